@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""local stand-in for spotify.Session/EventLoop/Config
+
+Serves a generated catalog and delivers synthetic 44.1 kHz stereo PCM
+through the same MUSIC_DELIVERY/END_OF_TRACK callbacks as libspotify, at
+a multiple of real time (speed=0 delivers as fast as the ripper accepts
+the audio).  install() swaps the classes into the spotify module, the
+enums and spotify.Error still come from pyspotify.
+"""
+
+from __future__ import unicode_literals, division
+
+import math
+import random
+import struct
+import threading
+import time
+import spotify
+
+sample_rate = 44100
+frame_size = 4
+frames_per_delivery = 2048
+
+
+def synthetic_pcm(seconds=1):
+    """a few tones plus noise, so encoders do a realistic amount of
+    work (silence compresses to nothing)"""
+    rnd = random.Random(0)
+    samples = []
+    for i in range(sample_rate * seconds):
+        t = i / sample_rate
+        tone = 0.3 * math.sin(2 * math.pi * 220 * t) + \
+            0.2 * math.sin(2 * math.pi * 331 * t) + \
+            0.1 * math.sin(2 * math.pi * 1870 * t)
+        left = tone + 0.1 * rnd.uniform(-1, 1)
+        right = tone * 0.8 + 0.1 * rnd.uniform(-1, 1)
+        samples.append(int(left * 32767 * 0.8))
+        samples.append(int(right * 32767 * 0.8))
+    return struct.pack(str("<%dh" % len(samples)), *samples)
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeLink(object):
+    def __init__(self, uri, link_type, item):
+        self.uri = uri
+        self.type = link_type
+        self.item = item
+
+    def as_track(self):
+        return self.item
+
+    def as_playlist(self):
+        return self.item
+
+    def as_album(self):
+        return self.item
+
+
+class FakeItem(object):
+    """anything libspotify loads: tracks, albums, playlists, images"""
+    is_loaded = True
+
+    def __init__(self, uri, link_type, **kwargs):
+        self.link = FakeLink(uri, link_type, self)
+        self.__dict__.update(kwargs)
+
+    def load(self, timeout=None):
+        return self
+
+
+class FakeCatalog(object):
+    """a playlist of num_tracks tracks of duration seconds each, spread
+    over albums of album_size tracks"""
+
+    def __init__(self, num_tracks, duration, album_size=12, cover_kb=64):
+        rnd = random.Random(1)
+        self.items = {}
+        self.user = Obj(display_name="bench", canonical_name="bench")
+
+        self.tracks = []
+        albums = []
+        for i in range(num_tracks):
+            if i % album_size == 0:
+                n = len(albums)
+                artist = FakeItem("spotify:artist:bench%04d" % n,
+                                  spotify.LinkType.ARTIST,
+                                  name="Bench Artist %d" % n)
+                image = FakeItem(
+                    "spotify:image:bench%04d" % n, spotify.LinkType.IMAGE,
+                    data=bytes(bytearray(rnd.getrandbits(8)
+                                         for j in range(cover_kb * 1024))))
+                album = FakeItem("spotify:album:bench%04d" % n,
+                                 spotify.LinkType.ALBUM,
+                                 name="Bench Album %d" % n, year=2000 + n,
+                                 artist=artist, tracks=[])
+                album.cover = lambda image_size=None, _image=image: _image
+                album.browse = lambda _album=album: Obj(
+                    tracks=_album.tracks, load=lambda: None)
+                albums.append(album)
+
+            album = albums[-1]
+            track = FakeItem("spotify:track:bench%06d" % i,
+                             spotify.LinkType.TRACK,
+                             name="Bench Track %d" % i, artists=[artist],
+                             album=album, index=len(album.tracks) + 1,
+                             disc=1, duration=int(duration * 1000),
+                             availability=1)
+            album.tracks.append(track)
+            self.tracks.append(track)
+
+        self.playlist = FakeItem(
+            "spotify:user:bench:playlist:bench", spotify.LinkType.PLAYLIST,
+            name="Bench Playlist", owner=self.user, tracks=self.tracks)
+        for item in [self.playlist] + albums + self.tracks:
+            self.items[item.link.uri] = item
+
+    def get_link(self, uri):
+        item = self.items.get(uri)
+        if item is None:
+            raise spotify.Error("Unknown URI " + uri)
+        return item.link
+
+
+class FakePlayer(object):
+    """plays the loaded track on a thread, like libspotify does"""
+    track = None
+    thread = None
+
+    def __init__(self, session):
+        self.session = session
+        self.playing = threading.Event()
+        self.audio_format = Obj(sample_rate=sample_rate, channels=2,
+                                frame_size=lambda: frame_size)
+
+    def load(self, track):
+        self.track = track
+        self.position = 0
+
+    def play(self, play=True):
+        if not play:
+            self.playing.clear()
+            return
+        self.playing.set()
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.deliver)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def deliver(self):
+        session = self.session
+        pcm = session.pcm
+        pcm_frames = len(pcm) // frame_size
+        total = self.track.duration * sample_rate // 1000
+        speed = session.speed
+        start = time.time()
+        start_position = self.position
+
+        while self.position < total and self.playing.is_set():
+            offset = self.position % pcm_frames
+            num_frames = min(frames_per_delivery, total - self.position,
+                             pcm_frames - offset)
+            frames = pcm[offset * frame_size:
+                         (offset + num_frames) * frame_size]
+            delivery_start = time.time()
+            consumed = session.emit(spotify.SessionEvent.MUSIC_DELIVERY,
+                                    self.audio_format, frames, num_frames)
+            session.delivery_times.append(time.time() - delivery_start)
+            self.position += consumed
+
+            # libspotify delivers the rest again a little later
+            if consumed < num_frames:
+                time.sleep(0.005)
+            if speed > 0:
+                delay = start + (self.position - start_position) / \
+                    sample_rate / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+        if self.position >= total and self.playing.is_set():
+            session.emit(spotify.SessionEvent.END_OF_TRACK)
+
+
+class FakeSession(object):
+    """the parts of spotify.Session the ripper uses"""
+    catalog = None
+    speed = 0
+    pcm = None
+    volume_normalization = False
+
+    # seconds spent in each MUSIC_DELIVERY callback
+    delivery_times = []
+
+    def __init__(self, config=None):
+        self.config = config
+        self.listeners = {}
+        self.connection = Obj(state=spotify.ConnectionState.LOGGED_OUT)
+        self.user = self.catalog.user
+        self.player = FakePlayer(self)
+
+    def on(self, event, listener):
+        self.listeners.setdefault(event, []).append(listener)
+
+    def emit(self, event, *args):
+        result = None
+        for listener in self.listeners.get(event, []):
+            result = listener(self, *args)
+        return result
+
+    def preferred_bitrate(self, bit_rate):
+        pass
+
+    def set_state(self, state):
+        self.connection.state = state
+        self.emit(spotify.SessionEvent.CONNECTION_STATE_UPDATED)
+
+    def login(self, user, password, remember_me=False):
+        self.emit(spotify.SessionEvent.LOGGED_IN, spotify.ErrorType.OK)
+        self.set_state(spotify.ConnectionState.LOGGED_IN)
+
+    def relogin(self):
+        self.login(None, None)
+
+    def logout(self):
+        self.set_state(spotify.ConnectionState.LOGGED_OUT)
+
+    def get_link(self, uri):
+        return self.catalog.get_link(uri)
+
+
+class FakeEventLoop(object):
+    def __init__(self, session):
+        self.session = session
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class FakeConfig(object):
+    settings_location = None
+    cache_location = None
+
+    def load_application_key_file(self, filename):
+        pass
+
+
+def install(catalog, speed=0):
+    """make the spotify module hand out the stand-ins"""
+    FakeSession.catalog = catalog
+    FakeSession.speed = speed
+    FakeSession.pcm = synthetic_pcm()
+    spotify.Session = FakeSession
+    spotify.EventLoop = FakeEventLoop
+    spotify.Config = FakeConfig
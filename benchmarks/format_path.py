@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""micro-benchmark of Ripper.format_track_path
+
+Formats the paths of a fake album with the compiled path template and
+with the str.replace loop it replaced, and prints the cost per track:
+
+    python benchmarks/format_path.py [num_tracks]
+"""
+
+from __future__ import unicode_literals, print_function
+
+import os
+import re
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from spotify_ripper.ripper import Ripper
+from spotify_ripper.utils import *
+from spotify_ripper.template import truncate_path
+
+format_str = "{album_artist}/{album}/{disc_num}-{track_num:2} {artist} - " \
+             "{track_name}.{ext}"
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+artist = Obj(name="Fleetwood Mac")
+album = Obj(name="Rumours (Super Deluxe)", year=1977, link=Obj(
+    uri="spotify:album:1bt6q2SruMsBtcerNVtpZB"))
+tracks = [Obj(name="The Chain / Demo: %d" % i, artists=[artist], album=album,
+              index=i % 20 + 1, disc=i // 20 + 1) for i in range(1000)]
+args = argparse.Namespace(format=[format_str], output_type="mp3",
+                          directory=["/tmp/music"], ascii=False)
+
+
+class FakeRipper(object):
+    current_album = None
+    current_playlist = None
+    session = Obj(user=Obj(display_name="user"))
+    album_cache = Obj(get=lambda _album: _album)
+    path_template = Ripper.__dict__["path_template"]
+
+    def __init__(self):
+        self.path_templates = {}
+
+
+def legacy_format_track_path(idx, track):
+    """format_track_path before the path templates, without the
+    filesystem calls"""
+    audio_file = args.format[0].strip()
+    track_artist = to_ascii(
+        args, escape_filename_part(track.artists[0].name))
+    track_artists = to_ascii(args, ", ".join(
+        [_artist.name for _artist in track.artists]))
+    tags = {
+        "track_artist": track_artist, "track_artists": track_artists,
+        "album_artist": track_artist, "album_artists_web": track_artists,
+        "artist": track_artist, "artists": track_artists,
+        "album": to_ascii(args, escape_filename_part(track.album.name)),
+        "track_name": to_ascii(args, escape_filename_part(track.name)),
+        "track": to_ascii(args, escape_filename_part(track.name)),
+        "year": str(track.album.year), "ext": args.output_type,
+        "extension": args.output_type, "idx": str(idx), "index": str(idx),
+        "track_num": str(track.index), "track_idx": str(track.index),
+        "track_index": str(track.index), "disc_num": str(track.disc),
+        "disc_idx": str(track.disc), "disc_index": str(track.disc),
+        "playlist": "No Playlist", "playlist_name": "No Playlist",
+        "playlist_owner": "No Playlist Owner",
+        "playlist_user": "No Playlist Owner",
+        "playlist_username": "No Playlist Owner",
+        "user": "user", "username": "user",
+    }
+    fill_tags = {"idx", "index", "track_num", "track_idx",
+                 "track_index", "disc_num", "disc_idx", "disc_index"}
+    for tag in tags.keys():
+        audio_file = audio_file.replace("{" + tag + "}", tags[tag])
+        if tag in fill_tags:
+            match = re.search(r"\{" + tag + r":\d+\}", audio_file)
+            if match:
+                tokens = audio_file[match.start():match.end()]\
+                    .strip("{}").split(":")
+                tag_filled = tags[tag].zfill(int(tokens[1]))
+                audio_file = audio_file[:match.start()] + tag_filled + \
+                    audio_file[match.end():]
+    return to_ascii(args, os.path.join(
+        base_dir(args), truncate_path(audio_file)))
+
+
+def main():
+    num_tracks = int(sys.argv[1]) if len(sys.argv) > 1 else len(tracks)
+    ripper = FakeRipper()
+    format_track_path = Ripper.__dict__["format_track_path"]
+
+    def compiled():
+        for idx, track in enumerate(tracks[:num_tracks]):
+            format_track_path(ripper, idx, track, args, create_dirs=False)
+
+    def legacy():
+        for idx, track in enumerate(tracks[:num_tracks]):
+            legacy_format_track_path(idx, track)
+
+    assert format_track_path(ripper, 3, tracks[3], args, False) == \
+        legacy_format_track_path(3, tracks[3])
+
+    for name, func in [("str.replace loop", legacy),
+                       ("compiled template", compiled)]:
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        print("%-18s %8.1f us/track" % (name, best * 1e6 / num_tracks))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""end-to-end benchmark of the ripping pipeline without a Spotify account
+
+Runs spotify-ripper's main() against a generated playlist served by the
+stand-in session in fakespotify.py, once for every output type (each in
+its own process), and reports tracks/minute, CPU seconds per track
+(including the encoders), peak RSS, the time spent in the audio
+delivery callback and the latency of each stage from the --trace records:
+
+    python benchmarks/pipeline.py [--speed 0] [--tracks 10] [--duration 60]
+                                  [--output-types mp3,flac,...] [--tty]
+
+--tty runs the ripper on a pseudo-terminal, so the progress display is
+drawn like in an interactive session (it is off when logging to a file).
+
+--speed is a multiple of real time, 0 delivers audio as fast as the
+ripper takes it.  Results are appended to benchmarks/results.jsonl and
+compared with the last result of the same configuration, so regressions
+show up between versions.
+"""
+
+from __future__ import unicode_literals, print_function, division
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import platform
+import threading
+import subprocess
+import struct
+import pty
+import fcntl
+import termios
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from spotify_ripper.utils import which
+
+# (output type, option, encoder)
+output_types = [
+    ("mp3", None, "lame"),
+    ("flac", "--flac", "flac"),
+    ("ogg", "--vorbis", "oggenc"),
+    ("opus", "--opus", "opusenc"),
+    ("aac", "--aac", "faac"),
+    ("m4a", "--mp4", "fdkaac"),
+    ("wav", "--wav", None),
+    ("pcm", "--pcm", None),
+]
+
+# the stages reported, (where, name) of the --trace records
+report_stages = [
+    ("track", "prepare_rip"), ("track", "stream"),
+    ("track", "finish_rip"), ("output", "encoder_drain"),
+    ("output", "close"), ("output", "tagging"), ("output", "save"),
+]
+
+default_results = os.path.join(os.path.dirname(__file__), "results.jsonl")
+
+
+def version():
+    """git revision of the tree being benchmarked"""
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def stage_latencies(trace_file):
+    """mean and 95th percentile of every reported stage"""
+    durations = {}
+
+    def add(stages, where):
+        for name, (start, end) in stages.items():
+            durations.setdefault((where, name), []).append(end - start)
+
+    with io.open(trace_file, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            add(record["stages"], "track")
+            for output in record["outputs"].values():
+                add(output["stages"], "output")
+
+    latencies = {}
+    for key in report_stages:
+        values = durations.get(key)
+        if values:
+            latencies[key[1]] = {
+                "mean": sum(values) / len(values),
+                "p95": percentile(values, 0.95)}
+    return latencies
+
+
+def run_one(opts):
+    """rip the fake playlist in this process and write the result"""
+    import fakespotify
+    from spotify_ripper import main as ripper_main
+
+    catalog = fakespotify.FakeCatalog(opts.tracks, opts.duration)
+    fakespotify.install(catalog, opts.speed)
+
+    # the ripper waits forever if its thread dies
+    watchdog = threading.Timer(opts.timeout, os._exit, [2])
+    watchdog.daemon = True
+    watchdog.start()
+
+    # keep the journal and caches out of the real settings directory
+    work_dir = tempfile.mkdtemp(prefix="spotify-ripper-bench-")
+    os.environ["HOME"] = work_dir
+    try:
+        key_file = os.path.join(work_dir, "spotify_appkey.key")
+        with open(key_file, "wb") as f:
+            f.write(b"bench")
+        trace_file = os.path.join(work_dir, "trace.jsonl")
+        option = dict((t[0], t[1]) for t in output_types)[opts.child]
+        prog_args = [
+            "-S", os.path.join(work_dir, "settings"),
+            "-d", os.path.join(work_dir, "music"),
+            "-k", key_file, "-u", "bench", "-p", "bench",
+            "--trace", trace_file, catalog.playlist.link.uri]
+        if option is not None:
+            prog_args.insert(0, option)
+        if not opts.tty:
+            prog_args[:0] = ["-L", "-"]
+
+        def cpu_time():
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            return usage.ru_utime + usage.ru_stime + \
+                children.ru_utime + children.ru_stime
+
+        # generating the catalog and audio is not counted
+        cpu_start = cpu_time()
+        start = time.time()
+        ripper_main.main(prog_args)
+        elapsed = time.time() - start
+        cpu = cpu_time() - cpu_start
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        delivery_times = fakespotify.FakeSession.delivery_times
+
+        # ru_maxrss is in kilobytes on Linux and bytes on OS X
+        rss_unit = 1 if sys.platform == "darwin" else 1024
+        result = {
+            "output_type": opts.child,
+            "seconds": elapsed,
+            "tracks_per_minute": opts.tracks * 60 / elapsed,
+            "cpu_per_track": cpu / opts.tracks,
+            "peak_rss_mb": usage.ru_maxrss * rss_unit / 1048576.0,
+            "encoder_peak_rss_mb":
+                children.ru_maxrss * rss_unit / 1048576.0,
+            "delivery_us": {
+                "mean": sum(delivery_times) * 1e6 / len(delivery_times),
+                "p99": percentile(delivery_times, 0.99) * 1e6},
+            "stages": stage_latencies(trace_file),
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with io.open(opts.result, "w", encoding="utf-8") as f:
+        f.write(json.dumps(result))
+
+
+def run_on_tty(command, log):
+    """run command with its output on a pseudo-terminal, copying what
+    it draws to log"""
+    master, slave = pty.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack(str("HHHH"),
+                                                       50, 120, 0, 0))
+    proc = subprocess.Popen(command, stdout=slave, stderr=log)
+    os.close(slave)
+    while True:
+        try:
+            data = os.read(master, 65536)
+        except OSError:
+            # the child has exited and closed the terminal
+            break
+        if not data:
+            break
+        log.write(data)
+    os.close(master)
+    return proc.wait()
+
+
+def last_results(results_file, config):
+    """latest earlier result of each output type with the same config"""
+    results = {}
+    if os.path.exists(results_file):
+        with io.open(results_file, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if record["config"] == config:
+                    results[record["output_type"]] = record
+    return results
+
+
+def change(new, old):
+    if not old:
+        return ""
+    return "%+.1f%%" % ((new - old) * 100.0 / old)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--speed", type=float, default=0,
+                        help="multiple of real time, 0=unthrottled")
+    parser.add_argument("--tracks", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60,
+                        help="seconds of audio per track")
+    parser.add_argument("--output-types",
+                        default=",".join(t[0] for t in output_types))
+    parser.add_argument("--results", default=default_results)
+    parser.add_argument("--timeout", type=float, default=1800,
+                        help="seconds before a run is given up")
+    parser.add_argument("--tty", action="store_true",
+                        help="run the ripper on a pseudo-terminal")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.child is not None:
+        run_one(opts)
+        return
+
+    config = {"speed": opts.speed, "tracks": opts.tracks,
+              "duration": opts.duration, "tty": opts.tty}
+    previous = last_results(opts.results, config)
+    rev = version()
+
+    print("%-5s %10s %10s %9s %9s %12s  %s" % (
+        "type", "tracks/min", "cpu/track", "rss MB", "enc MB",
+        "delivery us", "stages"))
+    for output_type, option, encoder in output_types:
+        if output_type not in opts.output_types.split(","):
+            continue
+        if encoder is not None and which(encoder) is None:
+            print("%-5s skipped, %s is not installed" % (
+                output_type, encoder))
+            continue
+
+        # the ripper's output goes to a log, kept if the run fails
+        fd, result_file = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        log_file = result_file[:-5] + ".log"
+        try:
+            command = [
+                sys.executable, os.path.abspath(__file__),
+                "--child", output_type, "--result", result_file,
+                "--speed", str(opts.speed), "--tracks", str(opts.tracks),
+                "--duration", str(opts.duration),
+                "--timeout", str(opts.timeout)]
+            with open(log_file, "wb") as log:
+                if opts.tty:
+                    ret_code = run_on_tty(command + ["--tty"], log)
+                else:
+                    ret_code = subprocess.call(
+                        command, stdout=log, stderr=subprocess.STDOUT)
+            if ret_code != 0:
+                raise subprocess.CalledProcessError(ret_code, command)
+            with io.open(result_file, encoding="utf-8") as f:
+                result = json.loads(f.read())
+            os.remove(log_file)
+        except (subprocess.CalledProcessError, ValueError):
+            print("%-5s failed, see %s" % (output_type, log_file))
+            continue
+        finally:
+            os.remove(result_file)
+
+        old = previous.get(output_type, {})
+        print("%-5s %10.1f %10.2f %9.1f %9.1f %12.1f  %s" % (
+            output_type, result["tracks_per_minute"],
+            result["cpu_per_track"], result["peak_rss_mb"],
+            result["encoder_peak_rss_mb"], result["delivery_us"]["mean"],
+            ", ".join(
+                "%s %.0fms" % (name, stage["mean"] * 1000)
+                for name, stage in sorted(result["stages"].items()))))
+        if old:
+            print("%-5s %10s %10s %9s %9s %12s  vs %s" % (
+                "", change(result["tracks_per_minute"],
+                           old["tracks_per_minute"]),
+                change(result["cpu_per_track"], old["cpu_per_track"]),
+                "", "", change(result["delivery_us"]["mean"],
+                               old["delivery_us"]["mean"]),
+                old["version"]))
+
+        result.update({
+            "time": time.time(), "version": rev, "config": config,
+            "python": platform.python_version()})
+        with io.open(opts.results, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -36,7 +36,6 @@ setup(
         'colorama>=0.3.3',
         'mutagen==1.29',
         'requests>=2.3.0',
-        'schedule>=0.3.1',
     ],
 
     # Metadata
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from spotify_ripper.covers import Cover
+from collections import OrderedDict
+import threading
+
+
+class AlbumMeta(object):
+    """metadata of one album, the album browse and the cover image are
+    only fetched the first time they are needed"""
+    _discs = None
+    _cover_loaded = False
+    _cover = None
+
+    def __init__(self, album, cover_cache=None):
+        if not album.is_loaded:
+            album.load()
+        self.album = album
+        self.cover_cache = cover_cache
+        self.uri = album.link.uri
+        self.name = album.name
+        self.year = album.year
+        self.artist = album.artist.name if album.artist is not None \
+            else None
+
+    @property
+    def discs(self):
+        """highest track number of each disc"""
+        if self._discs is None:
+            album_browser = self.album.browse()
+            album_browser.load()
+            discs = {}
+            for track in album_browser.tracks:
+                if track.index > discs.get(track.disc, 0):
+                    discs[track.disc] = track.index
+            self._discs = discs
+        return self._discs
+
+    @property
+    def num_discs(self):
+        return max(self.discs.keys()) if self.discs else 0
+
+    def num_tracks(self, disc):
+        return self.discs.get(disc, 0)
+
+    @property
+    def cover(self):
+        """Cover of the album, None if the album has no cover"""
+        if not self._cover_loaded:
+            image = self.album.cover()
+            if image is not None:
+                if self.cover_cache is not None:
+                    self._cover = self.cover_cache.get(image)
+                else:
+                    image.load()
+                    self._cover = Cover(image.data)
+            self._cover_loaded = True
+        return self._cover
+
+
+class AlbumCache(object):
+    """least recently used cache of AlbumMeta keyed by album URI"""
+
+    def __init__(self, cover_cache=None, capacity=64):
+        self.cover_cache = cover_cache
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.albums = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, album):
+        uri = album.link.uri
+        with self.lock:
+            album_meta = self.albums.pop(uri, None)
+            if album_meta is not None:
+                self.hits += 1
+                self.albums[uri] = album_meta
+                return album_meta
+
+        # load outside the lock, loading may take a while
+        album_meta = AlbumMeta(album, self.cover_cache)
+        with self.lock:
+            self.misses += 1
+            self.albums[uri] = album_meta
+            while len(self.albums) > self.capacity:
+                self.albums.popitem(last=False)
+        return album_meta
+
+    def clear(self):
+        with self.lock:
+            self.albums.clear()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from mutagen import id3, flac, mp4
+from spotify_ripper.utils import *
+from collections import OrderedDict
+import os
+import io
+import base64
+import hashlib
+import threading
+import weakref
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class Cover(object):
+    """cover image bytes and the tag frames rendered from them, which are
+    built once and shared by every track of the album"""
+    _apic = None
+    _flac_picture = None
+    _vorbis_block = None
+    _mp4_cover = None
+    _m4a_cover = None
+
+    def __init__(self, data, path=None):
+        self.data = data
+        # file the image is cached in, None if it could not be saved
+        self.path = path
+        self.digest = hashlib.sha1(data).hexdigest()
+
+    @property
+    def apic(self):
+        if self._apic is None:
+            self._apic = id3.APIC(
+                encoding=3,
+                mime='image/jpeg',
+                type=3,
+                desc='Front Cover',
+                data=self.data
+            )
+        return self._apic
+
+    @property
+    def flac_picture(self):
+        if self._flac_picture is None:
+            pic = flac.Picture()
+            pic.type = 3
+            pic.mime = "image/jpeg"
+            pic.desc = "Front Cover"
+            pic.data = self.data
+            self._flac_picture = pic
+        return self._flac_picture
+
+    @property
+    def vorbis_block(self):
+        """base64 METADATA_BLOCK_PICTURE for Ogg Vorbis/Opus"""
+        if self._vorbis_block is None:
+            self._vorbis_block = base64.b64encode(
+                self.flac_picture.write()).decode("ascii")
+        return self._vorbis_block
+
+    @property
+    def mp4_cover(self):
+        if self._mp4_cover is None:
+            self._mp4_cover = mp4.MP4Cover(self.data)
+        return self._mp4_cover
+
+    @property
+    def m4a_cover(self):
+        # only used by Python 2
+        if self._m4a_cover is None:
+            from mutagen import m4a
+            self._m4a_cover = m4a.M4ACover(self.data)
+        return self._m4a_cover
+
+
+def downscale(data, max_size):
+    """shrink a JPEG to fit in max_size x max_size pixels"""
+    image = Image.open(io.BytesIO(data))
+    if image.size[0] <= max_size and image.size[1] <= max_size:
+        return data
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+    out = io.BytesIO()
+    image.convert("RGB").save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+class CoverCache(object):
+    """cover images keyed by image URI, kept in memory (least recently
+    used) and in the covers folder of the settings directory, the same
+    image under several URIs shares one Cover"""
+
+    def __init__(self, args, capacity=32):
+        self.args = args
+        self.capacity = capacity
+        self.max_size = args.cover_max_size
+        if self.max_size is not None and Image is None:
+            print(Fore.YELLOW + "Warning: --cover-max-size needs Pillow, "
+                  "embedding covers in their original size" + Fore.RESET)
+            self.max_size = None
+
+        self.dir = os.path.join(settings_dir(args), "covers")
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        self.lock = threading.Lock()
+        self.covers = OrderedDict()
+        self.digests = weakref.WeakValueDictionary()
+
+    def cover_file(self, uri):
+        key = uri if self.max_size is None else \
+            uri + ":" + str(self.max_size)
+        return os.path.join(
+            self.dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".jpg")
+
+    def get(self, image):
+        """Cover of a spotify.Image"""
+        uri = image.link.uri
+        with self.lock:
+            cover = self.covers.pop(uri, None)
+            if cover is not None:
+                self.covers[uri] = cover
+                return cover
+
+        cover_file = self.cover_file(uri)
+        if os.path.exists(cover_file):
+            with open(cover_file, "rb") as f:
+                data = f.read()
+        else:
+            image.load()
+            data = image.data
+            if self.max_size is not None:
+                data = downscale(data, self.max_size)
+            if not self.save(cover_file, data):
+                cover_file = None
+
+        cover = Cover(data, cover_file)
+        with self.lock:
+            # reuse the frames already rendered from the same image
+            cover = self.digests.setdefault(cover.digest, cover)
+            self.covers[uri] = cover
+            while len(self.covers) > self.capacity:
+                self.covers.popitem(last=False)
+        return cover
+
+    def save(self, cover_file, data):
+        """returns False if the cover could not be cached"""
+        tmp_file = cover_file + "." + str(threading.current_thread().ident)
+        try:
+            with open(tmp_file, "wb") as f:
+                f.write(data)
+            os.rename(tmp_file, cover_file)
+            return True
+        except (IOError, OSError) as e:
+            rm_file(tmp_file)
+            return False
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.ripper import Ripper, RipOutput
+from spotify_ripper.encoder import encoder_command
+from spotify_ripper.utils import *
+from collections import OrderedDict
+import re
+import sys
+import copy
+import json
+import time
+import threading
+
+if sys.version_info >= (3, 0):
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import queue
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import Queue as queue
+
+# options a job can override, see README
+job_options = ["output", "tee", "format", "directory", "overwrite",
+               "comment"]
+
+output_type_names = ["mp3", "wav", "pcm", "flac", "ogg", "vorbis", "opus",
+                     "aac", "m4a", "mp4"]
+
+
+def job_args(args, options, make_output_args):
+    """copy of the daemon's args with the options of a job, raises
+    ValueError if an option is invalid"""
+    if not isinstance(options, dict):
+        raise ValueError("options must be an object")
+    for name, value in options.items():
+        if name not in job_options:
+            raise ValueError("unknown option '" + name + "'")
+        if name == "tee":
+            if not isinstance(value, list) or \
+                    not all(isinstance(tee, type("")) for tee in value):
+                raise ValueError("tee must be a list of strings")
+        elif name != "overwrite" and not isinstance(value, type("")):
+            raise ValueError(name + " must be a string")
+
+    def output_args(_args, spec):
+        if spec.split(":", 1)[0].strip().lower() not in output_type_names:
+            raise ValueError("unknown output type '" + spec + "'")
+        _output_args = make_output_args(_args, spec)
+        command = encoder_command(_output_args, "-")
+        if command is not None and which(command[0]) is None:
+            raise ValueError("encoder '" + command[0] +
+                             "' is not installed")
+        return _output_args
+
+    _args = copy.copy(args)
+    if "directory" in options:
+        _args.directory = [options["directory"]]
+    if "overwrite" in options:
+        _args.overwrite = bool(options["overwrite"])
+    if "comment" in options:
+        _args.comment = [options["comment"]]
+    if "format" in options:
+        _args.format = [options["format"]]
+
+    # the outputs are made from the job's settings, so they pick up its
+    # directory, format and comment
+    if "output" in options:
+        _args = output_args(_args, options["output"])
+    _args.tee_outputs = [output_args(_args, tee)
+                         for tee in options.get("tee", args.tee) or []]
+
+    # two outputs with the same type and format would write the same files
+    outputs = set([(_args.output_type, _args.format[0])])
+    for output in _args.tee_outputs:
+        if (output.output_type, output.format[0]) in outputs:
+            raise ValueError("tee output '" + output.output_type + ":" +
+                             output.format[0] + "' writes the same files "
+                             "as another output")
+        outputs.add((output.output_type, output.format[0]))
+    return _args
+
+
+class Job(object):
+    """URIs submitted to the daemon and the events of ripping them"""
+    started = None
+    finished = None
+    error = None
+
+    def __init__(self, job_id, uris, options, args):
+        self.id = job_id
+        self.uris = uris
+        self.options = options
+        self.args = args
+        self.state = "queued"
+        self.submitted = time.time()
+        self.ripped = []
+        self.failed = []
+        self.events = []
+        self.cond = threading.Condition()
+
+    @property
+    def done(self):
+        return self.state in ("done", "failed")
+
+    def emit(self, event, **fields):
+        record = OrderedDict([("event", event), ("time", time.time())])
+        record.update(sorted(fields.items()))
+        with self.cond:
+            self.events.append(record)
+            self.cond.notify_all()
+
+    def wait_events(self, pos, timeout):
+        """events after the first pos, waits up to timeout for more"""
+        with self.cond:
+            if len(self.events) <= pos and not self.done:
+                self.cond.wait(timeout)
+            return self.events[pos:], self.done
+
+    def status(self):
+        return OrderedDict([
+            ("id", self.id), ("state", self.state), ("uris", self.uris),
+            ("options", self.options), ("submitted", self.submitted),
+            ("started", self.started), ("finished", self.finished),
+            ("ripped", len(self.ripped)), ("failed", len(self.failed)),
+            ("error", self.error)])
+
+
+class DaemonServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    """the job API, see README"""
+
+    def send_json(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        ripper = self.server.ripper
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path == "/health":
+            self.send_json(200, ripper.health())
+        elif path == "/ready":
+            ready = ripper.ready
+            self.send_json(200 if ready else 503, {"ready": ready})
+        elif path == "/jobs":
+            self.send_json(200, [job.status() for job in ripper.job_list()])
+        else:
+            match = re.match(r"^/jobs/(\d+)(/events)?$", path)
+            job = ripper.jobs.get(int(match.group(1))) \
+                if match is not None else None
+            if job is None:
+                self.send_json(404, {"error": "not found"})
+            elif match.group(2) is not None:
+                self.stream_events(job)
+            else:
+                self.send_json(200, job.status())
+
+    def do_POST(self):
+        ripper = self.server.ripper
+        if self.path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length).decode("utf-8"))
+            uris = body["uris"]
+            if not isinstance(uris, list) or not uris:
+                raise ValueError("uris must be a non-empty list")
+            job = ripper.submit(uris, body.get("options", {}))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(201, job.status())
+
+    def stream_events(self, job):
+        """one JSON event per line until the job is done, with the
+        position in the current track every second"""
+        ripper = self.server.ripper
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+
+        def write(record):
+            self.wfile.write((json.dumps(record, ensure_ascii=False) +
+                              "\n").encode("utf-8"))
+
+        pos = 0
+        try:
+            while True:
+                events, done = job.wait_events(pos, 1.0)
+                for record in events:
+                    write(record)
+                pos += len(events)
+                if done and not events:
+                    break
+                if not events:
+                    progress = ripper.track_progress(job)
+                    if progress is not None:
+                        write(progress)
+                self.wfile.flush()
+        except (IOError, OSError):
+            # the client went away
+            pass
+
+    def log_message(self, format, *args):
+        # keep the access log out of the ripper's output
+        pass
+
+
+class DaemonRipper(Ripper):
+    """keeps one logged in session and rips the jobs submitted to its
+    local HTTP API one after the other (--daemon)"""
+    job = None
+    track_uri = None
+    jobs_run = 0
+
+    # finished jobs kept for GET /jobs, older ones are forgotten
+    max_finished_jobs = 100
+
+    def __init__(self, args, make_output_args):
+        # only reachable from this machine, there is no authentication
+        try:
+            self.server = DaemonServer(("127.0.0.1", args.daemon),
+                                       DaemonHandler)
+        except (IOError, OSError) as e:
+            print(Fore.RED + "spotify-ripper: error: could not listen on "
+                  "port " + str(args.daemon) + Fore.RESET)
+            print(str(e))
+            sys.exit(1)
+
+        Ripper.__init__(self, args)
+        self.base_args = args
+        self.base_outputs = self.outputs
+        self.make_output_args = make_output_args
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.job_queue = queue.Queue()
+        self.next_id = 1
+        self.started = time.time()
+
+        self.server.ripper = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def ready(self):
+        return self.logged_in.is_set() and not self.finished
+
+    def health(self):
+        return OrderedDict([
+            ("status", "ok"), ("logged_in", self.logged_in.is_set()),
+            ("uptime", time.time() - self.started),
+            ("queued", self.job_queue.qsize()),
+            ("running", self.job.id if self.job is not None else None)])
+
+    def job_list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def submit(self, uris, options, check_uris=True):
+        """queue a job, raises ValueError if it is invalid"""
+        # files, stdin and search queries are only for the command line,
+        # a search would wait for input on the daemon's terminal
+        if check_uris:
+            for uri in uris:
+                if (not isinstance(uri, type("")) or
+                        not uri.startswith("spotify:")):
+                    raise ValueError("not a Spotify URI: " +
+                                     json.dumps(uri))
+
+        args = job_args(self.base_args, options, self.make_output_args)
+        args.uri = uris
+        with self.lock:
+            job = Job(self.next_id, uris, options, args)
+            self.jobs[job.id] = job
+            self.next_id += 1
+        self.job_queue.put(job)
+        return job
+
+    def run(self):
+        if not self.login_from_args():
+            self.finished = True
+            return
+
+        if self.spool is not None:
+            self.spool.resume()
+
+        if self.args.resume:
+            self.resume_journal()
+
+        # URIs given on the command line are the first job
+        if self.args.uri:
+            self.submit(self.args.uri, {}, check_uris=False)
+
+        print(Fore.GREEN + "Ready for jobs" + Fore.RESET)
+        while True:
+            job = self.job_queue.get()
+            if job is None:
+                break
+            self.run_job(job)
+
+        self.finish_run()
+
+    def run_job(self, job):
+        print(Fore.GREEN + "Starting job " + str(job.id) + Fore.RESET)
+        self.job = job
+        job.state = "running"
+        job.started = time.time()
+        job.emit("started")
+
+        # every job is a run of its own, only the first one continues
+        # the journal of a --resume
+        if self.jobs_run > 0:
+            self.durability.sync_pending()
+            self.journal.reset()
+        self.jobs_run += 1
+        self.tracks_to_remove = []
+        self.created_dirs = set()
+
+        # a job with its own output settings gets its own encoders
+        self.args = self.planner.args = job.args
+        if any(name != "overwrite" for name in job.options):
+            self.outputs = [RipOutput(output_args) for output_args in
+                            [job.args] + job.args.tee_outputs]
+        self.success_tracks = []
+        self.failure_tracks = []
+        self.expander.failed_links = []
+        try:
+            self.rip_uris()
+            job.state = "done"
+        except Exception as e:
+            print(Fore.RED + "Job " + str(job.id) + " failed" + Fore.RESET)
+            print(str(e))
+            self.finish_encodes(wait=True)
+            job.state = "failed"
+            job.error = str(e)
+        finally:
+            if self.outputs is not self.base_outputs:
+                self.shutdown_encoders()
+                self.outputs = self.base_outputs
+            self.args = self.planner.args = self.base_args
+            self.current_playlist = None
+            self.current_album = None
+            self.tracks_to_remove = []
+            self.print_summary()
+            self.job = None
+            job.finished = time.time()
+            job.emit(job.state, ripped=len(job.ripped),
+                     failed=len(job.failed), error=job.error)
+            self.forget_jobs()
+
+    def forget_jobs(self):
+        """drop the oldest finished jobs past max_finished_jobs"""
+        with self.lock:
+            finished = [job_id for job_id, job in self.jobs.items()
+                        if job.done]
+            for job_id in finished[:-self.max_finished_jobs]:
+                del self.jobs[job_id]
+
+    def rip_track(self, plan, overwrite=False):
+        self.track_uri = plan.uri
+        if self.job is not None:
+            self.job.emit("track", uri=plan.uri, idx=plan.idx,
+                          total=self.progress.total_tracks)
+        Ripper.rip_track(self, plan, overwrite)
+
+    def track_progress(self, job):
+        """position in the track being ripped for job, if any"""
+        if self.job is not job or not self.ripping:
+            return None
+        progress = self.progress
+        return OrderedDict([
+            ("event", "progress"), ("time", time.time()),
+            ("uri", self.track_uri),
+            ("position", progress.song_position),
+            ("duration", progress.song_duration)])
+
+    def log_success(self, track, audio_files):
+        Ripper.log_success(self, track, audio_files)
+        if self.job is not None:
+            self.job.ripped.append(track.link.uri)
+            self.job.emit("ripped", uri=track.link.uri, files=audio_files)
+
+    def log_failure(self, track):
+        Ripper.log_failure(self, track)
+        if self.job is not None:
+            self.job.failed.append(track.link.uri)
+            self.job.emit("failed", uri=track.link.uri)
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def finish_run(self):
+        self.stop_server()
+        Ripper.finish_run(self)
+
+    def abort(self):
+        self.stop_server()
+        Ripper.abort(self)
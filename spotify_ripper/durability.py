@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+import os
+import threading
+
+durability_modes = ["none", "batch", "strict"]
+
+
+def fsync_path(path):
+    """flush a file (or directory) that is no longer open to disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Durability(threading.Thread):
+    """flushes the ripped files to disk according to --durability
+
+    none leaves it to the OS, batch fsyncs the files of every sync_every
+    tracks (or whatever finished in the last sync_interval seconds) on
+    this thread, strict fsyncs every file and its directory before the
+    track is logged as done.  A track is only recorded as tagged in the
+    journal once its files are synced.
+    """
+    sync_every = 16
+    sync_interval = 30.0
+
+    def __init__(self, args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.mode = args.durability
+        self.lock = threading.Lock()
+        self.pending = []
+        self.num_tracks = 0
+        self.wake_up = threading.Event()
+        self.stopped = False
+        if self.mode == "batch":
+            self.start()
+
+    @property
+    def enabled(self):
+        """whether the files a run writes are fsynced at all"""
+        return self.mode != "none"
+
+    def add(self, audio_files, synced=None):
+        """files of a track that has been ripped and tagged, synced is
+        called once they are on disk (right away with none, from this
+        thread with batch)"""
+        if self.mode == "batch":
+            with self.lock:
+                self.pending.append((audio_files, synced))
+                self.num_tracks += 1
+                if self.num_tracks >= self.sync_every:
+                    self.wake_up.set()
+            return
+
+        if self.mode == "strict" and self.sync(audio_files):
+            return
+        if synced is not None:
+            synced()
+
+    def run(self):
+        while not self.stopped:
+            self.wake_up.wait(self.sync_interval)
+            self.wake_up.clear()
+            self.sync_pending()
+
+    def sync_pending(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+            self.num_tracks = 0
+        failed = self.sync([path for audio_files, _ in pending
+                            for path in audio_files])
+        for audio_files, synced in pending:
+            if synced is not None and not failed.intersection(audio_files):
+                synced()
+
+    def sync(self, audio_files):
+        """returns the files that could not be synced"""
+        # the directories make the renames of the part files durable
+        failed = set()
+        dirs = []
+        for path in audio_files:
+            dir_name = os.path.dirname(path)
+            if dir_name not in dirs:
+                dirs.append(dir_name)
+        for path in audio_files + dirs:
+            try:
+                fsync_path(path)
+            except (IOError, OSError) as e:
+                print(Fore.YELLOW + "Warning: could not sync " + path +
+                      " to disk" + Fore.RESET)
+                print(str(e))
+                failed.add(path)
+        for path in audio_files:
+            if os.path.dirname(path) in failed:
+                failed.add(path)
+        return failed
+
+    def close(self):
+        """sync what is left, called at the end of a run"""
+        if self.mode == "batch" and self.is_alive():
+            self.stopped = True
+            self.wake_up.set()
+            self.join()
+        self.sync_pending()
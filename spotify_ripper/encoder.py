@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from subprocess import Popen, PIPE
+from spotify_ripper.utils import *
+import os
+import re
+import errno
+import time
+import shutil
+import threading
+import uuid
+
+# output types that are piped through an external encoder
+encoded_types = ["flac", "ogg", "opus", "aac", "m4a", "mp3"]
+
+
+def encoder_command(args, audio_file, extra_args=None):
+    """command line of the encoder that reads raw PCM from stdin
+    and writes audio_file, extra_args go right after the program"""
+    command = base_encoder_command(args, audio_file)
+    if command is not None and extra_args:
+        command[1:1] = extra_args
+    return command
+
+
+def base_encoder_command(args, audio_file):
+    if args.output_type == "flac":
+        return ["flac", "-f", str("-" + args.comp), "--silent", "--endian",
+                "little", "--channels", "2", "--bps", "16", "--sample-rate",
+                "44100", "--sign", "signed", "-o", audio_file, "-"]
+    elif args.output_type == "ogg":
+        if args.cbr:
+            return ["oggenc", "--quiet", "--raw", "-b", args.bitrate, "-o",
+                    audio_file, "-"]
+        else:
+            return ["oggenc", "--quiet", "--raw", "-q", args.vbr, "-o",
+                    audio_file, "-"]
+    elif args.output_type == "opus":
+        if args.cbr:
+            return ["opusenc", "--quiet", "--comp", args.comp, "--cvbr",
+                    "--bitrate", str(int(args.bitrate) / 2), "--raw",
+                    "--raw-rate", "44100", "-", audio_file]
+        else:
+            return ["opusenc", "--quiet", "--comp", args.comp, "--vbr",
+                    "--bitrate", args.vbr, "--raw", "--raw-rate", "44100",
+                    "-", audio_file]
+    elif args.output_type == "aac":
+        if args.cbr:
+            return ["faac", "-P", "-X", "-b", args.bitrate, "-o",
+                    audio_file, "-"]
+        else:
+            return ["faac", "-P", "-X", "-q", args.vbr, "-o",
+                    audio_file, "-"]
+    elif args.output_type == "m4a":
+        if args.cbr:
+            return ["fdkaac", "-S", "-R", "-w", "200000", "-b",
+                    args.bitrate, "-o", audio_file, "-"]
+        else:
+            return ["fdkaac", "-S", "-R", "-w", "200000", "-m", args.vbr,
+                    "-o", audio_file, "-"]
+    elif args.output_type == "mp3":
+        if args.cbr:
+            return ["lame", "--silent", "-cbr", "-b", args.bitrate, "-h",
+                    "-r", "-", audio_file]
+        else:
+            return ["lame", "--silent", "-V", args.vbr, "-h", "-r", "-",
+                    audio_file]
+    return None
+
+
+def part_file_path(args):
+    """hidden file in the base directory that an encoder writes to
+    before it is moved to the track's path"""
+    _base_dir = base_dir(args)
+    if not os.path.exists(_base_dir):
+        os.makedirs(_base_dir)
+
+    # the pid tells which part files a crashed run left behind
+    return os.path.join(
+        _base_dir, ".spotify-ripper-" + str(os.getpid()) + "-" +
+        uuid.uuid4().hex[:12] + ".part." + args.output_type)
+
+
+def pid_alive(pid):
+    if os.name == "nt":
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def remove_stale_part_files(args):
+    """remove the part files in the base directory that a run which
+    didn't finish left behind"""
+    _base_dir = base_dir(args)
+    if not os.path.isdir(_base_dir):
+        return
+
+    # a part file that was written to lately could belong to another run
+    # sharing the directory (--accounts), which could be resuming its spool
+    min_age = 600
+    for name in os.listdir(_base_dir):
+        match = re.match(
+            r"^\.spotify-ripper-(?:(\d+)-)?[0-9a-f]{12}\.part\.\w+$", name)
+        if match is None:
+            continue
+        if match.group(1) is not None and pid_alive(int(match.group(1))):
+            continue
+        path = os.path.join(_base_dir, name)
+        try:
+            if time.time() - os.path.getmtime(path) < min_age:
+                continue
+        except OSError:
+            continue
+        rm_file(path)
+
+
+class EncoderJob(object):
+    """an encoder process and the track it is (or will be) encoding"""
+    idx = None
+    track = None
+    audio_file = None
+    ret_code = None
+    error = None
+    drain_start = None
+    drain_end = None
+
+    # the encoder wrote the tags itself
+    tagged = False
+
+    def __init__(self, proc, part_file, extra_args=None):
+        self.proc = proc
+        self.part_file = part_file
+        self.extra_args = extra_args
+
+    @property
+    def pipe(self):
+        return self.proc.stdin
+
+    @property
+    def failed(self):
+        return self.error is not None or self.ret_code != 0
+
+
+class EncoderPool(object):
+    """keeps the next track's encoder spawned while the current track
+    streams and lets finished tracks drain in the background
+
+    Encoders write to a hidden part file in the base directory, which is
+    moved to the track's path once the encoder exits successfully.
+    """
+    spare = None
+    # the encoder of the track that is streaming
+    active = None
+    dev_null = None
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(int(args.max_encoders))
+        self.draining = []
+        self.finished = []
+
+    def spawn(self, extra_args=None):
+        args = self.args
+        part_file = part_file_path(args)
+        command = encoder_command(args, part_file, extra_args)
+
+        # faac writes its progress to stdout/stderr
+        if args.output_type == "aac":
+            if self.dev_null is None:
+                self.dev_null = open(os.devnull, 'wb')
+            proc = Popen(command, stdin=PIPE,
+                         stdout=self.dev_null, stderr=self.dev_null)
+        else:
+            proc = Popen(command, stdin=PIPE)
+        return EncoderJob(proc, part_file, extra_args)
+
+    def acquire(self, idx, track, audio_file, extra_args=None,
+                tagged=False):
+        """hand out the pre-spawned encoder if it was started with the
+        same extra_args and start the next one
+
+        The tag padding of mp3/flac usually stays the same for a whole
+        album, so the next encoder is spawned with this track's extra
+        args.  The tags of ogg/opus (tagged) differ for every track, those
+        encoders can't be spawned ahead and are started here."""
+        job = self.spare
+        self.spare = None
+        if job is not None and (job.extra_args != extra_args or
+                                job.proc.poll() is not None):
+            self.abort(job)
+            job = None
+        if job is None:
+            job = self.spawn(extra_args)
+        if not tagged:
+            self.spare = self.spawn(extra_args)
+        self.active = job
+
+        job.idx = idx
+        job.track = track
+        job.audio_file = audio_file
+        job.tagged = tagged
+        return job
+
+    def release(self, job):
+        """close the encoder's input and let it finish in the background,
+        blocks while max_encoders are already draining"""
+        self.slots.acquire()
+        with self.lock:
+            self.draining.append(job)
+            if self.active is job:
+                self.active = None
+        thread = threading.Thread(target=self.drain, args=(job,))
+        thread.daemon = True
+        thread.start()
+
+    def drain(self, job):
+        job.drain_start = monotonic()
+        try:
+            job.proc.stdin.close()
+            job.ret_code = job.proc.wait()
+            if job.ret_code == 0:
+                shutil.move(job.part_file, job.audio_file)
+            else:
+                rm_file(job.part_file)
+        except (IOError, OSError) as e:
+            job.error = e
+            rm_file(job.part_file)
+        finally:
+            job.drain_end = monotonic()
+            with self.lock:
+                self.draining.remove(job)
+                self.finished.append(job)
+            self.slots.release()
+
+    def abort(self, job):
+        """kill an encoder whose track failed part way through"""
+        if self.active is job:
+            self.active = None
+        try:
+            job.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        if job.proc.poll() is None:
+            job.proc.kill()
+        job.proc.wait()
+        rm_file(job.part_file)
+
+    def completed(self, wait=False):
+        """return (and forget) the jobs that have finished draining"""
+        if wait:
+            # every draining job holds a slot until it is done
+            num_slots = int(self.args.max_encoders)
+            for i in range(num_slots):
+                self.slots.acquire()
+            for i in range(num_slots):
+                self.slots.release()
+
+        with self.lock:
+            jobs = self.finished
+            self.finished = []
+        return sorted(jobs, key=lambda job: job.idx)
+
+    @property
+    def num_alive(self):
+        with self.lock:
+            num = len(self.draining)
+        return num + (1 if self.spare is not None else 0) + \
+            (1 if self.active is not None else 0)
+
+    def shutdown(self):
+        if self.spare is not None:
+            self.abort(self.spare)
+            self.spare = None
+        if self.dev_null is not None:
+            self.dev_null.close()
+            self.dev_null = None
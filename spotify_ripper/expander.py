@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from collections import deque
+import time
+import threading
+
+
+class ExpandJob(threading.Thread):
+    """resolves one link to its tracks on its own thread"""
+    tracks = None
+    playlist = None
+    album = None
+    error = None
+    elapsed = 0
+
+    def __init__(self, ripper, uri):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.ripper = ripper
+        self.uri = uri
+
+    def run(self):
+        start = time.time()
+        try:
+            self.tracks, self.playlist, self.album = \
+                self.ripper.resolve_link(self.uri)
+        except Exception as e:
+            self.error = e
+        self.elapsed = time.time() - start
+
+
+class LinkExpander(object):
+    """resolves a list (or stream) of links to tracks, loading up to
+    max_links playlists/albums/artists at a time while keeping the
+    tracks in the order of the links"""
+
+    def __init__(self, ripper, max_links):
+        self.ripper = ripper
+        self.max_links = max(1, int(max_links))
+        self.timings = []
+
+        # links that could not be loaded, the others are still ripped
+        self.failed_links = []
+
+    def expand(self, uris):
+        for job in self.jobs(uris):
+            # the tracks are ripped in the context of their playlist/album
+            if job.playlist is not None:
+                self.ripper.current_playlist = job.playlist
+            if job.album is not None:
+                self.ripper.current_album = job.album
+            for track in job.tracks:
+                yield track
+
+    def jobs(self, uris):
+        """the resolved links, in order"""
+        uris = iter(uris)
+        pending = deque()
+
+        def start_next():
+            for uri in uris:
+                uri = uri.strip()
+                # ignore blank lines (e.g. from a file)
+                if not uri:
+                    continue
+                job = ExpandJob(self.ripper, uri)
+                # a track link needs no loading, don't start a thread
+                if uri.startswith("spotify:track:"):
+                    job.run()
+                else:
+                    job.start()
+                pending.append(job)
+                return
+
+        for i in range(self.max_links):
+            start_next()
+
+        while len(pending) > 0:
+            job = pending.popleft()
+            if job.ident is not None:
+                job.join()
+            start_next()
+
+            if job.error is not None:
+                print(Fore.RED + "Could not load " + job.uri + Fore.RESET)
+                print(str(job.error))
+                self.failed_links.append(job.uri)
+                continue
+
+            # only report the links that had to be loaded
+            self.timings.append((job.uri, job.elapsed))
+            if job.playlist is not None or job.album is not None or \
+                    job.elapsed >= 1.0:
+                print(Fore.CYAN + "Loaded " + job.uri + " in " +
+                      ("%.2f" % job.elapsed) + "s" + Fore.RESET)
+            yield job
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from spotify_ripper.utils import *
+import os
+import io
+import json
+import time
+import threading
+from collections import OrderedDict
+
+# states in which a track needs no more work, failed tracks are tried
+# again on --resume
+done_states = ["tagged", "skipped"]
+
+
+class Journal(object):
+    """append-only log of the state of every track in a run, one JSON
+    record per line
+
+    A track goes through planned -> streaming -> encoded -> tagged (or
+    skipped/failed).  Records are fsynced in batches, so a crash loses at
+    most the last few state changes, which only means a track is ripped
+    again on --resume.  With --durability none they are only flushed.
+    """
+    sync_every = 32
+    sync_interval = 2.0
+
+    def __init__(self, args):
+        _settings_dir = settings_dir(args)
+        if not os.path.exists(_settings_dir):
+            os.makedirs(_settings_dir)
+        self.journal_file = os.path.join(_settings_dir, "journal.log")
+        self.lock = threading.Lock()
+        self.tracks = OrderedDict()
+
+        # tracks the resumed run finished, a track can appear more than
+        # once in a run so this only covers earlier runs
+        self.finished = set()
+        self.durable = args.durability != "none"
+
+        # a new run starts a new journal, --resume continues the old one
+        # and a --plan dry run leaves it alone
+        if args.plan is not None:
+            self.f = None
+        elif args.resume:
+            complete = self.replay()
+            self.finished = set(uri for uri, track in self.tracks.items()
+                                if track["state"] in done_states)
+            self.f = io.open(self.journal_file, "a", encoding="utf-8")
+            if not complete:
+                self.f.write("\n")
+        else:
+            self.f = io.open(self.journal_file, "w", encoding="utf-8")
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def replay(self):
+        """load the journal, returns False if the last line is cut short"""
+        if not os.path.exists(self.journal_file):
+            return True
+
+        line = "\n"
+        with io.open(self.journal_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line may be cut short by a crash
+                    continue
+                self.update(record)
+        return line.endswith("\n")
+
+    def update(self, record):
+        uri = record["uri"]
+        if uri not in self.tracks:
+            self.tracks[uri] = {}
+        self.tracks[uri].update(record)
+
+    def write(self, state, uri, **fields):
+        record = {"state": state, "uri": uri, "time": time.time()}
+        record.update(fields)
+        with self.lock:
+            if self.f is None:
+                return
+            self.update(record)
+            self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.unsynced += 1
+            if (self.unsynced >= self.sync_every or
+                    time.time() - self.last_sync >= self.sync_interval):
+                self.sync()
+
+    def sync(self):
+        self.f.flush()
+        if self.durable:
+            os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def plan(self, uri, idx, total, playlist, album):
+        if self.state(uri) is None:
+            self.write("planned", uri, idx=idx, total=total,
+                       playlist=playlist, album=album)
+
+    def state(self, uri):
+        track = self.tracks.get(uri)
+        return track["state"] if track is not None else None
+
+    def is_done(self, uri):
+        """whether the run being resumed finished the track"""
+        return uri in self.finished
+
+    def unfinished(self):
+        """tracks that were planned or in flight when the last run
+        stopped, in the order they were planned"""
+        return [track for track in self.tracks.values()
+                if track["state"] not in done_states]
+
+    def reset(self):
+        """start over with an empty journal, like a new run"""
+        with self.lock:
+            if self.f is None:
+                return
+            self.f.close()
+            self.f = io.open(self.journal_file, "w", encoding="utf-8")
+            self.tracks = OrderedDict()
+            self.finished = set()
+            self.unsynced = 0
+            self.last_sync = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.sync()
+                self.f.close()
+                self.f = None
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+import os
+import json
+import time
+import sqlite3
+import threading
+
+schema = """
+create table if not exists files (
+    source text not null,
+    uri text not null,
+    output_type text not null,
+    path text not null,
+    layout text not null,
+    size integer,
+    mtime real,
+    primary key (source, uri, output_type)
+);
+create index if not exists files_path on files (path);
+create table if not exists sources (
+    source text primary key,
+    tracks text not null,
+    synced real
+);
+"""
+
+
+def output_layout(args):
+    """what the path of an output depends on besides the track"""
+    return json.dumps([args.output_type, args.directory, args.format,
+                       args.flat, args.flat_with_index])
+
+
+class Library(object):
+    """index of --sync runs (library.db in the settings directory)
+
+    Keeps the files ripped for each track of a synced playlist/album (the
+    source) with their size and mtime, and the tracks each source had
+    when it was last synced, so a sync only plans the tracks added since
+    then without formatting paths or touching the file system.
+    """
+    db = None
+
+    # the source whose tracks are being ripped, files are recorded for it
+    source = None
+
+    def __init__(self, args):
+        self.lock = threading.Lock()
+        if not args.sync:
+            return
+        _settings_dir = settings_dir(args)
+        if not os.path.exists(_settings_dir):
+            os.makedirs(_settings_dir)
+        self.library_file = os.path.join(_settings_dir, "library.db")
+        self.db = sqlite3.connect(self.library_file,
+                                  check_same_thread=False)
+        self.db.executescript(schema)
+
+    def known(self, source, layouts):
+        """URIs of the tracks of source that have a file for every
+        output, ripped with the same directory and format"""
+        with self.lock:
+            rows = self.db.execute(
+                "select uri, layout from files where source = ?",
+                (source,)).fetchall()
+        uri_layouts = {}
+        for uri, layout in rows:
+            uri_layouts.setdefault(uri, set()).add(layout)
+        return set(uri for uri, _layouts in uri_layouts.items()
+                   if _layouts.issuperset(layouts))
+
+    def last_tracks(self, source):
+        """tracks of source when it was last synced"""
+        with self.lock:
+            row = self.db.execute(
+                "select tracks from sources where source = ?",
+                (source,)).fetchone()
+        return json.loads(row[0]) if row is not None else []
+
+    def add(self, uri, output_args, audio_file):
+        """record a file that has been ripped (or already existed) for
+        the current source"""
+        if self.db is None or self.source is None:
+            return
+        try:
+            stat = os.stat(audio_file)
+        except OSError:
+            return
+        with self.lock:
+            self.db.execute(
+                "insert or replace into files values "
+                "(?, ?, ?, ?, ?, ?, ?)",
+                (self.source, uri, output_args.output_type, audio_file,
+                 output_layout(output_args), stat.st_size, stat.st_mtime))
+
+    def remove(self, source, uris, prune=False):
+        """forget the tracks removed from source, deleting their files
+        with prune unless another source still has them"""
+        for uri in uris:
+            with self.lock:
+                paths = [row[0] for row in self.db.execute(
+                    "select path from files where source = ? and uri = ?",
+                    (source, uri))]
+                self.db.execute(
+                    "delete from files where source = ? and uri = ?",
+                    (source, uri))
+            print(Fore.YELLOW + "Removed from " + source + ": " + uri +
+                  Fore.RESET)
+            for path in paths:
+                with self.lock:
+                    shared = self.db.execute(
+                        "select count(*) from files where path = ?",
+                        (path,)).fetchone()[0] > 0
+                if prune and not shared:
+                    print(Fore.YELLOW + "Deleting " + path + Fore.RESET)
+                    rm_file(path)
+                else:
+                    print(Fore.CYAN + path + Fore.RESET)
+
+    def set_tracks(self, source, uris):
+        """remember the tracks of a source once it has been synced"""
+        with self.lock:
+            self.db.execute(
+                "insert or replace into sources values (?, ?, ?)",
+                (source, json.dumps(uris), time.time()))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
@@ -5,11 +5,15 @@ from __future__ import unicode_literals
 
 from colorama import init, Fore, AnsiToWin32
 from spotify_ripper.ripper import Ripper
+from spotify_ripper.daemon import DaemonRipper
+from spotify_ripper.spool import spool_dir
+from spotify_ripper.supervisor import Supervisor
 from spotify_ripper.utils import *
 import os
 import sys
 import codecs
 import time
+import copy
 import argparse
 import pkg_resources
 
@@ -17,7 +21,6 @@ if sys.version_info >= (3, 0):
     import configparser as ConfigParser
 else:
     import ConfigParser
-import schedule
 import signal
 
 
@@ -34,7 +37,7 @@ def load_config(args, defaults):
 
             to_array_options = [
                 "directory", "key", "user", "password", "log",
-                "genres", "format"]
+                "genres", "format", "tee", "spool_dir", "accounts"]
 
             # coerce boolean and none types
             for _key in config_items:
@@ -93,6 +96,51 @@ def patch_bug_in_mutagen():
         MP4Tags._MP4Tags__parse_cover, MP4Tags.__fixed_render_cover)
 
 
+def set_output_defaults(args):
+    """default quality settings for the codec in args.output_type"""
+    if args.output_type == "flac":
+        if args.comp == "10":
+            args.comp = "8"
+    elif args.output_type == "ogg":
+        if args.vbr == "0":
+            args.vbr = "10"
+    elif args.output_type == "opus":
+        if args.vbr == "0":
+            args.vbr = "320"
+    elif args.output_type == "aac":
+        if args.vbr == "0":
+            args.vbr = "500"
+    elif args.output_type == "m4a":
+        if args.vbr == "0":
+            args.vbr = "5"
+
+
+def tee_output_args(args, tee, quality_args):
+    """copy of args for an additional output given as TYPE[:FORMAT],
+    quality_args holds the quality settings before any codec defaults"""
+    tokens = tee.split(":", 1)
+    output_types = {
+        "mp3": "mp3", "wav": "wav", "pcm": "pcm", "flac": "flac",
+        "ogg": "ogg", "vorbis": "ogg", "opus": "opus", "aac": "aac",
+        "m4a": "m4a", "mp4": "m4a",
+    }
+    output_type = output_types.get(tokens[0].strip().lower())
+    if output_type is None:
+        print(Fore.RED + "spotify-ripper: error: unknown --tee output "
+              "type '" + tokens[0] + "'" + Fore.RESET)
+        sys.exit(1)
+
+    output_args = copy.copy(args)
+    output_args.output_type = output_type
+    output_args.vbr = quality_args.vbr
+    output_args.comp = quality_args.comp
+    if len(tokens) > 1 and tokens[1].strip():
+        output_args.format = [tokens[1]]
+    output_args.tee_outputs = []
+    set_output_defaults(output_args)
+    return output_args
+
+
 def main(prog_args=sys.argv[1:]):
     # in case we changed the location of the settings directory where the
     # config file lives, we need to parse this argument before we parse
@@ -108,8 +156,13 @@ def main(prog_args=sys.argv[1:]):
     # load config file, overwriting any defaults
     defaults = {
         "bitrate": "320",
+        "buffer_size": "8",
         "quality": "320",
         "comp": "10",
+        "durability": "batch",
+        "link_workers": "4",
+        "max_encoders": "2",
+        "progress_rate": "5",
         "vbr": "0",
     }
     defaults = load_config(args, defaults)
@@ -127,9 +180,13 @@ def main(prog_args=sys.argv[1:]):
     ''')
 
     # create group to prevent user from using both the -l and -u option
+    # (credentials come from the accounts file when using --accounts)
     is_user_set = defaults.get('user') is not None
     is_last_set = defaults.get('last') is True
-    if is_user_set or is_last_set:
+    is_accounts_set = defaults.get('accounts') is not None or any(
+        arg == "--accounts" or arg.startswith("--accounts=")
+        for arg in remaining_argv)
+    if is_user_set or is_last_set or is_accounts_set:
         if is_user_set and is_last_set:
             print("spotify-ripper: error: one of the arguments -u/--user "
                   "-l/--last is required")
@@ -145,6 +202,11 @@ def main(prog_args=sys.argv[1:]):
     parser.set_defaults(**defaults)
 
     prog_version = pkg_resources.require("spotify-ripper")[0].version
+    parser.add_argument(
+        '--accounts', nargs=1,
+        help='INI file with one section per Spotify account, starts a '
+             'worker process for each account that rips tracks from a '
+             'shared queue (see README)')
     parser.add_argument(
         '-a', '--ascii', action='store_true',
         help='Convert the file name and the metadata tags to ASCII '
@@ -158,6 +220,10 @@ def main(prog_args=sys.argv[1:]):
              'encoding [Default=utf-8]')
     parser.add_argument(
         '-b', '--bitrate', help='CBR bitrate [Default=320]')
+    parser.add_argument(
+        '--buffer-size',
+        help='Size in MB of the in-memory audio buffer between Spotify and '
+             'the encoder [Default=8]')
     parser.add_argument(
         '-c', '--cbr', action='store_true', help='CBR encoding [Default=VBR]')
     parser.add_argument(
@@ -169,9 +235,22 @@ def main(prog_args=sys.argv[1:]):
     parser.add_argument(
         '--cover-file', nargs=1,
         help='Save album cover image to file name (e.g "cover.jpg") [Default=embed]')
+    parser.add_argument(
+        '--cover-max-size', type=int,
+        help='Downscale cover images larger than COVER_MAX_SIZE x COVER_MAX_SIZE pixels before embedding them, requires Pillow [Default=original size]')
     parser.add_argument(
         '-d', '--directory', nargs=1,
         help='Base directory where ripped MP3s are saved [Default=cwd]')
+    parser.add_argument(
+        '--daemon', type=int, metavar='PORT',
+        help='Stay logged in and rip the jobs submitted to a local HTTP API '
+             'on 127.0.0.1:PORT, the URIs given are ripped as the first job '
+             '(see README)')
+    parser.add_argument(
+        '--durability', choices=['none', 'batch', 'strict'],
+        help='When ripped files are synced to disk: none=left to the OS, '
+             'batch=every few tracks in the background, strict=every file '
+             'before it is logged as done (see README) [Default=batch]')
     parser.add_argument(
         '--fail-log', nargs=1,
         help="Logs the list of track URIs that failed to rip"
@@ -207,6 +286,10 @@ def main(prog_args=sys.argv[1:]):
     group.add_argument(
         '-l', '--last', action='store_true',
         help='Use last login credentials')
+    parser.add_argument(
+        '--link-workers',
+        help='Number of playlists, albums and artists loaded concurrently '
+             '[Default=4]')
     parser.add_argument(
         '-L', '--log', nargs=1,
         help='Log in a log-friendly format to a file (use - to log to stdout)')
@@ -217,6 +300,17 @@ def main(prog_args=sys.argv[1:]):
         '--mp4', action='store_true',
         help='Rip songs to MP4/M4A format with Fraunhofer FDK AAC codec '
              'instead of MP3')
+    parser.add_argument(
+        '--max-encoders',
+        help='Maximum number of encoders finishing tracks in the background '
+             'while the next track streams [Default=2]')
+    parser.add_argument(
+        '--metrics-file', nargs=1,
+        help='Write Prometheus metrics to this file every 10 seconds, for '
+             "node_exporter's textfile collector")
+    parser.add_argument(
+        '--metrics-port', type=int,
+        help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
     parser.add_argument(
         '--normalize', action='store_true',
         help='Normalize volume levels of tracks')
@@ -226,17 +320,77 @@ def main(prog_args=sys.argv[1:]):
     encoding_group.add_argument(
         '--opus', action='store_true',
         help='Rip songs to Opus encoding instead of MP3')
+    parser.add_argument(
+        '--plan', nargs=1,
+        help='Dry run: write a manifest of what would be ripped (JSON, or '
+             'CSV if the file name ends in .csv) without streaming any audio')
+    parser.add_argument(
+        '--progress-rate',
+        help='Times per second the progress bars are redrawn, 0 hides '
+             'them (they are never shown if the output is not a '
+             'terminal) [Default=5]')
     parser.add_argument(
         '-q', '--vbr',
         help='VBR quality setting or target bitrate for Opus [Default=0]')
     parser.add_argument(
         '-Q', '--quality', choices=['160', '320', '96'],
         help='Spotify stream bitrate preference [Default=320]')
+    parser.add_argument(
+        '--spool', action='store_true',
+        help='Only spool the raw PCM to disk while streaming and encode '
+             'spooled tracks in a pool of worker processes')
+    parser.add_argument(
+        '--spool-compress', action='store_true',
+        help='Compress spooled PCM with gzip [Default=uncompressed]')
+    parser.add_argument(
+        '--spool-dir', nargs=1,
+        help='Directory for spooled tracks [Default=Settings Directory/spool]')
+    parser.add_argument(
+        '--spool-workers',
+        help='Number of encoder processes in spool mode '
+             '[Default=number of CPUs]')
+    parser.add_argument(
+        '--stream', action='store_true',
+        help='Resolve URIs and plan tracks in small windows while ripping, '
+             'so ripping starts right away and memory use stays bounded '
+             'for huge URI files and collections')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Resume the last run from the journal in the settings '
+             'directory, ripping only the tracks it did not finish')
     parser.add_argument(
         '-s', '--strip-colors', action='store_true',
         help='Strip coloring from output [Default=colors]')
+    parser.add_argument(
+        '--sync', action='store_true',
+        help='Only rip the tracks added to each playlist/album since it '
+             'was last synced, using an index of the ripped files in the '
+             'settings directory (see README)')
+    parser.add_argument(
+        '--sync-prune', action='store_true',
+        help='Delete the files of tracks removed from a synced '
+             'playlist/album (implies --sync) [Default=report only]')
+    parser.add_argument(
+        '--tee', action='append',
+        help='Also encode each track to this output type (e.g. "flac" or '
+             '"mp3:mp3/{artist} - {track_name}.{ext}") while streaming, '
+             'optionally with its own format string, can be used '
+             'multiple times')
+    parser.add_argument(
+        '--trace', nargs=1,
+        help='Append one JSON record per track with the start and end '
+             'times of each stage (loading, streaming, encoding, tagging) '
+             'and the frames/bytes written to this file')
     parser.add_argument(
         '-V', '--version', action='version', version=prog_version)
+    parser.add_argument(
+        '--verify', action='store_true',
+        help='Check files that already exist (duration and tags) before '
+             'skipping them, missing or invalid files are ripped again')
+    parser.add_argument(
+        '--verify-report', nargs=1,
+        help='Write the result of every file checked by --verify to this '
+             'JSON file (implies --verify)')
     encoding_group.add_argument(
         '--wav', action='store_true',
         help='Rip songs to uncompressed WAV file instead of MP3')
@@ -252,11 +406,15 @@ def main(prog_args=sys.argv[1:]):
         help='Exclude albums that an artist \'appears on\' when passing '
              'a Spotify artist URI')
     parser.add_argument(
-        'uri', nargs="+",
-        help='One or more Spotify URI(s) (either URI, a file of URIs or a '
-             'search query)')
+        'uri', nargs="*",
+        help='One or more Spotify URI(s) (either URI, a file of URIs, "-" to '
+             'read URIs from stdin or a search query)')
     args = parser.parse_args(remaining_argv)
 
+    # URIs are optional only when resuming or waiting for jobs
+    if len(args.uri) == 0 and not args.resume and args.daemon is None:
+        parser.error("the following arguments are required: uri")
+
     # kind of a hack to get colorama stripping to work when outputting
     # to a file instead of stdout.  Taken from initialise.py in colorama
     def wrap_stream(stream, convert, strip, autoreset, wrap):
@@ -281,32 +439,82 @@ def main(prog_args=sys.argv[1:]):
     if args.ascii_path_only is True:
         args.ascii = True
 
+    if args.verify_report is not None:
+        args.verify = True
+
+    if args.sync_prune:
+        args.sync = True
+
+    # an encoder needs a slot to finish a track
+    try:
+        max_encoders = int(args.max_encoders)
+    except ValueError:
+        max_encoders = 0
+    if max_encoders < 1:
+        print(Fore.RED + "spotify-ripper: error: --max-encoders must be "
+              "a number of at least 1" + Fore.RESET)
+        sys.exit(1)
+
+    # track indexes differ between workers
+    if args.accounts is not None and args.remove_from_playlist:
+        print(Fore.RED + "spotify-ripper: error: -r/--remove-from-playlist "
+              "can't be used with --accounts" + Fore.RESET)
+        sys.exit(1)
+
+    if args.plan is not None and (args.accounts is not None or
+                                  args.resume):
+        print(Fore.RED + "spotify-ripper: error: --plan can't be used "
+              "with --accounts or --resume" + Fore.RESET)
+        sys.exit(1)
+
+    # every worker has its own journal
+    if args.accounts is not None and args.resume:
+        print(Fore.RED + "spotify-ripper: error: --resume can't be used "
+              "with --accounts" + Fore.RESET)
+        sys.exit(1)
+
+    if args.sync and (args.accounts is not None or args.plan is not None or
+                      args.stream):
+        print(Fore.RED + "spotify-ripper: error: --sync can't be used "
+              "with --accounts, --plan or --stream" + Fore.RESET)
+        sys.exit(1)
+
+    # a search query has no playlist/album to keep in sync
+    if args.sync:
+        for uri in args.uri:
+            if not (uri.startswith("spotify:") or uri == "-" or
+                    os.path.exists(uri)):
+                print(Fore.RED + "spotify-ripper: error: --sync only "
+                      "takes Spotify URIs or files of them, not '" + uri +
+                      "'" + Fore.RESET)
+                sys.exit(1)
+
+    if args.daemon is not None and (args.accounts is not None or
+                                    args.plan is not None):
+        print(Fore.RED + "spotify-ripper: error: --daemon can't be used "
+              "with --accounts or --plan" + Fore.RESET)
+        sys.exit(1)
+
+    # quality settings before the codec defaults are applied
+    quality_args = copy.copy(args)
+
     if args.wav:
         args.output_type = "wav"
     elif args.pcm:
         args.output_type = "pcm"
     elif args.flac:
         args.output_type = "flac"
-        if args.comp == "10":
-            args.comp = "8"
     elif args.vorbis:
         args.output_type = "ogg"
-        if args.vbr == "0":
-            args.vbr = "10"
     elif args.opus:
         args.output_type = "opus"
-        if args.vbr == "0":
-            args.vbr = "320"
     elif args.aac:
         args.output_type = "aac"
-        if args.vbr == "0":
-            args.vbr = "500"
     elif args.mp4:
         args.output_type = "m4a"
-        if args.vbr == "0":
-            args.vbr = "5"
     else:
         args.output_type = "mp3"
+    set_output_defaults(args)
 
     # check that encoder tool is available
     encoders = {
@@ -317,17 +525,20 @@ def main(prog_args=sys.argv[1:]):
         "mp3": ("lame", "lame"),
         "m4a": ("fdkaac", "fdk-aac-encoder"),
     }
-    if args.output_type in encoders.keys():
-        encoder = encoders[args.output_type][0]
-        if which(encoder) is None:
-            print(Fore.RED + "Missing dependency '" + encoder +
-                  "'.  Please install and add to path..." + Fore.RESET)
-            # assumes OS X or Ubuntu/Debian
-            command_help = ("brew install " if sys.platform == "darwin"
-                            else "sudo apt-get install ")
-            print("...try " + Fore.YELLOW + command_help +
-                  encoders[args.output_type][1] + Fore.RESET)
-            sys.exit(1)
+    def check_encoder(output_type):
+        if output_type in encoders.keys():
+            encoder = encoders[output_type][0]
+            if which(encoder) is None:
+                print(Fore.RED + "Missing dependency '" + encoder +
+                      "'.  Please install and add to path..." + Fore.RESET)
+                # assumes OS X or Ubuntu/Debian
+                command_help = ("brew install " if sys.platform == "darwin"
+                                else "sudo apt-get install ")
+                print("...try " + Fore.YELLOW + command_help +
+                      encoders[output_type][1] + Fore.RESET)
+                sys.exit(1)
+
+    check_encoder(args.output_type)
 
     # format string
     if args.flat:
@@ -337,10 +548,26 @@ def main(prog_args=sys.argv[1:]):
     elif args.format is None:
         args.format = ["{album_artist}/{album}/{artist} - {track_name}.{ext}"]
 
+    # additional outputs encoded from the same stream
+    args.tee_outputs = [tee_output_args(args, tee, quality_args)
+                        for tee in (args.tee or [])]
+    for output_args in args.tee_outputs:
+        check_encoder(output_args.output_type)
+
+    # two outputs with the same type and format would write the same files
+    outputs = set([(args.output_type, args.format[0])])
+    for tee, output_args in zip(args.tee or [], args.tee_outputs):
+        output = (output_args.output_type, output_args.format[0])
+        if output in outputs:
+            print(Fore.RED + "spotify-ripper: error: --tee output '" + tee +
+                  "' writes the same files as another output" + Fore.RESET)
+            sys.exit(1)
+        outputs.add(output)
+
     # print some settings
     print(Fore.GREEN + "Spotify Ripper - v" + prog_version + Fore.RESET)
 
-    def encoding_output_str():
+    def encoding_output_str(args):
         if args.output_type == "wav":
             return "WAV, Stereo 16bit 44100Hz"
         elif args.output_type == "pcm":
@@ -367,7 +594,11 @@ def main(prog_args=sys.argv[1:]):
                 return codec + ", VBR " + args.vbr
 
     print(Fore.YELLOW + "  Encoding output:\t" +
-          Fore.RESET + encoding_output_str())
+          Fore.RESET + encoding_output_str(args))
+    for output_args in args.tee_outputs:
+        print(Fore.YELLOW + "  Tee output:\t\t" + Fore.RESET +
+              encoding_output_str(output_args) + " (" +
+              output_args.format[0] + ")")
     print(Fore.YELLOW + "  Spotify bitrate:\t" +
           Fore.RESET + args.quality + " kbps")
 
@@ -386,15 +617,44 @@ def main(prog_args=sys.argv[1:]):
     print(Fore.YELLOW + "  Settings directory:\t" + Fore.RESET +
           settings_dir(args))
 
+    if args.spool:
+        print(Fore.YELLOW + "  Spool directory:\t" + Fore.RESET +
+              spool_dir(args))
     print(Fore.YELLOW + "  Format String:\t" + Fore.RESET + args.format[0])
     print(Fore.YELLOW + "  Overwrite files:\t" +
           Fore.RESET + ("Yes" if args.overwrite else "No"))
 
     # patch a bug when Python 3/MP4
-    if sys.version_info >= (3, 0) and args.output_type == "m4a":
+    if sys.version_info >= (3, 0) and "m4a" in [
+            output_args.output_type for output_args in
+            [args] + args.tee_outputs]:
         patch_bug_in_mutagen()
 
-    ripper = Ripper(args)
+    if args.accounts is not None:
+        print(Fore.YELLOW + "  Accounts file:\t" + Fore.RESET +
+              norm_path(args.accounts[0]))
+        supervisor = Supervisor(args)
+        try:
+            supervisor.run()
+        except KeyboardInterrupt:
+            print("\n" + Fore.RED + "Aborting..." + Fore.RESET)
+            supervisor.abort()
+            sys.exit(1)
+        return
+
+    if args.daemon is not None:
+        print(Fore.YELLOW + "  Job API:\t\t" + Fore.RESET +
+              "http://127.0.0.1:" + str(args.daemon) + "/jobs")
+        ripper = DaemonRipper(
+            args, lambda _args, tee: tee_output_args(_args, tee,
+                                                      quality_args))
+
+        # stopping the daemon aborts the current job like Ctrl-C
+        def terminate(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, terminate)
+    else:
+        ripper = Ripper(args)
     ripper.start()
 
     # try to listen for terminal resize events
@@ -406,7 +666,6 @@ def main(prog_args=sys.argv[1:]):
     # wait for ripping thread to finish
     try:
         while not ripper.finished:
-            schedule.run_pending()
             time.sleep(0.1)
     except (KeyboardInterrupt, Exception) as e:
         if not isinstance(e, KeyboardInterrupt):
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+import os
+import io
+import sys
+import csv
+import json
+
+columns = ["idx", "uri", "available", "action", "files", "duration",
+           "size", "collision"]
+
+
+def plan_action(args, plan):
+    """what a real run would do with the track of a plan"""
+    if plan.available is None:
+        return "error"
+    elif not plan.available:
+        return "unavailable"
+    elif plan.skip:
+        return "skip"
+    elif args.overwrite and any(os.path.exists(audio_file)
+                                for audio_file in plan.audio_files):
+        return "overwrite"
+    return "rip"
+
+
+class Manifest(object):
+    """rows of a --plan dry run, one per track, with the tracks that
+    would be ripped to the same file flagged as collisions"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rows = []
+        self.paths = {}
+
+    def add(self, plan):
+        row = {
+            "idx": plan.idx,
+            "uri": plan.uri,
+            "available": plan.available,
+            "action": plan_action(self.args, plan),
+            "files": plan.audio_files or [],
+            "duration": plan.duration,
+            "size": int(plan.size),
+            "collision": False,
+        }
+
+        # two different tracks that map to the same file would
+        # overwrite (or skip) each other
+        for audio_file in row["files"]:
+            other = self.paths.get(audio_file)
+            if other is None:
+                self.paths[audio_file] = row
+            elif other["uri"] != row["uri"]:
+                other["collision"] = True
+                row["collision"] = True
+        self.rows.append(row)
+
+    def write(self, manifest_file):
+        if manifest_file.lower().endswith(".csv"):
+            self.write_csv(manifest_file)
+        else:
+            with io.open(manifest_file, "w", encoding="utf-8") as f:
+                f.write(json.dumps(self.rows, ensure_ascii=False, indent=1))
+
+    def write_csv(self, manifest_file):
+        def encode(values):
+            # the python 2 csv module only writes bytes
+            if sys.version_info < (3, 0):
+                return [value.encode("utf-8") for value in values]
+            return values
+
+        def csv_row(row):
+            return encode([";".join(row[column]) if column == "files"
+                           else "%s" % row[column] for column in columns])
+
+        if sys.version_info >= (3, 0):
+            f = io.open(manifest_file, "w", encoding="utf-8", newline="")
+        else:
+            f = open(manifest_file, "wb")
+        with f:
+            writer = csv.writer(f)
+            writer.writerow(encode(columns))
+            for row in self.rows:
+                writer.writerow(csv_row(row))
+
+    def print_summary(self):
+        counts = {}
+        for row in self.rows:
+            counts[row["action"]] = counts.get(row["action"], 0) + 1
+        to_rip = [row for row in self.rows
+                  if row["action"] in ("rip", "overwrite")]
+
+        print(Fore.GREEN + "\nPlan Summary\n" + ("-" * 79) + Fore.RESET)
+        print(str(len(self.rows)) + " tracks: " + ", ".join(
+            [str(counts[action]) + " " + action
+             for action in sorted(counts.keys())]))
+        print("Download Size: " + format_size(
+            sum(row["size"] for row in to_rip)))
+        print("Duration: " + format_time(
+            sum(row["duration"] for row in to_rip) / 1000.0))
+        collisions = sum(1 for row in self.rows if row["collision"])
+        if collisions > 0:
+            print(Fore.YELLOW + str(collisions) + " tracks map to the "
+                  "same file as another track" + Fore.RESET)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+import os
+import io
+import sys
+import time
+import threading
+
+if sys.version_info >= (3, 0):
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# name: (type, help)
+metric_info = {
+    "spotify_ripper_tracks_total":
+        ("counter", "Tracks finished, by result"),
+    "spotify_ripper_pcm_frames_total":
+        ("counter", "PCM frames delivered by Spotify"),
+    "spotify_ripper_pcm_frames_per_second":
+        ("gauge", "PCM frames delivered per second since the last scrape"),
+    "spotify_ripper_realtime_factor":
+        ("gauge", "Audio seconds delivered per wall-clock second"),
+    "spotify_ripper_bytes_written_total":
+        ("counter", "Bytes of PCM written, by output type"),
+    "spotify_ripper_encoders_alive":
+        ("gauge", "Encoder processes alive (spare and draining)"),
+    "spotify_ripper_buffer_fill_ratio":
+        ("gauge", "Fill ratio of the audio ring buffer"),
+    "spotify_ripper_buffer_overflows_total":
+        ("counter", "Deliveries only partly accepted by the ring buffer"),
+    "spotify_ripper_web_api_requests_total":
+        ("counter", "Web API lookups, by cache result"),
+    "spotify_ripper_web_api_request_seconds":
+        ("summary", "Time spent in Web API requests that hit the network"),
+    "spotify_ripper_tagging_seconds":
+        ("summary", "Time spent in set_metadata_tags"),
+    "spotify_ripper_last_delivery_timestamp_seconds":
+        ("gauge", "Time of the last audio delivery, stalls show up here"),
+    "spotify_ripper_planned_tracks":
+        ("gauge", "Tracks planned for the current URI"),
+    "spotify_ripper_planned_duration_seconds":
+        ("gauge", "Audio duration of the tracks planned to be ripped"),
+    "spotify_ripper_ripped_duration_seconds":
+        ("gauge", "Audio duration of the tracks ripped so far"),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        [name + '="' + value.replace('"', '\\"') + '"'
+         for name, value in labels]) + "}"
+
+
+class Metrics(object):
+    """counters and gauges of a run, rendered in Prometheus' text
+    exposition format"""
+    last_frames = 0
+    last_time = None
+    fps = 0.0
+    last_delivery = 0
+
+    # labels of every metric, e.g. the worker in --accounts mode
+    labels = ()
+
+    def __init__(self, ripper):
+        self.ripper = ripper
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        self.inc(name + "_sum", seconds, **labels)
+        self.inc(name + "_count", 1, **labels)
+
+    def get(self, name, **labels):
+        with self.lock:
+            return self.values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def collect(self):
+        """read the gauges from the ripper and progress"""
+        ripper = self.ripper
+        progress = ripper.progress
+
+        # rate over at least a second, the HTTP endpoint and the
+        # textfile may be read at the same time
+        frames = self.get("spotify_ripper_pcm_frames_total")
+        now = time.time()
+        with self.lock:
+            if self.last_time is None:
+                self.last_frames = frames
+                self.last_time = now
+            elif now - self.last_time >= 1.0:
+                self.fps = (frames - self.last_frames) / \
+                    (now - self.last_time)
+                self.last_frames = frames
+                self.last_time = now
+            fps = self.fps
+
+        gauges = {
+            "spotify_ripper_pcm_frames_per_second": fps,
+            "spotify_ripper_realtime_factor": fps / 44100.0,
+            "spotify_ripper_encoders_alive": sum(
+                output.encoders.num_alive for output in ripper.outputs),
+            "spotify_ripper_last_delivery_timestamp_seconds":
+                self.last_delivery,
+            "spotify_ripper_buffer_fill_ratio":
+                ripper.ring_buffer.fill_ratio,
+            "spotify_ripper_planned_tracks": progress.total_tracks,
+            "spotify_ripper_planned_duration_seconds":
+                progress.total_duration / 1000.0,
+            "spotify_ripper_ripped_duration_seconds":
+                progress.total_position / 1000.0,
+        }
+        values = [((name, ()), value) for name, value in gauges.items()]
+
+        # counters kept by other parts of the ripper
+        web_api = ripper.web_api
+        for result in ["hits", "misses", "revalidated"]:
+            values.append((("spotify_ripper_web_api_requests_total",
+                            (("result", result),)),
+                           getattr(web_api, result)))
+        values.append((("spotify_ripper_web_api_request_seconds_sum", ()),
+                       web_api.request_time))
+        values.append((("spotify_ripper_web_api_request_seconds_count", ()),
+                       web_api.num_requests))
+
+        with self.lock:
+            values += list(self.values.items())
+        return values
+
+    def render(self):
+        lines = []
+        by_name = {}
+        for (name, labels), value in self.collect():
+            base_name = name
+            for suffix in ["_sum", "_count"]:
+                if name.endswith(suffix) and \
+                        name[:-len(suffix)] in metric_info:
+                    base_name = name[:-len(suffix)]
+            by_name.setdefault(base_name, []).append((name, labels, value))
+
+        for base_name in sorted(by_name.keys()):
+            metric_type, metric_help = metric_info[base_name]
+            lines.append("# HELP " + base_name + " " + metric_help)
+            lines.append("# TYPE " + base_name + " " + metric_type)
+            for name, labels, value in sorted(by_name[base_name]):
+                lines.append(name + format_labels(self.labels + labels) +
+                             " " + repr(float(value)))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep the access log out of the ripper's output
+        pass
+
+
+class MetricsExporter(threading.Thread):
+    """serves the metrics on a local HTTP port and/or writes them to a
+    file for node_exporter's textfile collector"""
+    interval = 10
+    server = None
+
+    def __init__(self, metrics, port=None, metrics_file=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.metrics = metrics
+        self.metrics_file = metrics_file
+        self.stopped = threading.Event()
+
+        if port is not None:
+            self.server = HTTPServer(("127.0.0.1", port), MetricsHandler)
+            self.server.metrics = metrics
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            print(Fore.GREEN + "Serving metrics on http://127.0.0.1:" +
+                  str(port) + "/metrics" + Fore.RESET)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write_file()
+
+    def write_file(self):
+        if self.metrics_file is None:
+            return
+        tmp_file = self.metrics_file + ".tmp"
+        try:
+            with io.open(tmp_file, "w", encoding="utf-8") as f:
+                f.write(self.metrics.render())
+            os.rename(tmp_file, self.metrics_file)
+        except (IOError, OSError) as e:
+            print(Fore.YELLOW + "Warning: could not write metrics to " +
+                  self.metrics_file + Fore.RESET)
+            print(str(e))
+
+    def stop(self):
+        self.stopped.set()
+        self.write_file()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import io
+import struct
+
+# bytes of raw PCM per millisecond (stereo, 16 bit, 44.1 kHz)
+PCM_BYTES_PER_MS = 44100 * 4 / 1000.0
+
+WAV_HEADER_SIZE = 44
+
+
+def wav_header(data_size):
+    """RIFF/WAVE header of data_size bytes of 44.1 kHz 16 bit stereo"""
+    return struct.pack(str("<4sI4s4sIHHIIHH4sI"),
+                       b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16,
+                       1, 2, 44100, 44100 * 4, 4, 16, b"data", data_size)
+
+
+def preallocate(fd, size):
+    """reserve size bytes on disk, so the file isn't fragmented by the
+    small writes of other outputs"""
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (IOError, OSError):
+        # not supported by every file system
+        pass
+
+
+class PCMFile(object):
+    """raw PCM (or WAV) file written in large blocks
+
+    Deliveries are collected in a block_size buffer, so the file is
+    written in aligned blocks instead of once per delivery. The file is
+    preallocated for the expected size and truncated to what was written
+    when it is closed, a WAV header is written once at that point.
+    """
+    block_size = 1024 * 1024
+    f = None
+
+    def __init__(self, path, expected_size=0, wav=False):
+        self.wav = wav
+        self.header_size = WAV_HEADER_SIZE if wav else 0
+        self.size = 0
+        self.buf = bytearray(self.block_size)
+        self.fill = 0
+
+        self.f = io.open(path, "wb", buffering=0)
+        preallocate(self.f.fileno(), self.header_size + int(expected_size))
+
+        # the sizes in the header are filled in by close
+        if wav:
+            self.buf[:WAV_HEADER_SIZE] = wav_header(0)
+            self.fill = WAV_HEADER_SIZE
+
+    def write(self, frame_bytes):
+        n = len(frame_bytes)
+        self.size += n
+        pos = 0
+        while pos < n:
+            count = min(n - pos, self.block_size - self.fill)
+            self.buf[self.fill:self.fill + count] = \
+                frame_bytes[pos:pos + count]
+            self.fill += count
+            pos += count
+            if self.fill == self.block_size:
+                self.write_fully(self.buf)
+                self.fill = 0
+
+    def write_fully(self, data):
+        """the file is unbuffered, a write can be short"""
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[self.f.write(view):]
+
+    def close(self):
+        """write what is buffered and the header, and cut off the space
+        preallocated past the end of the audio"""
+        if self.f is None:
+            return
+        try:
+            if self.fill > 0:
+                self.write_fully(memoryview(self.buf)[:self.fill])
+                self.fill = 0
+            if self.wav:
+                self.f.seek(0)
+                self.write_fully(wav_header(self.size))
+            self.f.truncate(self.header_size + self.size)
+        finally:
+            self.f.close()
+            self.f = None
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from spotify_ripper.utils import *
+from collections import namedtuple
+import os
+import time
+import spotify
+
+# everything the progress totals and the rip loop need to know about a
+# track, available/audio_files are None if the track could not be loaded
+TrackPlan = namedtuple("TrackPlan", [
+    "idx", "track", "uri", "available", "duration", "audio_files", "skip",
+    "size"])
+
+
+def wait_loaded(tracks, timeout):
+    """wait until libspotify has loaded all tracks (or timeout), their
+    metadata is fetched concurrently once the tracks are created"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if all(track.is_loaded for track in tracks):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class Planner(object):
+    """loads and inspects every track of a list once, up front
+
+    Planning has no side effects: paths are formatted without creating
+    any directories, which is left to the rip loop.
+    """
+    batch_size = 100
+    load_timeout = 10
+
+    def __init__(self, args, ripper):
+        self.args = args
+        self.ripper = ripper
+
+    def plan(self, tracks, first_idx=0, idxs=None):
+        """plan a list of tracks in batches, idxs are the indexes of the
+        tracks if they don't follow each other"""
+        if idxs is None:
+            idxs = range(first_idx, first_idx + len(tracks))
+        plans = []
+        for start in range(0, len(tracks), self.batch_size):
+            batch = tracks[start:start + self.batch_size]
+            load_start = monotonic()
+            wait_loaded(batch, self.load_timeout)
+            load_end = monotonic()
+            batch_plans = []
+            for idx, track in zip(idxs[start:start + self.batch_size],
+                                  batch):
+                self.ripper.tracer.track(idx, track.link.uri).add(
+                    "batch_load", load_start, load_end)
+                batch_plans.append(self.plan_one(idx, track, verify=False))
+
+            # --verify checks the existing files of a whole batch at once
+            plans += self.ripper.verifier.verify(batch_plans)
+        return plans
+
+    def plan_one(self, idx, track, verify=True):
+        uri = track.link.uri
+        trace = self.ripper.tracer.track(idx, uri)
+        try:
+            with trace.stage("load"):
+                track.load()
+            if track.availability != 1:
+                return TrackPlan(idx, track, uri, False, track.duration,
+                                 None, False, 0)
+            with trace.stage("format_track_path"):
+                audio_files = self.ripper.format_track_paths(
+                    idx, track, create_dirs=False)
+        except spotify.Error as e:
+            # the rip loop tries again and logs the failure
+            return TrackPlan(idx, track, uri, None, 0, None, False, 0)
+
+        skip = not self.args.overwrite and all(
+            os.path.exists(audio_file) for audio_file in audio_files)
+        size = 0 if skip else calc_file_size(self.args, track)
+        plan = TrackPlan(idx, track, uri, True, track.duration, audio_files,
+                         skip, size)
+        return self.ripper.verifier.verify([plan])[0] if verify else plan
@@ -7,8 +7,7 @@ from spotify_ripper.utils import *
 import os
 import sys
 import time
-import schedule
-import spotify
+import threading
 
 try:
     from fcntl import ioctl
@@ -18,6 +17,36 @@ except ImportError:
     pass
 
 
+def is_tty(stream):
+    isatty = getattr(stream, "isatty", None)
+    return isatty is not None and isatty()
+
+
+class ProgressRenderer(threading.Thread):
+    """redraws the progress bars at a fixed rate, so delivering audio
+    only has to count the frames"""
+    eta_interval = 2.0
+
+    def __init__(self, progress, rate):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.progress = progress
+        self.interval = 1.0 / rate
+        self.stopped = threading.Event()
+
+    def run(self):
+        last_eta = monotonic()
+        while not self.stopped.wait(self.interval):
+            now = monotonic()
+            update_eta = now - last_eta >= self.eta_interval
+            if update_eta:
+                last_eta = now
+            self.progress.render(update_eta)
+
+    def stop(self):
+        self.stopped.set()
+
+
 class Progress(object):
     # song progress
     current_track = None
@@ -40,36 +69,36 @@ class Progress(object):
     # flag for moving cursor
     move_cursor = False
     term_width = 120
+    renderer = None
 
     def __init__(self, args, ripper):
         self.args = args
         self.ripper = ripper
-        if not self.args.has_log:
-            schedule.every(2).seconds.do(self.eta_calc)
+        self.lock = threading.Lock()
 
-    def calc_total(self, tracks):
-        self.total_tracks = len(tracks)
-        if self.total_tracks <= 1:
-            return
+        # there is nothing to redraw in a log file or a pipe
+        self.rate = float(args.progress_rate)
+        self.enabled = not args.has_log and self.rate > 0 and \
+            is_tty(sys.stdout)
 
-        self.show_total = True
+    def calc_total(self, plans):
+        self.show_total = False
+        self.total_tracks = 0
+        self.total_position = 0
         self.total_duration = 0
         self.total_size = 0
+        self.add_total(plans)
+
+    def add_total(self, plans):
+        """refine the totals as more tracks are streamed in"""
+        self.total_tracks += len(plans)
+        self.show_total = self.total_tracks > 1
 
-        # some duplicate work here, maybe cache this info beforehand?
-        for idx, track in enumerate(tracks):
-            try:
-                track.load()
-                if track.availability != 1:
-                    continue
-                audio_file = self.ripper.format_track_path(idx, track)
-                if not self.args.overwrite and os.path.exists(audio_file):
-                    continue
-                self.total_duration += track.duration
-                file_size = calc_file_size(self.args, track)
-                self.total_size += file_size
-            except spotify.Error as e:
+        for plan in plans:
+            if not plan.available or plan.skip:
                 continue
+            self.total_duration += plan.duration
+            self.total_size += plan.size
 
     def eta_calc(self):
         # exponential moving average
@@ -126,23 +155,40 @@ class Progress(object):
             self.term_width = int(os.environ.get('COLUMNS', 120)) - 1
 
     def prepare_track(self, track):
-        self.song_position = 0
-        self.song_duration = track.duration
-        self.move_cursor = False
-        self.current_track = track
+        # started with the first track rather than in __init__, the
+        # ripper forks its process pools after creating the progress
+        if self.enabled and self.renderer is None:
+            self.renderer = ProgressRenderer(self, self.rate)
+            self.renderer.start()
+
+        with self.lock:
+            self.song_position = 0
+            self.song_duration = track.duration
+            self.move_cursor = False
+            self.current_track = track
 
     def end_track(self):
-        self.end_progress()
-        self.stat_prev = None
-        self.song_eta = None
-        self.total_eta = None
-        self.total_position += self.current_track.duration
-        self.current_track = None
-
-    def update_progress(self, num_frames, audio_format):
-        if self.args.has_log:
-            return
-
+        with self.lock:
+            self.end_progress()
+            self.stat_prev = None
+            self.song_eta = None
+            self.total_eta = None
+            self.total_position += self.current_track.duration
+            self.current_track = None
+
+    def add_frames(self, num_frames, sample_rate):
+        """called for every audio delivery, the bars are drawn by the
+        renderer"""
+        self.song_position += (num_frames * 1000.0) / sample_rate
+
+    def render(self, update_eta=False):
+        with self.lock:
+            if self.current_track is not None and self.ripper.ripping:
+                if update_eta:
+                    self.eta_calc()
+                self.draw()
+
+    def draw(self):
         # log output until we run out of space on this line
         def output_what_fits(init, output_strings):
             print_str(self.args, init)
@@ -164,8 +210,6 @@ class Progress(object):
             prog_width = 40
 
         # song position/progress calculations
-        if num_frames > 0:
-            self.song_position += (num_frames * 1000) / audio_format.sample_rate
         pos_seconds = self.song_position // 1000
         dur_seconds = self.song_duration // 1000
         pct = int(self.song_position * 100 // self.song_duration)
@@ -218,7 +262,13 @@ class Progress(object):
             output_what_fits("\n\033[2K", output_strings)
 
     def end_progress(self):
+        if not self.enabled:
+            return
         self.song_position = self.song_duration
         self.eta_calc()
-        self.update_progress(0, None)
+        self.draw()
         print_str(self.args, "\n")
+
+    def stop(self):
+        if self.renderer is not None:
+            self.renderer.stop()
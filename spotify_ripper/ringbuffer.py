@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+import threading
+
+
+class RingBuffer(object):
+    """bounded byte buffer between libspotify's music delivery callback
+    and the thread that writes audio to the encoder or disk"""
+
+    # backpressure counters
+    overflows = 0
+    backpressure_frames = 0
+    high_water = 0
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = bytearray(capacity)
+        self.read_pos = 0
+        self.size = 0
+        self.in_flight = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    @property
+    def fill_level(self):
+        """number of bytes waiting to be written"""
+        return self.size
+
+    @property
+    def fill_ratio(self):
+        return float(self.size) / self.capacity
+
+    def write_frames(self, data, frame_size, num_frames):
+        """copy as many whole frames as fit into the buffer without
+        blocking and return the number of frames accepted"""
+        with self.cond:
+            free_frames = (self.capacity - self.size) // frame_size
+            accepted = min(num_frames, free_frames)
+            if accepted < num_frames:
+                self.overflows += 1
+                self.backpressure_frames += num_frames - accepted
+            if accepted <= 0:
+                return 0
+
+            n = accepted * frame_size
+            write_pos = (self.read_pos + self.size) % self.capacity
+            first = min(n, self.capacity - write_pos)
+            self.buf[write_pos:write_pos + first] = data[:first]
+            if first < n:
+                self.buf[:n - first] = data[first:n]
+
+            self.size += n
+            if self.size > self.high_water:
+                self.high_water = self.size
+            self.cond.notify_all()
+            return accepted
+
+    def read(self, max_size, timeout=None):
+        """wait for data and return up to max_size bytes (empty on timeout
+        or close), the caller must call release() once it is written"""
+        with self.cond:
+            if self.size == 0 and not self.closed:
+                self.cond.wait(timeout)
+
+            n = min(max_size, self.size)
+            if n == 0:
+                return b""
+
+            first = min(n, self.capacity - self.read_pos)
+            data = bytes(self.buf[self.read_pos:self.read_pos + first])
+            if first < n:
+                data += bytes(self.buf[:n - first])
+
+            self.read_pos = (self.read_pos + n) % self.capacity
+            self.size -= n
+            self.in_flight = n
+            self.cond.notify_all()
+            return data
+
+    def release(self):
+        with self.cond:
+            self.in_flight = 0
+            self.cond.notify_all()
+
+    def wait_empty(self, timeout=None):
+        """block until every byte has been read and written out"""
+        with self.cond:
+            while self.size > 0 or self.in_flight > 0:
+                if not self.cond.wait(timeout) and timeout is not None:
+                    return False
+            return True
+
+    def clear(self):
+        """drop any buffered audio (e.g. after a failed track)"""
+        with self.cond:
+            self.read_pos = 0
+            self.size = 0
+            self.in_flight = 0
+            self.cond.notify_all()
+
+    def reset_stats(self):
+        self.overflows = 0
+        self.backpressure_frames = 0
+        self.high_water = 0
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class BufferWriter(threading.Thread):
+    """drains a RingBuffer on its own thread so a slow encoder or disk
+    never blocks libspotify's event loop"""
+
+    # read size, must stay a multiple of the PCM frame size (4 bytes)
+    chunk_size = 65536
+
+    def __init__(self, ring_buffer, write_func):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.ring_buffer = ring_buffer
+        self.write_func = write_func
+        self.write_errors = 0
+
+    def run(self):
+        ring_buffer = self.ring_buffer
+        while not ring_buffer.closed or ring_buffer.size > 0:
+            data = ring_buffer.read(self.chunk_size, timeout=0.5)
+            if not data:
+                continue
+            try:
+                self.write_func(data)
+            except (IOError, OSError, ValueError) as e:
+                # keep draining so finish_rip never waits forever on a
+                # dead encoder
+                self.write_errors += 1
+                if self.write_errors == 1:
+                    print("\n" + Fore.YELLOW + "Warning: error while "
+                          "writing audio data" + Fore.RESET)
+                    print(str(e))
+            finally:
+                ring_buffer.release()
+
+    def reset_errors(self):
+        self.write_errors = 0
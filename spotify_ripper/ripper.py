@@ -2,20 +2,36 @@
 
 from __future__ import unicode_literals
 
-from subprocess import Popen, PIPE
 from colorama import Fore
 from spotify_ripper.utils import *
-from spotify_ripper.tags import set_metadata_tags
+from spotify_ripper.tags import set_metadata_tags, encoder_tag_args
 from spotify_ripper.progress import Progress
+from spotify_ripper.ringbuffer import RingBuffer, BufferWriter
+from spotify_ripper.encoder import EncoderPool, encoded_types, \
+    remove_stale_part_files
+from spotify_ripper.pcmfile import PCMFile, PCM_BYTES_PER_MS
+from spotify_ripper.spool import Spool
+from spotify_ripper.journal import Journal
+from spotify_ripper.durability import Durability
+from spotify_ripper.verify import Verifier
+from spotify_ripper.library import Library, output_layout
+from spotify_ripper.planner import Planner
+from spotify_ripper.albumcache import AlbumCache
+from spotify_ripper.covers import CoverCache
+from spotify_ripper.expander import LinkExpander
+from spotify_ripper.template import PathTemplate
+from spotify_ripper.manifest import Manifest, plan_action
+from spotify_ripper.metrics import Metrics, MetricsExporter
+from spotify_ripper.trace import Tracer, null_trace
+from spotify_ripper.webapi import WebAPI
 import os
 import sys
+import copy
 import time
 import threading
 import spotify
 import getpass
 import itertools
-import requests
-import wave
 import re
 
 class BitRate(spotify.utils.IntEnum):
@@ -24,12 +40,41 @@ class BitRate(spotify.utils.IntEnum):
     BITRATE_96K = 2
 
 
-class Ripper(threading.Thread):
+class RipOutput(object):
+    """one output format of the track being ripped, args is a copy of
+    the program args with its own output_type and format"""
     audio_file = None
+    # PCMFile of a wav/pcm output
     pcm_file = None
-    wav_file = None
-    rip_proc = None
+    encoder_job = None
     pipe = None
+    trace = null_trace
+
+    # per-track encoder arguments from encoder_tag_args
+    encoder_args = None
+    tagged = False
+
+    # a write to this output failed, the track is not written to it
+    # any further
+    failed = False
+
+    def __init__(self, args):
+        self.args = args
+        self.encoders = EncoderPool(args)
+
+    def write(self, frame_bytes):
+        if self.pipe is not None:
+            self.pipe.write(frame_bytes)
+
+        if self.pcm_file is not None:
+            self.pcm_file.write(frame_bytes)
+
+
+class Ripper(threading.Thread):
+    audio_file = None
+    outputs = []
+    rip_outputs = []
+    pending_tracks = {}
     ripping = False
     finished = False
     current_playlist = None
@@ -39,7 +84,13 @@ class Ripper(threading.Thread):
     idx_digits = 3
     login_success = False
     progress = None
-    dev_null = None
+    ring_buffer = None
+    buffer_writer = None
+    spool = None
+    spool_writer = None
+    metrics_exporter = None
+    journal = None
+    trace = null_trace
     fail_log_file = None
     success_tracks = []
     failure_tracks = []
@@ -58,6 +109,39 @@ class Ripper(threading.Thread):
         self.logged_out = threading.Event()
         self.logged_out.set()
 
+        # in spool mode tracks are encoded by a pool of worker processes,
+        # which needs to be forked before any threads are started (so
+        # does the pool that checks files with --verify)
+        if args.spool and args.plan is None:
+            self.spool = Spool(args)
+        self.verifier = Verifier(args)
+
+        # audio is queued here by on_music_delivery and written out to the
+        # encoder/file by a separate thread
+        self.ring_buffer = RingBuffer(
+            int(float(args.buffer_size) * 1024 * 1024))
+        self.buffer_writer = BufferWriter(self.ring_buffer, self.write_audio)
+        self.buffer_writer.start()
+
+        # state of every track, so an interrupted run can be resumed
+        self.journal = Journal(args)
+        self.durability = Durability(args)
+        self.library = Library(args)
+        self.tracer = Tracer(args)
+        self.planner = Planner(args, self)
+        self.album_cache = AlbumCache(CoverCache(args))
+        self.web_api = WebAPI(args)
+        self.expander = LinkExpander(self, args.link_workers)
+        self.path_templates = {}
+        self.created_dirs = set()
+        self.metrics = Metrics(self)
+
+        # every track is written to each output in a single pass
+        self.outputs = [RipOutput(output_args) for output_args in
+                        [args] + args.tee_outputs]
+        for output in self.outputs:
+            remove_stale_part_files(output.args)
+
         config = spotify.Config()
 
         default_dir = default_settings_dir()
@@ -119,8 +203,21 @@ class Ripper(threading.Thread):
         self.event_loop = spotify.EventLoop(self.session)
         self.event_loop.start()
 
+        if args.metrics_port is not None or args.metrics_file is not None:
+            self.metrics_exporter = MetricsExporter(
+                self.metrics, args.metrics_port,
+                norm_path(args.metrics_file[0])
+                if args.metrics_file is not None else None)
+            self.metrics_exporter.start()
+
+    def log_success(self, track, audio_files):
+        self.success_tracks.append(track)
+        self.metrics.inc("spotify_ripper_tracks_total", result="ripped")
+
     def log_failure(self, track):
         self.failure_tracks.append(track)
+        self.metrics.inc("spotify_ripper_tracks_total", result="failed")
+        self.journal.write("failed", track.link.uri)
         if self.fail_log_file is not None:
             self.fail_log_file.write(track.link.uri + "\n")
 
@@ -128,7 +225,8 @@ class Ripper(threading.Thread):
         if self.fail_log_file is not None:
             file_name = self.fail_log_file.name
             self.fail_log_file.flush()
-            os.fsync(self.fail_log_file.fileno())
+            if self.durability.enabled:
+                os.fsync(self.fail_log_file.fileno())
             self.fail_log_file.close()
             self.fail_log_file = None
 
@@ -136,6 +234,13 @@ class Ripper(threading.Thread):
                 rm_file(file_name)
 
     def print_summary(self):
+        failed_links = self.expander.failed_links
+        if len(failed_links) > 0:
+            print(Fore.RED + "\nFailed Links\n" + ("-" * 79) + Fore.RESET)
+            for uri in failed_links:
+                print(" • " + uri)
+            print("")
+
         if len(self.success_tracks) + len(self.failure_tracks) <= 1:
             return
 
@@ -161,121 +266,494 @@ class Ripper(threading.Thread):
     def run(self):
         args = self.args
 
-        # login
-        print("Logging in...")
-        if args.last:
-            self.login_as_last()
-        elif args.user is not None and args.password is None:
-            password = getpass.getpass()
-            self.login(args.user[0], password)
-        else:
-            self.login(args.user[0], args.password[0])
-
-        if not self.login_success:
-            print(
-                Fore.RED + "Encountered issue while logging into "
-                           "Spotify, aborting..." + Fore.RESET)
+        if not self.login_from_args():
             self.finished = True
             return
 
-        # create track iterator
+        # encode whatever a previous run left in the spool
+        if self.spool is not None:
+            self.spool.resume()
+
+        if args.plan is not None:
+            self.plan_run()
+            self.finish_run()
+            return
+
+        if args.resume:
+            self.resume_journal()
+
+        self.rip_uris()
+        self.finish_run()
+
+    def rip_uris(self):
+        """rip every URI of args"""
+        args = self.args
+        if args.sync:
+            self.sync_run()
+            return
+
         for uri in args.uri:
-            if os.path.exists(uri):
-                tracks = itertools.chain(
-                    *[self.load_link(line.strip()) for line in open(uri)])
-            elif uri.startswith("spotify:"):
-                if (args.exclude_appears_on and
-                        uri.startswith("spotify:artist:")):
-                    album_uris = self.load_artist_albums(uri)
-                    tracks = itertools.chain(
-                        *[self.load_link(album_uri) for
-                          album_uri in album_uris])
-                else:
-                    tracks = self.load_link(uri)
+            if args.stream:
+                self.rip_stream(uri)
             else:
-                tracks = self.search_query(uri)
+                self.rip_uri(uri)
+
+    def rip_uri(self, uri):
+        args = self.args
+        tracks = self.expand_uri(uri)
+
+        if args.flat_with_index and self.current_playlist:
+            self.idx_digits = len(str(len(self.current_playlist.tracks)))
+
+        tracks = list(tracks)
+        num_tracks = len(tracks)
+        tracks, idxs = self.skip_resumed(tracks)
+        self.plan_tracks(tracks, idxs=idxs)
+        plans = self.planner.plan(tracks, idxs=idxs)
+        self.progress.calc_total(plans)
+        self.progress.total_tracks = num_tracks
+        self.prefetch_genres(plans)
+
+        if self.progress.total_size > 0:
+            print(
+                "Total Download Size: " +
+                format_size(self.progress.total_size))
+
+        # ripping loop
+        for plan in plans:
+            # tag any tracks whose encoders have finished meanwhile
+            self.finish_encodes()
+            self.rip_track(plan)
+
+        # wait for the remaining encoders before touching the playlist
+        self.finish_encodes(wait=True)
+
+        # actually removing the tracks from playlist
+        self.remove_tracks_from_playlist()
 
+    def plan_run(self):
+        """plan every URI and write a manifest, no audio is streamed"""
+        args = self.args
+        manifest = Manifest(args)
+        for uri in args.uri:
+            tracks = list(self.expand_uri(uri))
             if args.flat_with_index and self.current_playlist:
                 self.idx_digits = len(str(len(self.current_playlist.tracks)))
+            for plan in self.planner.plan(tracks):
+                manifest.add(plan)
+                self.tracer.finish(plan.idx, plan.uri,
+                                   plan_action(args, plan))
+
+        manifest_file = norm_path(args.plan[0])
+        manifest.write(manifest_file)
+        manifest.print_summary()
+        print(Fore.GREEN + "Plan written to " + manifest_file + Fore.RESET)
+
+    def rip_stream(self, uri):
+        """rip the tracks of a URI while they are still being resolved,
+        one planner batch at a time"""
+        args = self.args
+        tracks = self.expand_uri(uri)
+        window_size = self.planner.batch_size
+        start = 0
+        while True:
+            window = list(itertools.islice(tracks, window_size))
+            if len(window) == 0:
+                break
 
-            tracks = list(tracks)
-            self.progress.calc_total(tracks)
+            if args.flat_with_index and self.current_playlist:
+                self.idx_digits = len(str(len(self.current_playlist.tracks)))
 
-            if self.progress.total_size > 0:
-                print(
-                    "Total Download Size: " +
-                    format_size(self.progress.total_size))
+            window_tracks, idxs = self.skip_resumed(window, start)
+            self.plan_tracks(window_tracks, idxs=idxs)
+            plans = self.planner.plan(window_tracks, idxs=idxs)
+            if start == 0:
+                self.progress.calc_total(plans)
+            else:
+                self.progress.add_total(plans)
+            self.prefetch_genres(plans)
 
-            # ripping loop
-            for idx, track in enumerate(tracks):
-                try:
-                    print('Loading track...')
-                    track.load()
-                    if track.availability != 1:
-                        print(
-                            Fore.RED + 'Track is not available, '
-                                       'skipping...' + Fore.RESET)
-                        self.log_failure(track)
-                        continue
+            for plan in plans:
+                self.finish_encodes()
+                self.rip_track(plan)
+            start += len(window)
 
-                    self.audio_file = self.format_track_path(idx, track)
+        self.finish_encodes(wait=True)
+        self.remove_tracks_from_playlist()
 
-                    if not args.overwrite and os.path.exists(self.audio_file):
-                        print(
-                            Fore.YELLOW + "Skipping " +
-                            track.link.uri + Fore.RESET)
-                        print(Fore.CYAN + self.audio_file + Fore.RESET)
-                        self.queue_remove_from_playlist(idx)
-                        continue
+    def sync_run(self):
+        """rip only the tracks added to each playlist/album since it was
+        last synced, the others are looked up in the library index"""
+        def lines():
+            for uri in self.args.uri:
+                if uri == "-":
+                    for line in sys.stdin:
+                        yield line
+                elif os.path.exists(uri):
+                    with open(uri) as f:
+                        for line in f:
+                            yield line
+                else:
+                    yield uri
 
-                    self.session.player.load(track)
-                    self.prepare_rip(idx, track)
-                    self.session.player.play()
+        # like expand_uri, but every playlist/album is synced on its own
+        def links():
+            for uri in lines():
+                uri = uri.strip()
+                if not uri:
+                    continue
+                if not uri.startswith("spotify:"):
+                    print(Fore.YELLOW + "Skipping " + uri + ", only "
+                          "Spotify URIs can be synced" + Fore.RESET)
+                elif (self.args.exclude_appears_on and
+                        uri.startswith("spotify:artist:")):
+                    for album_uri in self.load_artist_albums(uri):
+                        yield album_uri
+                else:
+                    yield uri
 
-                    self.end_of_track.wait()
-                    self.end_of_track.clear()
+        for job in self.expander.jobs(links()):
+            self.current_playlist = job.playlist
+            self.current_album = job.album
+            self.sync_link(job.uri, list(job.tracks))
 
-                    self.finish_rip(track)
+    def sync_link(self, uri, tracks):
+        args = self.args
+        if args.flat_with_index and self.current_playlist:
+            self.idx_digits = len(str(len(self.current_playlist.tracks)))
+
+        # --overwrite and --verify need to look at every file
+        track_uris = [track.link.uri for track in tracks]
+        known = set()
+        if not args.overwrite and not args.verify:
+            known = self.library.known(
+                uri, [output_layout(output.args) for output in self.outputs])
+        current = set(track_uris)
+        removed = [track_uri for track_uri in self.library.last_tracks(uri)
+                   if track_uri not in current]
+        new = [(idx, track) for idx, track in enumerate(tracks)
+               if track.link.uri not in known]
+
+        print(Fore.GREEN + "Syncing " + uri + ": " + str(len(new)) +
+              " new, " + str(len(tracks) - len(new)) + " in the library, " +
+              str(len(removed)) + " removed" + Fore.RESET)
+        self.library.remove(uri, removed, args.sync_prune)
+
+        self.library.source = uri
+        new_tracks, new_idxs = self.skip_resumed(
+            [track for idx, track in new], idxs=[idx for idx, track in new])
+        self.plan_tracks(new_tracks, idxs=new_idxs)
+        plans = self.planner.plan(new_tracks, idxs=new_idxs)
+        self.progress.calc_total(plans)
+        self.progress.total_tracks = len(tracks)
+        self.prefetch_genres(plans)
+
+        if self.progress.total_size > 0:
+            print(
+                "Total Download Size: " +
+                format_size(self.progress.total_size))
 
-                    # update id3v2 with metadata and embed front cover image
-                    set_metadata_tags(args, self.audio_file, track)
+        for plan in plans:
+            self.finish_encodes()
+            self.rip_track(plan)
 
-                    # make a note of the index and remove all the
-                    # tracks from the playlist when everything is done
-                    self.queue_remove_from_playlist(idx)
+        # tracks in the library count as ripped for -r
+        for idx, track_uri in enumerate(track_uris):
+            if track_uri in known:
+                self.queue_remove_from_playlist(idx)
 
-                except spotify.Error as e:
-                    print(Fore.RED + "Spotify error detected" + Fore.RESET)
-                    print(str(e))
-                    print("Skipping to next track...")
-                    self.session.player.play(False)
-                    self.clean_up_partial()
-                    self.log_failure(track)
-                    continue
+        self.finish_encodes(wait=True)
+        self.remove_tracks_from_playlist()
+        self.library.set_tracks(uri, track_uris)
+        self.library.source = None
+
+    def skip_resumed(self, tracks, start=0, idxs=None):
+        """(tracks, idxs) without the tracks finished by the run being
+        resumed, so they are neither loaded nor planned"""
+        if idxs is None:
+            idxs = range(start, start + len(tracks))
+        pairs = [(idx, track) for idx, track in zip(idxs, tracks)
+                 if not self.journal.is_done(track.link.uri)]
+        num_skipped = len(tracks) - len(pairs)
+        if num_skipped > 0:
+            print(Fore.YELLOW + "Skipping " + str(num_skipped) +
+                  " track(s), already done according to the journal" +
+                  Fore.RESET)
+        return [track for idx, track in pairs], [idx for idx, track in pairs]
+
+    def plan_tracks(self, tracks, start=0, idxs=None):
+        """write the tracks to the journal, the total is unknown while
+        streaming"""
+        playlist = self.current_playlist.link.uri \
+            if self.current_playlist is not None else None
+        album = self.current_album.link.uri \
+            if self.current_album is not None else None
+        total = None if self.args.stream else len(tracks)
+        if idxs is None:
+            idxs = range(start, start + len(tracks))
+        for idx, track in zip(idxs, tracks):
+            self.journal.plan(track.link.uri, idx, total, playlist, album)
+
+    def prefetch_genres(self, plans):
+        """look up the genres of all tracks to be ripped in a few batched
+        Web API requests instead of one request per track"""
+        args = self.args
+        if args.genres is None:
+            return
+
+        uris = []
+        for plan in plans:
+            if not plan.available or plan.skip:
+                continue
+            try:
+                item = plan.track.artists[0] \
+                    if args.genres[0] == "artist" else plan.track.album
+                uris.append(item.link.uri)
+            except (spotify.Error, IndexError):
+                continue
+        self.web_api.prefetch(args.genres[0], uris)
+
+    def resume_journal(self):
+        """rip the tracks the previous run did not finish"""
+        items = self.journal.unfinished()
+        if len(items) == 0:
+            print(Fore.YELLOW + "Nothing to resume in " +
+                  self.journal.journal_file + Fore.RESET)
+            return
+
+        print(Fore.GREEN + "Resuming " + str(len(items)) +
+              " unfinished track(s)" + Fore.RESET)
 
-            # actually removing the tracks from playlist
-            self.remove_tracks_from_playlist()
+        # the tracks may come from different playlists/albums, so each
+        # one is planned in its own context
+        plans = []
+        for item in items:
+            try:
+                plans.append(self.planner.plan_one(
+                    item["idx"], self.load_work_item(item)))
+            except spotify.Error as e:
+                print(str(e))
+                plans.append(None)
+        plans_ok = [plan for plan in plans if plan is not None]
+        self.progress.calc_total(plans_ok)
+        self.prefetch_genres(plans_ok)
+
+        for item, plan in zip(items, plans):
+            if plan is None:
+                continue
+            self.finish_encodes()
+            try:
+                self.load_work_item(item)
+            except spotify.Error as e:
+                print(str(e))
+                continue
 
+            # a track that was streaming may have left a truncated file
+            self.rip_track(plan, overwrite=item["state"] != "planned")
+
+        self.finish_encodes(wait=True)
+        self.remove_tracks_from_playlist()
+        self.tracks_to_remove = []
+
+    def load_work_item(self, item):
+        """restore the playlist/album context of a queued or journaled
+        track"""
+        current = self.current_playlist.link.uri \
+            if self.current_playlist is not None else None
+        if item["playlist"] != current:
+            self.current_playlist = None
+            if item["playlist"] is not None:
+                self.current_playlist = self.session.get_link(
+                    item["playlist"]).as_playlist()
+                self.current_playlist.load()
+
+        current = self.current_album.link.uri \
+            if self.current_album is not None else None
+        if item["album"] != current:
+            self.current_album = None
+            if item["album"] is not None:
+                self.current_album = self.session.get_link(
+                    item["album"]).as_album()
+                self.current_album.load()
+
+        if item["total"] is not None:
+            self.progress.total_tracks = item["total"]
+        return self.session.get_link(item["uri"]).as_track()
+
+    def login_from_args(self):
+        args = self.args
+
+        print("Logging in...")
+        if args.last:
+            self.login_as_last()
+        elif args.user is not None and args.password is None:
+            password = getpass.getpass()
+            self.login(args.user[0], password)
+        else:
+            self.login(args.user[0], args.password[0])
+
+        if not self.login_success:
+            print(
+                Fore.RED + "Encountered issue while logging into "
+                           "Spotify, aborting..." + Fore.RESET)
+        return self.login_success
+
+    def expand_uri(self, uri):
+        """create track iterator for a URI, a file of URIs or a query"""
+        args = self.args
+        if uri == "-":
+            return self.load_links(sys.stdin)
+        elif os.path.exists(uri):
+            return self.load_links(open(uri))
+        elif uri.startswith("spotify:"):
+            if (args.exclude_appears_on and
+                    uri.startswith("spotify:artist:")):
+                album_uris = self.load_artist_albums(uri)
+                return self.load_links(album_uris)
+            else:
+                return self.load_link(uri)
+        else:
+            return self.search_query(uri)
+
+    def rip_track(self, plan, overwrite=False):
+        args = self.args
+        overwrite = overwrite or args.overwrite
+        idx = plan.idx
+        track = plan.track
+        trace = self.tracer.track(idx, plan.uri)
+
+        try:
+            # planning could not load the track, give it another try
+            if plan.available is None:
+                print('Loading track...')
+                track.load()
+                plan = self.planner.plan_one(idx, track)
+                if plan.available is None:
+                    raise spotify.Error("Track could not be loaded")
+
+            if not plan.available:
+                print(
+                    Fore.RED + 'Track is not available, '
+                               'skipping...' + Fore.RESET)
+                self.log_failure(track)
+                self.tracer.finish(idx, plan.uri, "unavailable")
+                return
+
+            if (self.spool is not None and
+                    self.spool.has_pending(plan.uri)):
+                print(
+                    Fore.YELLOW + "Skipping " + plan.uri +
+                    ", already spooled" + Fore.RESET)
+                self.tracer.finish(idx, plan.uri, "skipped")
+                return
+
+            audio_files = plan.audio_files
+            self.audio_file = audio_files[0]
+
+            # only rip the outputs that don't exist yet (or failed
+            # --verify), a duplicate track may have been ripped since the
+            # plan was made
+            self.rip_outputs = []
+            if overwrite or not plan.skip:
+                for output, audio_file in zip(self.outputs, audio_files):
+                    if (overwrite or not os.path.exists(audio_file) or
+                            not self.verifier.is_valid(audio_file)):
+                        output.audio_file = audio_file
+                        self.rip_outputs.append(output)
+
+            if len(self.rip_outputs) == 0:
+                print(
+                    Fore.YELLOW + "Skipping " +
+                    plan.uri + Fore.RESET)
+                for audio_file in audio_files:
+                    print(Fore.CYAN + audio_file + Fore.RESET)
+                self.journal.write("skipped", plan.uri,
+                                   files=audio_files)
+                for output, audio_file in zip(self.outputs, audio_files):
+                    self.library.add(plan.uri, output.args, audio_file)
+                self.metrics.inc("spotify_ripper_tracks_total",
+                                 result="skipped")
+                self.tracer.finish(idx, plan.uri, "skipped")
+                self.queue_remove_from_playlist(idx)
+                return
+
+            for output in self.rip_outputs:
+                self.make_dirs(os.path.dirname(output.audio_file))
+
+            # tags that the encoders write (or make room for) while
+            # encoding, so tagging doesn't rewrite the file afterwards
+            with trace.stage("resolve_tags"):
+                album_meta = self.album_cache.get(track.album)
+                for output in self.rip_outputs:
+                    output.encoder_args, output.tagged = encoder_tag_args(
+                        output.args, track, album_meta, self.web_api)
+
+            self.trace = trace
+            with trace.stage("player_load"):
+                self.session.player.load(track)
+            with trace.stage("prepare_rip"):
+                self.prepare_rip(idx, track)
+            with trace.stage("stream"):
+                self.session.player.play()
+                self.end_of_track.wait()
+                self.end_of_track.clear()
+
+            with trace.stage("finish_rip"):
+                self.finish_rip(idx, track)
+
+        except spotify.Error as e:
+            print(Fore.RED + "Spotify error detected" + Fore.RESET)
+            print(str(e))
+            print("Skipping to next track...")
+            self.session.player.play(False)
+            self.clean_up_partial()
+            self.log_failure(track)
+            self.tracer.finish(idx, plan.uri, "failed")
+
+    def finish_run(self):
         # logout, we are done
+        self.progress.stop()
+        self.shutdown_encoders()
+        if self.spool is not None:
+            self.spool.shutdown()
+        self.verifier.close()
+        self.durability.close()
+        self.library.close()
+        self.journal.close()
+        self.tracer.close()
+        self.web_api.close()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
         self.end_failure_log()
         self.print_summary()
+        self.verifier.report()
         self.logout()
         self.finished = True
 
+    def load_links(self, uris):
+        """tracks of a list (or stream) of URIs, the links are loaded
+        concurrently just ahead of the tracks being consumed"""
+        return self.expander.expand(uris)
+
     def load_link(self, uri):
         # ignore if the uri is just blank (e.g. from a file)
         if not uri:
             return iter([])
+        return self.load_links([uri])
 
+    def resolve_link(self, uri):
+        """load a link and return (tracks, playlist, album), does not
+        touch the current playlist/album so links can be resolved on
+        several threads"""
         link = self.session.get_link(uri)
         if link.type == spotify.LinkType.TRACK:
             track = link.as_track()
-            return iter([track])
+            return [track], None, None
         elif link.type == spotify.LinkType.PLAYLIST:
-            self.current_playlist = link.as_playlist()
+            playlist = link.as_playlist()
             print('Loading playlist...')
-            self.current_playlist.load()
-            return iter(self.current_playlist.tracks)
+            playlist.load()
+            return playlist.tracks, playlist, None
         elif link.type == spotify.LinkType.STARRED:
             link_user = link.as_user()
             if link_user is not None:
@@ -286,26 +764,25 @@ class Ripper(threading.Thread):
             if starred is not None:
                 print('Loading starred playlist...')
                 starred.load()
-                return iter(starred.tracks)
+                return starred.tracks, None, None
             else:
                 print(
                     Fore.RED + "Could not load starred playlist..." +
                     Fore.RESET)
-                return iter([])
+                return [], None, None
         elif link.type == spotify.LinkType.ALBUM:
             album = link.as_album()
             album_browser = album.browse()
             print('Loading album browser...')
             album_browser.load()
-            self.current_album = album
-            return iter(album_browser.tracks)
+            return album_browser.tracks, None, album
         elif link.type == spotify.LinkType.ARTIST:
             artist = link.as_artist()
             artist_browser = artist.browse()
             print('Loading artist browser...')
             artist_browser.load()
-            return iter(artist_browser.tracks)
-        return iter([])
+            return artist_browser.tracks, None, None
+        return [], None, None
 
     # excludes 'appears on' albums
     def load_artist_albums(self, uri):
@@ -314,17 +791,7 @@ class Ripper(threading.Thread):
                   uri_tokens[2] + \
                   '/albums/?=album_type=album,single,compilation' + \
                   '&limit=50&offset=' + str(offset)
-            print(
-                Fore.GREEN + "Attempting to retrieve albums "
-                             "from Spotify's Web API" + Fore.RESET)
-            print(Fore.CYAN + url + Fore.RESET)
-            req = requests.get(url)
-            if req.status_code == 200:
-                return req.json()
-            else:
-                print(Fore.YELLOW + "URL returned non-200 HTTP code: " +
-                      str(req.status_code) + Fore.RESET)
-            return None
+            return self.web_api.get_json(url)
 
         # extract artist id from uri
         uri_tokens = uri.split(':')
@@ -404,14 +871,51 @@ class Ripper(threading.Thread):
         return iter([])
 
     def clean_up_partial(self):
-        if self.audio_file is not None and os.path.exists(self.audio_file):
-            print(Fore.YELLOW + "Deleting partially ripped file" + Fore.RESET)
-            rm_file(self.audio_file)
+        self.ring_buffer.clear()
+        self.trace = null_trace
+        if self.spool_writer is not None:
+            print(Fore.YELLOW + "Deleting partially spooled track" +
+                  Fore.RESET)
+            self.spool.discard(self.spool_writer)
+            self.spool_writer = None
+            self.rip_outputs = []
+            return
+
+        for output in self.rip_outputs:
+            if (output.encoder_job is not None or
+                    output.pcm_file is not None or
+                    (output.audio_file is not None and
+                     os.path.exists(output.audio_file))):
+                print(Fore.YELLOW + "Deleting partially ripped file" +
+                      Fore.RESET)
+            self.discard_output(output)
+        self.rip_outputs = []
+
+    def discard_output(self, output):
+        """stop writing the track to an output and delete what it has
+        written so far"""
+        if output.encoder_job is not None:
+            # the encoder writes to a part file until it finishes
+            output.pipe = None
+            output.encoders.abort(output.encoder_job)
+            output.encoder_job = None
+        elif output.pcm_file is not None:
+            try:
+                output.pcm_file.close()
+            except (IOError, OSError):
+                pass
+            output.pcm_file = None
+            rm_file(output.audio_file)
+        elif (output.audio_file is not None and
+                os.path.exists(output.audio_file)):
+            rm_file(output.audio_file)
+        output.trace = null_trace
 
     def on_music_delivery(self, session, audio_format,
                           frame_bytes, num_frames):
-        self.rip(session, audio_format, frame_bytes, num_frames)
-        return num_frames
+        # returning less than num_frames tells libspotify to deliver
+        # the rest again later
+        return self.rip(session, audio_format, frame_bytes, num_frames)
 
     def on_connection_state_changed(self, session):
         if session.connection.state is spotify.ConnectionState.LOGGED_IN:
@@ -471,151 +975,98 @@ class Ripper(threading.Thread):
             self.logged_out.wait()
         self.event_loop.stop()
 
-    def album_artists_web(self, uri):
-        def get_album_json(album_id):
-            url = 'https://api.spotify.com/v1/albums/' + album_id
-            print(
-                Fore.GREEN + "Attempting to retrieve album "
-                             "from Spotify's Web API" + Fore.RESET)
-            print(Fore.CYAN + url + Fore.RESET)
-            req = requests.get(url)
-            if req.status_code == 200:
-                return req.json()
-            else:
-                print(Fore.YELLOW + "URL returned non-200 HTTP code: " +
-                      str(req.status_code) + Fore.RESET)
-            return None
+    def format_track_paths(self, idx, track, create_dirs=True):
+        """path of the track for each output, the main output first"""
+        return [self.format_track_path(idx, track, output.args, create_dirs)
+                for output in self.outputs]
 
-        # extract album id from uri
-        uri_tokens = uri.split(':')
-        if len(uri_tokens) != 3:
-            return None
+    def format_track_path(self, idx, track, args=None, create_dirs=True):
+        if args is None:
+            args = self.args
+        template = self.path_template(args)
 
-        album = get_album_json(uri_tokens[2])
-        if album is None:
-            return None
+        def album_artist():
+            if self.current_album is not None:
+                return path_part(args, self.current_album.artist.name,
+                                 escape=False)
+            return path_part(args, track.artists[0].name)
 
-        return [artist['name'] for artist in album['artists']]
-
-    def format_track_path(self, idx, track):
-        args = self.args
-        _base_dir = base_dir(args)
-        audio_file = args.format[0].strip()
-
-        track_artist = to_ascii(
-            args, escape_filename_part(track.artists[0].name))
-        track_artists = to_ascii(args, ", ".join(
-            [artist.name for artist in track.artists]))
-        album_artist = to_ascii(
-            args,
-            self.current_album.artist.name
-            if self.current_album is not None else track_artist)
-        album_artists_web = track_artists
+        def track_artists():
+            return path_part(args, ", ".join(
+                [artist.name for artist in track.artists]), escape=False)
 
         # only retrieve album_artist_web if it exists in the format string
-        if (self.current_album is not None and
-                audio_file.find("{album_artists_web}") >= 0):
-            artist_array = self.album_artists_web(self.current_album.link.uri)
-            if artist_array is not None:
-                album_artists_web = to_ascii(args, ", ".join(artist_array))
-
-        album = to_ascii(args, escape_filename_part(track.album.name))
-        track_name = to_ascii(args, escape_filename_part(track.name))
-        year = str(track.album.year)
-        extension = args.output_type
-        idx_str = str(idx)
-        track_num = str(track.index)
-        disc_num = str(track.disc)
-        if self.current_playlist is not None:
-            playlist_name = to_ascii(args, self.current_playlist.name)
-            playlist_owner = to_ascii(args, self.current_playlist.owner.display_name)
-        else:
-            playlist_name = "No Playlist"
-            playlist_owner = "No Playlist Owner"
-        user = self.session.user.display_name
-
-        tags = {
-            "track_artist": track_artist,
+        def album_artists_web():
+            if self.current_album is not None:
+                artist_array = self.web_api.album_artists(
+                    self.current_album.link.uri)
+                if artist_array is not None:
+                    return path_part(args, ", ".join(artist_array),
+                                     escape=False)
+            return track_artists()
+
+        def playlist_name():
+            if self.current_playlist is not None:
+                return path_part(args, self.current_playlist.name,
+                                 escape=False)
+            return "No Playlist"
+
+        def playlist_owner():
+            if self.current_playlist is not None:
+                return path_part(
+                    args, self.current_playlist.owner.display_name,
+                    escape=False)
+            return "No Playlist Owner"
+
+        audio_file = template.render({
+            "track_artist": lambda: path_part(args, track.artists[0].name),
             "track_artists": track_artists,
             "album_artist": album_artist,
             "album_artists_web": album_artists_web,
-            "artist": track_artist,
-            "artists": track_artists,
-            "album": album,
-            "track_name": track_name,
-            "track": track_name,
-            "year": year,
-            "ext": extension,
-            "extension": extension,
-            "idx": idx_str,
-            "index": idx_str,
-            "track_num": track_num,
-            "track_idx": track_num,
-            "track_index": track_num,
-            "disc_num": disc_num,
-            "disc_idx": disc_num,
-            "disc_index": disc_num,
+            "album": lambda: path_part(
+                args, self.album_cache.get(track.album).name),
+            "track_name": lambda: path_part(args, track.name),
+            "year": lambda: str(self.album_cache.get(track.album).year),
+            "ext": args.output_type,
+            "idx": str(idx),
+            "track_num": lambda: str(track.index),
+            "disc_num": lambda: str(track.disc),
             "playlist": playlist_name,
-            "playlist_name": playlist_name,
             "playlist_owner": playlist_owner,
-            "playlist_user": playlist_owner,
-            "playlist_username": playlist_owner,
-            "user": user,
-            "username": user,
-        }
-        fill_tags = {"idx", "index", "track_num", "track_idx",
-                     "track_index", "disc_num", "disc_idx", "disc_index"}
-        for tag in tags.keys():
-            audio_file = audio_file.replace("{" + tag + "}", tags[tag])
-            if tag in fill_tags:
-                match = re.search(r"\{" + tag + r":\d+\}", audio_file)
-                if match:
-                    tokens = audio_file[match.start():match.end()]\
-                        .strip("{}").split(":")
-                    tag_filled = tags[tag].zfill(int(tokens[1]))
-                    audio_file = audio_file[:match.start()] + tag_filled + \
-                        audio_file[match.end():]
-
-        # in case the file name is too long
-        def truncate(_str, max_size):
-            return _str[:max_size].strip() if len(_str) > max_size else _str
-
-        def truncate_dir_path(dir_path):
-            path_tokens = dir_path.split(os.pathsep)
-            path_tokens = [truncate(token, 255) for token in path_tokens]
-            return os.pathsep.join(path_tokens)
-
-        def truncate_file_name(file_name):
-            tokens = file_name.rsplit(os.extsep, 1)
-            if len(tokens) > 1:
-                tokens[0] = truncate(tokens[0], 255 - len(tokens[1]) - 1)
-            else:
-                tokens[0] = truncate(tokens[0], 255)
-            return os.extsep.join(tokens)
-
-        # ensure each component in path is no more than 255 chars long
-        tokens = audio_file.rsplit(os.pathsep, 1)
-        if len(tokens) > 1:
-            audio_file = os.path.join(
-                truncate_dir_path(tokens[0]), truncate_file_name(tokens[1]))
-        else:
-            audio_file = truncate_file_name(tokens[0])
+            "user": lambda: self.session.user.display_name,
+        })
 
         # prepend base_dir
-        audio_file = to_ascii(args, os.path.join(_base_dir, audio_file))
+        audio_file = to_ascii(args, os.path.join(template.base_dir,
+                                                 audio_file))
 
         # create directory if it doesn't exist
-        audio_path = os.path.dirname(audio_file)
-        if not os.path.exists(audio_path):
-            os.makedirs(audio_path)
+        if create_dirs:
+            self.make_dirs(os.path.dirname(audio_file))
 
         return audio_file
 
-    def prepare_rip(self, idx, track):
-        args = self.args
+    def path_template(self, args):
+        """compiled format string of an output, along with its base dir"""
+        key = (args.format[0], args.directory[0]
+               if args.directory is not None else None)
+        template = self.path_templates.get(key)
+        if template is None:
+            template = PathTemplate(args.format[0].strip())
+            template.base_dir = base_dir(args)
+            self.path_templates[key] = template
+        return template
+
+    def make_dirs(self, path):
+        """create a directory once per run"""
+        if path not in self.created_dirs:
+            make_dirs(path)
+            self.created_dirs.add(path)
 
+    def prepare_rip(self, idx, track):
         # reset progress
         self.progress.prepare_track(track)
+        self.journal.write("streaming", track.link.uri)
 
         if self.progress.total_tracks > 1:
             print(Fore.GREEN + "[ " + str(idx + 1) + " / " + str(
@@ -623,128 +1074,288 @@ class Ripper(threading.Thread):
                   track.link.uri + Fore.RESET)
         else:
             print(Fore.GREEN + "Ripping " + track.link.uri + Fore.RESET)
-        print(Fore.CYAN + self.audio_file + Fore.RESET)
+        for output in self.rip_outputs:
+            print(Fore.CYAN + output.audio_file + Fore.RESET)
 
         file_size = calc_file_size(self.args, track)
         print("Track Download Size: " + format_size(file_size))
 
-        if args.output_type == "wav":
-            self.wav_file = wave.open(self.audio_file, "wb")
-            self.wav_file.setparams((2, 2, 44100, 0, 'NONE', 'not compressed'))
-        elif args.output_type == "pcm":
-            self.pcm_file = open(self.audio_file, 'wb')
-        elif args.output_type == "flac":
-            self.rip_proc = Popen(
-                ["flac", "-f", str("-" + args.comp), "--silent", "--endian",
-                 "little", "--channels", "2", "--bps", "16", "--sample-rate",
-                 "44100", "--sign", "signed", "-o", self.audio_file, "-"],
-                stdin=PIPE)
-        elif args.output_type == "ogg":
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["oggenc", "--quiet", "--raw", "-b", args.bitrate, "-o",
-                     self.audio_file, "-"], stdin=PIPE)
-            else:
-                self.rip_proc = Popen(
-                    ["oggenc", "--quiet", "--raw", "-q", args.vbr, "-o",
-                     self.audio_file, "-"], stdin=PIPE)
-        elif args.output_type == "opus":
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["opusenc", "--quiet", "--comp", args.comp, "--cvbr",
-                     "--bitrate", str(int(args.bitrate) / 2), "--raw",
-                     "--raw-rate", "44100", "-", self.audio_file], stdin=PIPE)
-            else:
-                self.rip_proc = Popen(
-                    ["opusenc", "--quiet", "--comp", args.comp, "--vbr",
-                     "--bitrate", args.vbr, "--raw", "--raw-rate", "44100",
-                     "-", self.audio_file], stdin=PIPE)
-        elif args.output_type == "aac":
-            if self.dev_null is None:
-                self.dev_null = open(os.devnull, 'wb')
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["faac", "-P", "-X", "-b", args.bitrate, "-o",
-                     self.audio_file, "-"], stdin=PIPE,
-                    stdout=self.dev_null, stderr=self.dev_null)
-            else:
-                self.rip_proc = Popen(
-                    ["faac", "-P", "-X", "-q", args.vbr, "-o",
-                     self.audio_file, "-"], stdin=PIPE,
-                    stdout=self.dev_null, stderr=self.dev_null)
-        elif args.output_type == "m4a":
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["fdkaac", "-S", "-R", "-w", "200000", "-b",
-                     args.bitrate, "-o", self.audio_file, "-"], stdin=PIPE)
-            else:
-                self.rip_proc = Popen(
-                    ["fdkaac", "-S", "-R", "-w", "200000", "-m", args.vbr,
-                     "-o", self.audio_file, "-"], stdin=PIPE)
-        elif args.output_type == "mp3":
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["lame", "--silent", "-cbr", "-b", args.bitrate, "-h",
-                     "-r", "-", self.audio_file], stdin=PIPE)
-            else:
-                self.rip_proc = Popen(
-                    ["lame", "--silent", "-V", args.vbr, "-h", "-r", "-",
-                     self.audio_file], stdin=PIPE)
+        self.ring_buffer.clear()
+        self.ring_buffer.reset_stats()
+        self.buffer_writer.reset_errors()
+
+        # only the raw PCM is written while streaming in spool mode
+        if self.spool is not None:
+            self.spool_writer = self.spool.open(
+                idx, track, self.rip_outputs)
+            self.ripping = True
+            return
 
-        if self.rip_proc is not None:
-            self.pipe = self.rip_proc.stdin
+        for output in self.rip_outputs:
+            output_type = output.args.output_type
+            output.trace = self.trace.output(output_type)
+            output.failed = False
+            if output_type == "wav" or output_type == "pcm":
+                output.pcm_file = PCMFile(
+                    output.audio_file, track.duration * PCM_BYTES_PER_MS,
+                    wav=output_type == "wav")
+            elif output_type in encoded_types:
+                with output.trace.stage("encoder_spawn"):
+                    output.encoder_job = output.encoders.acquire(
+                        idx, track, output.audio_file, output.encoder_args,
+                        output.tagged)
+                output.pipe = output.encoder_job.pipe
 
         self.ripping = True
 
-    def finish_rip(self, track):
+    def finish_rip(self, idx, track):
         self.progress.end_track()
-        if self.pipe is not None:
-            print(Fore.GREEN + 'Rip complete' + Fore.RESET)
-            self.pipe.flush()
-            self.pipe.close()
 
-            # wait for process to end before continuing
-            ret_code = self.rip_proc.wait()
-            if ret_code != 0:
-                print(
-                    Fore.YELLOW + "Warning: encoder returned non-zero "
-                                  "error code " + str(ret_code) + Fore.RESET)
-            self.rip_proc = None
-            self.pipe = None
+        # make sure everything buffered has been handed to the encoder
+        with self.trace.stage("buffer_drain"):
+            self.ring_buffer.wait_empty()
+        if self.ring_buffer.overflows > 0:
+            self.metrics.inc("spotify_ripper_buffer_overflows_total",
+                             self.ring_buffer.overflows)
+            print(Fore.YELLOW + "Audio buffer was full " +
+                  str(self.ring_buffer.overflows) + " times (peak " +
+                  format_size(self.ring_buffer.high_water) + "), " +
+                  "encoder or disk could not keep up" + Fore.RESET)
+
+        # audio that could not be written leaves the files incomplete
+        if self.buffer_writer.write_errors > 0:
+            print(Fore.RED + "Could not write the audio of " +
+                  track.link.uri + ", skipping..." + Fore.RESET)
+            self.ripping = False
+            self.clean_up_partial()
+            self.log_failure(track)
+            self.tracer.finish(idx, track.link.uri, "failed")
+            return
 
-        if self.wav_file is not None:
-            self.wav_file.flush()
-            os.fsync(self.wav_file.fileno())
-            self.wav_file.close()
-            self.wav_file = None
+        print(Fore.GREEN + 'Rip complete' + Fore.RESET)
+        self.ripping = False
+        self.trace = null_trace
 
-        if self.pcm_file is not None:
-            self.pcm_file.flush()
-            os.fsync(self.pcm_file.fileno())
-            self.pcm_file.close()
-            self.pcm_file = None
+        # the track is done once every output has been tagged
+        self.pending_tracks[(idx, track.link.uri)] = \
+            [len(self.rip_outputs), False, []]
+        rip_outputs = self.rip_outputs
+        self.rip_outputs = []
 
-        self.ripping = False
-        self.success_tracks.append(track)
+        if self.spool_writer is not None:
+            self.spool.submit(self.spool_writer)
+            self.spool_writer = None
+
+        for output in rip_outputs:
+            if output.failed:
+                print(Fore.YELLOW + "Deleting partially ripped file" +
+                      Fore.RESET)
+                self.discard_output(output)
+                self.finish_output(idx, track, output.args,
+                                   output.audio_file, failed=True)
+                continue
+
+            if output.encoder_job is not None:
+                # the encoder finishes in the background, the file is
+                # tagged by finish_encodes once it exits
+                output.pipe = None
+                with output.trace.stage("encoder_release"):
+                    output.encoders.release(output.encoder_job)
+                output.encoder_job = None
+
+            if output.pcm_file is not None:
+                with output.trace.stage("close"):
+                    output.pcm_file.close()
+                output.pcm_file = None
+                self.finish_output(idx, track, output.args, output.audio_file)
+            output.trace = null_trace
+
+        self.audio_file = None
+
+    def finish_encodes(self, wait=False):
+        """tag the files whose encoders have exited"""
+        for output in self.outputs:
+            for job in output.encoders.completed(wait):
+                if job.failed:
+                    if job.error is not None:
+                        print(Fore.YELLOW + "Warning: encoder for " +
+                              job.track.link.uri + " failed" + Fore.RESET)
+                        print(str(job.error))
+                    else:
+                        print(Fore.YELLOW + "Warning: encoder for " +
+                              job.track.link.uri + " returned non-zero "
+                              "error code " + str(job.ret_code) + Fore.RESET)
+
+                self.tracer.track(job.idx, job.track.link.uri).output(
+                    output.args.output_type).add(
+                    "encoder_drain", job.drain_start, job.drain_end)
+                self.finish_output(job.idx, job.track, output.args,
+                                   job.audio_file, job.failed, job.tagged)
+
+        if self.spool is not None:
+            for spooled_track in self.spool.completed(wait):
+                self.finish_spooled(spooled_track)
+
+    def finish_spooled(self, spooled_track):
+        """tag the outputs of a track encoded by the spool's workers"""
+        track = spooled_track.track
+        outputs = spooled_track.outputs
+        if track is None:
+            # left over from a previous run
+            try:
+                track = self.session.get_link(spooled_track.uri).as_track()
+            except spotify.Error as e:
+                print(str(e))
+                spooled_track.remove()
+                return
+            self.pending_tracks[(None, spooled_track.uri)] = \
+                [len(outputs), False, []]
+
+        results = spooled_track.results
+        for i, output in enumerate(outputs):
+            ret_code, error = results[min(i, len(results) - 1)]
+            failed = ret_code != 0 or error is not None
+            if error is not None:
+                print(Fore.YELLOW + "Warning: encoding " +
+                      spooled_track.uri + " from spool failed" + Fore.RESET)
+                print(error)
+            elif failed:
+                print(Fore.YELLOW + "Warning: encoder for " +
+                      spooled_track.uri + " returned non-zero error code " +
+                      str(ret_code) + Fore.RESET)
+
+            self.finish_output(spooled_track.idx, track,
+                               self.spooled_output_args(output),
+                               output["audio_file"], failed,
+                               output.get("tagged", False))
+
+        spooled_track.remove()
+
+    def spooled_output_args(self, output):
+        for rip_output in self.outputs:
+            if rip_output.args.output_type == output["output_type"]:
+                return rip_output.args
+
+        # spooled by a previous run with other outputs
+        output_args = copy.copy(self.args)
+        output_args.output_type = output["output_type"]
+        return output_args
+
+    def finish_output(self, idx, track, output_args, audio_file,
+                      failed=False, tagged=False):
+        if not failed:
+            self.journal.write("encoded", track.link.uri, file=audio_file)
+            trace = self.tracer.track(idx, track.link.uri).output(
+                output_args.output_type)
+            start = time.time()
+            try:
+                with trace.stage("tagging"):
+                    with trace.stage("album_load"):
+                        album_meta = self.album_cache.get(track.album)
+
+                    # update id3v2 with metadata and embed front cover image
+                    set_metadata_tags(output_args, audio_file, track,
+                                      album_meta, self.web_api, trace,
+                                      tagged)
+                self.metrics.observe("spotify_ripper_tagging_seconds",
+                                     time.time() - start,
+                                     output_type=output_args.output_type)
+                self.library.add(track.link.uri, output_args, audio_file)
+            except spotify.Error as e:
+                print(Fore.RED + "Spotify error detected" + Fore.RESET)
+                print(str(e))
+                rm_file(audio_file)
+                failed = True
+
+        key = (idx, track.link.uri)
+        pending = self.pending_tracks[key]
+        pending[0] -= 1
+        pending[1] = pending[1] or failed
+        pending[2].append(audio_file)
+        if pending[0] > 0:
+            return
+
+        del self.pending_tracks[key]
+        if pending[1]:
+            self.log_failure(track)
+        else:
+            # make a note of the index and remove all the
+            # tracks from the playlist when everything is done
+            if idx is not None:
+                self.queue_remove_from_playlist(idx)
+            with self.tracer.track(idx, track.link.uri).stage("sync"):
+                self.durability.add(pending[2], self.journal_tagged(
+                    track.link.uri, pending[2]))
+            self.verifier.ripped(pending[2])
+            self.log_success(track, pending[2])
+        self.tracer.finish(idx, track.link.uri,
+                           "failed" if pending[1] else "ripped")
+
+    def journal_tagged(self, uri, audio_files):
+        """called once the files of a track are synced, --resume rips
+        anything a crash could have cut short again"""
+        return lambda: self.journal.write("tagged", uri, files=audio_files)
+
+    def shutdown_encoders(self):
+        for output in self.outputs:
+            output.encoders.shutdown()
 
     def rip(self, session, audio_format, frame_bytes, num_frames):
-        if self.ripping:
-            self.progress.update_progress(num_frames, audio_format)
-            if self.pipe is not None:
-                self.pipe.write(frame_bytes)
+        if not self.ripping:
+            return num_frames
+
+        num_frames = self.ring_buffer.write_frames(
+            frame_bytes, audio_format.frame_size(), num_frames)
+        if num_frames > 0:
+            self.metrics.inc("spotify_ripper_pcm_frames_total", num_frames)
+            self.trace.frames += num_frames
+            self.metrics.last_delivery = time.time()
+            self.progress.add_frames(num_frames, audio_format.sample_rate)
+        return num_frames
 
-            if self.wav_file is not None:
-                self.wav_file.writeframes(frame_bytes)
+    def write_audio(self, frame_bytes):
+        """called from the buffer writer thread"""
+        if self.spool_writer is not None:
+            self.spool_writer.write(frame_bytes)
+            self.trace.output("spool").bytes += len(frame_bytes)
+            self.metrics.inc("spotify_ripper_bytes_written_total",
+                             len(frame_bytes), output_type="spool")
+            return
 
-            if self.pcm_file is not None:
-              self.pcm_file.write(frame_bytes)
+        for output in self.rip_outputs:
+            if output.failed:
+                continue
+            try:
+                output.write(frame_bytes)
+            except (IOError, OSError, ValueError) as e:
+                # only this output is incomplete, keep feeding the others
+                output.failed = True
+                print("\n" + Fore.YELLOW + "Warning: error while writing "
+                      "audio data to " + output.audio_file + Fore.RESET)
+                print(str(e))
+                continue
+            output.trace.bytes += len(frame_bytes)
+            self.metrics.inc("spotify_ripper_bytes_written_total",
+                             len(frame_bytes),
+                             output_type=output.args.output_type)
 
     def abort(self):
         self.session.player.play(False)
         self.clean_up_partial()
+        if self.spool is not None:
+            # spooled tracks are encoded on the next run
+            self.spool.shutdown(terminate=True)
+        else:
+            self.finish_encodes(wait=True)
+        self.shutdown_encoders()
         self.remove_tracks_from_playlist()
+        self.verifier.close()
+        self.durability.close()
+        self.library.close()
+        self.journal.close()
         self.end_failure_log()
         self.print_summary()
+        self.verifier.report()
         self.logout()
         self.finished = True
 
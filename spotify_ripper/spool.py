@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from subprocess import Popen, PIPE
+from colorama import Fore
+from spotify_ripper.utils import *
+from spotify_ripper.encoder import encoder_command, part_file_path
+from spotify_ripper.pcmfile import PCMFile, PCM_BYTES_PER_MS
+import os
+import io
+import json
+import gzip
+import mmap
+import shutil
+import signal
+import time
+import threading
+import multiprocessing
+import uuid
+
+
+def spool_dir(args):
+    return norm_path(args.spool_dir[0]) if args.spool_dir is not None \
+        else os.path.join(settings_dir(args), "spool")
+
+
+def write_manifest(manifest_file, manifest):
+    """atomically replace the manifest of a spooled track"""
+    tmp_file = manifest_file + ".tmp"
+    with io.open(tmp_file, "w", encoding="utf-8") as f:
+        f.write(json.dumps(manifest, ensure_ascii=False))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_file, manifest_file)
+
+
+def read_manifest(manifest_file):
+    with io.open(manifest_file, "r", encoding="utf-8") as f:
+        return json.loads(f.read())
+
+
+class SpoolWriter(object):
+    """appends raw PCM for one track to a memory-mapped (or gzip
+    compressed) spool file"""
+    mm = None
+    size = 0
+
+    def __init__(self, pcm_file, compressed, expected_size):
+        self.pcm_file = pcm_file
+        self.compressed = compressed
+        if compressed:
+            self.f = gzip.open(pcm_file, "wb", compresslevel=1)
+        else:
+            self.f = open(pcm_file, "w+b")
+            self.map(max(expected_size, mmap.PAGESIZE))
+
+    def map(self, capacity):
+        if self.mm is not None:
+            self.mm.close()
+        self.f.truncate(capacity)
+        self.capacity = capacity
+        self.mm = mmap.mmap(self.f.fileno(), capacity)
+
+    def write(self, frame_bytes):
+        n = len(frame_bytes)
+        if self.compressed:
+            self.f.write(frame_bytes)
+        else:
+            if self.size + n > self.capacity:
+                # track is longer than announced, grow by ~10 seconds
+                self.map(self.size + n + int(PCM_BYTES_PER_MS * 10000))
+            self.mm[self.size:self.size + n] = frame_bytes
+        self.size += n
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+            self.f.truncate(self.size)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+
+def encode_spooled(manifest_file):
+    """encode a spooled track to all of its outputs, runs in a worker
+    process of the encode farm"""
+    try:
+        return manifest_file, encode_outputs(read_manifest(manifest_file))
+    except Exception as e:
+        # the main process waits for a result of every track
+        return manifest_file, [(None, str(e))]
+
+
+def encode_outputs(manifest):
+    outputs = manifest["outputs"]
+    results = []
+
+    dev_null = open(os.devnull, 'wb')
+    procs = []
+    for output in outputs:
+        if output["output_type"] in ("wav", "pcm"):
+            procs.append(PCMFile(output["part_file"], manifest["size"],
+                                 wav=output["output_type"] == "wav"))
+        elif output["quiet"]:
+            procs.append(Popen(output["command"], stdin=PIPE,
+                               stdout=dev_null, stderr=dev_null))
+        else:
+            procs.append(Popen(output["command"], stdin=PIPE))
+
+    def write_all(data):
+        for output, proc in zip(outputs, procs):
+            if output["output_type"] in ("wav", "pcm"):
+                proc.write(data)
+            else:
+                proc.stdin.write(data)
+
+    error = None
+    try:
+        if manifest["compressed"]:
+            with gzip.open(manifest["pcm_file"], "rb") as f:
+                while True:
+                    data = f.read(1024 * 1024)
+                    if not data:
+                        break
+                    write_all(data)
+        elif manifest["size"] > 0:
+            with open(manifest["pcm_file"], "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for pos in range(0, len(mm), 1024 * 1024):
+                        write_all(mm[pos:pos + 1024 * 1024])
+                finally:
+                    mm.close()
+    except (IOError, OSError) as e:
+        error = str(e)
+
+    for output, proc in zip(outputs, procs):
+        ret_code = 0
+        output_error = error
+        try:
+            if output["output_type"] in ("wav", "pcm"):
+                proc.close()
+            else:
+                proc.stdin.close()
+                ret_code = proc.wait()
+            if ret_code == 0 and output_error is None:
+                shutil.move(output["part_file"], output["audio_file"])
+        except (IOError, OSError) as e:
+            output_error = str(e)
+        if ret_code != 0 or output_error is not None:
+            rm_file(output["part_file"])
+        results.append((ret_code, output_error))
+
+    dev_null.close()
+    return results
+
+
+def init_worker():
+    # Ctrl-C is handled by the main process, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class SpooledTrack(object):
+    """a track waiting in the spool, track/idx are None for tracks left
+    over from a previous run"""
+
+    def __init__(self, manifest_file, manifest, idx=None, track=None):
+        self.manifest_file = manifest_file
+        self.manifest = manifest
+        self.idx = idx
+        self.track = track
+        self.results = None
+
+    @property
+    def uri(self):
+        return self.manifest["uri"]
+
+    @property
+    def outputs(self):
+        return self.manifest["outputs"]
+
+    def remove(self):
+        rm_file(self.manifest["pcm_file"])
+        rm_file(self.manifest_file)
+
+
+class Spool(object):
+    """spools raw PCM to disk while streaming and encodes spooled tracks
+    in a pool of worker processes
+
+    Each track is a PCM file plus a JSON manifest with the encoder
+    command lines for each output.  A manifest stays in the spool until
+    the track has been encoded and tagged, so tracks spooled before a
+    crash are encoded on the next run.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.dir = spool_dir(args)
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.finished = []
+
+        # create the pool before any other threads are started
+        num_workers = int(args.spool_workers) \
+            if args.spool_workers is not None \
+            else multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(num_workers, init_worker)
+
+    def open(self, idx, track, rip_outputs):
+        """start spooling a track, returns the writer for its PCM"""
+        name = uuid.uuid4().hex
+        compressed = self.args.spool_compress
+        pcm_file = os.path.join(
+            self.dir, name + (".pcm.gz" if compressed else ".pcm"))
+        manifest_file = os.path.join(self.dir, name + ".json")
+
+        outputs = []
+        for output in rip_outputs:
+            output_type = output.args.output_type
+            part_file = part_file_path(output.args)
+            outputs.append({
+                "output_type": output_type,
+                "audio_file": output.audio_file,
+                "part_file": part_file,
+                "command": encoder_command(output.args, part_file,
+                                           output.encoder_args),
+                "quiet": output_type == "aac",
+                "tagged": output.tagged,
+            })
+
+        manifest = {
+            "uri": track.link.uri,
+            "state": "streaming",
+            "pcm_file": pcm_file,
+            "compressed": compressed,
+            "size": 0,
+            "outputs": outputs,
+        }
+        write_manifest(manifest_file, manifest)
+
+        writer = SpoolWriter(pcm_file, compressed,
+                             int(track.duration * PCM_BYTES_PER_MS))
+        writer.spooled_track = SpooledTrack(
+            manifest_file, manifest, idx, track)
+        return writer
+
+    def submit(self, writer):
+        """mark a fully streamed track as spooled and queue its encode"""
+        writer.close()
+        spooled_track = writer.spooled_track
+        spooled_track.manifest["state"] = "spooled"
+        spooled_track.manifest["size"] = writer.size
+        write_manifest(spooled_track.manifest_file, spooled_track.manifest)
+        self.encode(spooled_track)
+
+    def discard(self, writer):
+        """drop a track that failed while streaming"""
+        try:
+            writer.close()
+        except (IOError, OSError, ValueError):
+            pass
+        writer.spooled_track.remove()
+
+    def encode(self, spooled_track):
+        with self.lock:
+            self.pending[spooled_track.manifest_file] = spooled_track
+
+        def on_result(result):
+            manifest_file, results = result
+            with self.lock:
+                spooled_track = self.pending.pop(manifest_file)
+                spooled_track.results = results
+                self.finished.append(spooled_track)
+
+        self.pool.apply_async(encode_spooled, (spooled_track.manifest_file,),
+                              callback=on_result)
+
+    def resume(self):
+        """queue tracks left in the spool by a previous run"""
+        num_resumed = 0
+        for file_name in sorted(os.listdir(self.dir)):
+            if not file_name.endswith(".json"):
+                continue
+
+            manifest_file = os.path.join(self.dir, file_name)
+            try:
+                manifest = read_manifest(manifest_file)
+            except (IOError, OSError, ValueError) as e:
+                print(Fore.YELLOW + "Warning: could not read spool "
+                      "manifest " + manifest_file + Fore.RESET)
+                continue
+
+            spooled_track = SpooledTrack(manifest_file, manifest)
+            if manifest["state"] == "spooled":
+                self.encode(spooled_track)
+                num_resumed += 1
+            else:
+                # never finished streaming
+                spooled_track.remove()
+
+        if num_resumed > 0:
+            print(Fore.GREEN + "Resuming " + str(num_resumed) +
+                  " spooled track(s)" + Fore.RESET)
+
+    def has_pending(self, uri):
+        with self.lock:
+            return any(spooled_track.uri == uri
+                       for spooled_track in self.pending.values())
+
+    def completed(self, wait=False):
+        """return (and forget) the tracks that have finished encoding"""
+        if wait:
+            while True:
+                with self.lock:
+                    if len(self.pending) == 0:
+                        break
+                time.sleep(0.1)
+
+        with self.lock:
+            finished = self.finished
+            self.finished = []
+        return finished
+
+    def shutdown(self, terminate=False):
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore, AnsiToWin32
+from spotify_ripper.ripper import Ripper
+from spotify_ripper.utils import *
+import os
+import sys
+import copy
+import time
+import codecs
+import signal
+import spotify
+import multiprocessing
+
+if sys.version_info >= (3, 0):
+    import configparser as ConfigParser
+    import queue
+else:
+    import ConfigParser
+    import Queue as queue
+
+
+def load_accounts(args):
+    """one worker per section of the accounts file, e.g.
+
+    [alice]
+    user = alice
+    password = secret
+    settings = ~/.spotify-ripper/alice
+    """
+    accounts_file = norm_path(args.accounts[0])
+    if not os.path.exists(accounts_file):
+        print(Fore.RED + "Accounts file " + accounts_file +
+              " does not exist" + Fore.RESET)
+        sys.exit(1)
+
+    # raw parser, passwords may contain '%'
+    config = ConfigParser.RawConfigParser()
+    config.read(accounts_file)
+
+    accounts = []
+    for section in config.sections():
+        items = dict(config.items(section))
+        account = {
+            "name": section,
+            "user": items.get("user"),
+            "password": items.get("password"),
+            "last": items.get("last", "False").strip() == "True",
+            "settings": norm_path(os.path.expanduser(items["settings"]))
+            if "settings" in items else
+            os.path.join(settings_dir(args), "workers", section),
+        }
+
+        # workers can't ask for a password interactively
+        if not account["last"] and (account["user"] is None or
+                                    account["password"] is None):
+            print(Fore.RED + "Account " + section + " needs a user and "
+                  "password, or last = True" + Fore.RESET)
+            sys.exit(1)
+        accounts.append(account)
+
+    if len(accounts) == 0:
+        print(Fore.RED + "No accounts found in " + accounts_file +
+              Fore.RESET)
+        sys.exit(1)
+    return accounts
+
+
+def worker_args(args, account, worker_idx):
+    """copy of args for the worker that rips as account"""
+    if not os.path.exists(account["settings"]):
+        os.makedirs(account["settings"])
+
+    _args = copy.copy(args)
+    _args.user = [account["user"]] if account["user"] is not None else None
+    _args.password = [account["password"]] \
+        if account["password"] is not None else None
+    _args.last = account["last"]
+    _args.settings = [account["settings"]]
+    _args.accounts = None
+    _args.fail_log = None
+    _args.log = [os.path.join(account["settings"], "worker.log")]
+    _args.has_log = True
+
+    # each worker exports its own metrics, trace and verify report
+    if args.metrics_port is not None:
+        _args.metrics_port = args.metrics_port + worker_idx
+    if args.metrics_file is not None:
+        base, ext = os.path.splitext(args.metrics_file[0])
+        _args.metrics_file = [base + "-" + account["name"] + ext]
+    if args.trace is not None:
+        base, ext = os.path.splitext(args.trace[0])
+        _args.trace = [base + "-" + account["name"] + ext]
+    if args.verify_report is not None:
+        base, ext = os.path.splitext(args.verify_report[0])
+        _args.verify_report = [base + "-" + account["name"] + ext]
+
+    # a worker's spool resume would delete or re-encode the tracks the
+    # other workers are spooling
+    if args.spool_dir is not None:
+        _args.spool_dir = [os.path.join(args.spool_dir[0],
+                                        account["name"])]
+    return _args
+
+
+def track_str(track):
+    try:
+        return track.artists[0].name + " - " + track.name
+    except (spotify.Error, IndexError):
+        return track.link.uri
+
+
+class WorkerRipper(Ripper):
+    """a Ripper that rips tracks from the supervisor's work queue, the
+    first worker to log in expands the URIs into the queue"""
+
+    def __init__(self, args, worker_idx, num_workers, work_queue,
+                 result_queue, expander_lock):
+        Ripper.__init__(self, args)
+        self.worker_idx = worker_idx
+        self.num_workers = num_workers
+        self.work_queue = work_queue
+        self.result_queue = result_queue
+        self.expander_lock = expander_lock
+        self.metrics.labels = (("worker", str(worker_idx)),)
+
+    def run(self):
+        if not self.login_from_args():
+            self.result_queue.put(("login_failed", self.worker_idx))
+            self.logout()
+            self.finished = True
+            return
+
+        if self.spool is not None:
+            self.spool.resume()
+
+        if self.expander_lock.acquire(False):
+            self.queue_work()
+
+        while True:
+            item = self.work_queue.get()
+            if item is None:
+                break
+
+            self.finish_encodes()
+            try:
+                track = self.load_work_item(item)
+            except spotify.Error as e:
+                print(str(e))
+                self.result_queue.put(
+                    ("failure", self.worker_idx, item["uri"], item["uri"]))
+                continue
+            self.rip_track(self.planner.plan_one(item["idx"], track))
+
+        self.finish_encodes(wait=True)
+        self.finish_run()
+
+    def queue_work(self):
+        self.result_queue.put(("expanding", self.worker_idx))
+        num_tracks = 0
+        for uri in self.args.uri:
+            if not os.path.exists(uri) and not uri.startswith("spotify:"):
+                print(Fore.YELLOW + "Search queries are not supported with "
+                      "--accounts, skipping " + uri + Fore.RESET)
+                continue
+
+            tracks = list(self.expand_uri(uri))
+            playlist = self.current_playlist.link.uri \
+                if self.current_playlist is not None else None
+            album = self.current_album.link.uri \
+                if self.current_album is not None else None
+            for idx, track in enumerate(tracks):
+                self.work_queue.put({
+                    "uri": track.link.uri,
+                    "idx": idx,
+                    "total": len(tracks),
+                    "playlist": playlist,
+                    "album": album,
+                })
+            num_tracks += len(tracks)
+
+        self.result_queue.put(("queued", self.worker_idx, num_tracks))
+        for i in range(self.num_workers):
+            self.work_queue.put(None)
+
+    def log_success(self, track, audio_files):
+        Ripper.log_success(self, track, audio_files)
+        self.result_queue.put(("success", self.worker_idx, track.link.uri,
+                               track_str(track), audio_files))
+
+    def log_failure(self, track):
+        Ripper.log_failure(self, track)
+        self.result_queue.put(("failure", self.worker_idx, track.link.uri,
+                               track_str(track)))
+
+
+def run_worker(args, worker_idx, num_workers, work_queue, result_queue,
+               expander_lock):
+    # Ctrl-C is handled by the supervisor, which stops us with SIGTERM
+    def on_terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, on_terminate)
+
+    # each worker logs to a file in its own settings directory
+    log_file = codecs.open(args.log[0], 'a', 'utf-8')
+    sys.stdout = AnsiToWin32(log_file, strip=True).stream
+
+    ripper = WorkerRipper(args, worker_idx, num_workers, work_queue,
+                          result_queue, expander_lock)
+    ripper.start()
+    try:
+        while not ripper.finished:
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        ripper.abort()
+
+
+class Supervisor(object):
+    """runs one worker process per account, all pulling tracks from a
+    shared work queue, and merges their results"""
+    expander = None
+    num_queued = None
+
+    def __init__(self, args):
+        self.args = args
+        self.accounts = load_accounts(args)
+        self.procs = []
+        self.success_tracks = []
+        self.failure_tracks = []
+
+    def run(self):
+        num_workers = len(self.accounts)
+        self.work_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        expander_lock = multiprocessing.Lock()
+
+        for worker_idx, account in enumerate(self.accounts):
+            _args = worker_args(self.args, account, worker_idx)
+            proc = multiprocessing.Process(
+                target=run_worker,
+                args=(_args, worker_idx, num_workers, self.work_queue,
+                      self.result_queue, expander_lock))
+            proc.start()
+            self.procs.append(proc)
+            print(Fore.GREEN + "Started worker " + account["name"] +
+                  Fore.RESET + " (log: " + _args.log[0] + ")")
+
+        while True:
+            try:
+                self.handle_result(self.result_queue.get(timeout=0.5))
+                continue
+            except queue.Empty:
+                pass
+
+            if not any(proc.is_alive() for proc in self.procs):
+                break
+
+            # make sure nobody waits forever for a worker that died
+            # while queueing tracks
+            if (self.expander is not None and self.num_queued is None and
+                    not self.procs[self.expander].is_alive()):
+                print(Fore.RED + "Worker " +
+                      self.accounts[self.expander]["name"] +
+                      " exited while queueing tracks" + Fore.RESET)
+                self.num_queued = 0
+                for i in range(num_workers):
+                    self.work_queue.put(None)
+
+        for proc in self.procs:
+            proc.join()
+
+        self.write_failure_log()
+        self.print_summary()
+
+    def handle_result(self, result):
+        name = self.accounts[result[1]]["name"]
+        if result[0] == "expanding":
+            self.expander = result[1]
+            print("Worker " + name + " is loading tracks...")
+        elif result[0] == "queued":
+            self.num_queued = result[2]
+            print(str(result[2]) + " tracks queued")
+        elif result[0] == "login_failed":
+            print(Fore.RED + "Worker " + name + " could not log in" +
+                  Fore.RESET)
+        elif result[0] == "success":
+            self.success_tracks.append(result[2:])
+            print(Fore.GREEN + "[" + name + "] Ripped " + result[3] +
+                  Fore.RESET)
+            for audio_file in result[4]:
+                print(Fore.CYAN + audio_file + Fore.RESET)
+        elif result[0] == "failure":
+            self.failure_tracks.append(result[2:])
+            print(Fore.RED + "[" + name + "] Failed " + result[3] +
+                  Fore.RESET)
+
+    def write_failure_log(self):
+        if self.args.fail_log is None or len(self.failure_tracks) == 0:
+            return
+
+        _base_dir = base_dir(self.args)
+        if not os.path.exists(_base_dir):
+            os.makedirs(_base_dir)
+        with open(os.path.join(_base_dir, self.args.fail_log[0]), 'w') as f:
+            for uri, name in self.failure_tracks:
+                f.write(uri + "\n")
+
+    def print_summary(self):
+        if len(self.success_tracks) > 0:
+            print(Fore.GREEN + "\nSuccess Summary\n" + ("-" * 79) +
+                  Fore.RESET)
+            for uri, name, audio_files in self.success_tracks:
+                print(" • " + name)
+            print("")
+        if len(self.failure_tracks) > 0:
+            print(Fore.RED + "\nFailure Summary\n" + ("-" * 79) +
+                  Fore.RESET)
+            for uri, name in self.failure_tracks:
+                print(" • " + name)
+            print("")
+
+    def abort(self):
+        for proc in self.procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in self.procs:
+            proc.join()
+        self.write_failure_log()
+        self.print_summary()
@@ -6,13 +6,119 @@ from colorama import Fore, Style
 from mutagen import mp3, id3, flac, oggvorbis, oggopus, aac
 from stat import ST_SIZE
 from spotify_ripper.utils import *
+from spotify_ripper.albumcache import AlbumMeta
+from spotify_ripper.webapi import WebAPI
+from spotify_ripper.trace import null_trace
 import os
 import sys
-import requests
-import base64
 
-
-def set_metadata_tags(args, audio_file, track):
+# output types whose encoder reserves room for the tags and cover, so
+# mutagen can write them in place instead of rewriting the whole file
+padded_types = ["mp3", "flac"]
+
+# output types tagged by the encoder itself, mutagen can only grow an
+# Ogg comment header by rewriting the file
+encoder_tagged_types = ["ogg", "opus"]
+
+# room for the text tags, on top of the cover
+tag_padding = 16384
+
+# the cover's share of the padding is rounded up to this, so albums with
+# covers of about the same size can use the encoder spawned ahead
+cover_padding_step = 32768
+
+# longest single argument Linux accepts (MAX_ARG_STRLEN)
+max_arg_len = 131072
+
+
+def track_genres(args, track, web_api=None):
+    """genres of the track's artist or album from the Web API"""
+    if args.genres is None:
+        return None
+    if web_api is None:
+        web_api = WebAPI(args)
+    item = track.artists[0] if args.genres[0] == "artist" else track.album
+    return web_api.genres(args.genres[0], item.link.uri)
+
+
+def vorbis_comments(args, track, album_meta, genres):
+    """(name, value) of the Vorbis comments of a track"""
+    def tag_str(_str):
+        return _str if args.ascii_path_only else to_ascii(args, _str)
+
+    comments = []
+    if album_meta.name is not None:
+        comments.append(("ALBUM", tag_str(album_meta.name)))
+    comments += [
+        ("TITLE", tag_str(track.name)),
+        ("ARTIST", tag_str(track.artists[0].name)),
+        ("YEAR", str(album_meta.year)),
+        ("DISCNUMBER", str(track.disc)),
+        ("DISCTOTAL", str(album_meta.num_discs)),
+        ("TRACKNUMBER", str(track.index)),
+        ("TRACKTOTAL", str(album_meta.num_tracks(track.disc))),
+    ]
+    if args.comment is not None:
+        comments.append(("COMMENT", tag_str(args.comment[0])))
+    if genres:
+        comments.append(("GENRE", ", ".join(
+            [tag_str(genre) for genre in genres])))
+    return comments
+
+
+def encoder_tag_args(args, track, album_meta, web_api=None):
+    """extra encoder arguments that tag the track (or make room for its
+    tags) while it is encoded, returns (arguments, tagged) where tagged
+    means the encoder wrote all the tags itself"""
+    output_type = args.output_type
+    if output_type not in padded_types + encoder_tagged_types:
+        return None, False
+
+    # the cover is saved next to the file instead of being embedded
+    cover = album_meta.cover if args.cover_file is None else None
+
+    if output_type in padded_types:
+        # without a cover the encoder's default padding will do
+        if cover is None:
+            return None, False
+        steps = (len(cover.data) + cover_padding_step - 1) // \
+            cover_padding_step
+        padding = tag_padding + steps * cover_padding_step
+        if output_type == "mp3":
+            return ["--pad-id3v2-size", str(padding)], False
+        return ["--padding=" + str(padding)], False
+
+    comments = vorbis_comments(args, track, album_meta,
+                               track_genres(args, track, web_api))
+    if output_type == "opus":
+        extra_args = []
+        for name, value in comments:
+            extra_args += ["--comment", name + "=" + value]
+        if cover is not None:
+            if cover.path is None:
+                return None, False
+            extra_args += ["--picture", cover.path]
+    else:
+        if cover is not None:
+            comments.append(("METADATA_BLOCK_PICTURE", cover.vorbis_block))
+        extra_args = []
+        for name, value in comments:
+            comment = name + "=" + value
+            # mutagen adds what doesn't fit on the command line
+            if len(comment.encode("utf-8")) >= max_arg_len:
+                return None, False
+            extra_args += ["-c", comment]
+
+    # python 2 can only pass byte strings to a process
+    if sys.version_info < (3, 0):
+        extra_args = [arg.encode("utf-8") for arg in extra_args]
+    return extra_args, True
+
+
+def set_metadata_tags(args, audio_file, track, album_meta=None,
+                      web_api=None, trace=null_trace, tagged=False):
+    """tag a ripped file, tagged means the encoder already wrote the
+    tags and only the cover file (if any) is left to do"""
     # log completed file
     print(Fore.GREEN + Style.BRIGHT + os.path.basename(audio_file) +
           Style.NORMAL + "\t[ " + format_size(os.stat(audio_file)[ST_SIZE]) +
@@ -25,49 +131,23 @@ def set_metadata_tags(args, audio_file, track):
     # ensure everything is loaded still
     if not track.is_loaded:
         track.load()
-    if not track.album.is_loaded:
-        track.album.load()
-    album_browser = track.album.browse()
-    album_browser.load()
-
-    # calculate num of tracks on disc and num of dics
-    num_discs = 0
-    num_tracks = 0
-    for track_browse in album_browser.tracks:
-        if (track_browse.disc == track.disc and
-                track_browse.index > track.index):
-            num_tracks = track_browse.index
-        if track_browse.disc > num_discs:
-            num_discs = track_browse.disc
+    if album_meta is None:
+        album_meta = AlbumMeta(track.album)
+
+    # num of tracks on disc and num of discs
+    with trace.stage("album_browse"):
+        num_discs = album_meta.num_discs
+        num_tracks = album_meta.num_tracks(track.disc)
 
     # try to get genres from Spotify's Web API
-    genres = None
-    if args.genres is not None:
-        item = track.artists[0] if args.genres[0] == "artist" else track.album
-        uri_tokens = item.link.uri.split(':')
-        if len(uri_tokens) == 3:
-            url = ('https://api.spotify.com/v1/' +
-                   args.genres[0] + 's/' + uri_tokens[2])
-            print(
-                Fore.GREEN + "Attempting to retrieve genres "
-                             "from Spotify's Web API" + Fore.RESET)
-            print(Fore.CYAN + url + Fore.RESET)
-            req = requests.get(url)
-            if req.status_code == 200:
-                try:
-                    resp_json = req.json()
-                    genres = resp_json["genres"]
-                except KeyError as e:
-                    pass
-            else:
-                print(Fore.YELLOW + "URL returned non-200 HTTP code: " +
-                      str(req.status_code) + Fore.RESET)
+    with trace.stage("genres"):
+        genres = track_genres(args, track, web_api)
 
     # use mutagen to update id3v2 tags and vorbis comments
     try:
         audio = None
         on_error = 'replace' if args.ascii_path_only else 'ignore'
-        album = to_ascii(args, track.album.name, on_error)
+        album = to_ascii(args, album_meta.name, on_error)
         artist = to_ascii(args, track.artists[0].name, on_error)
         title = to_ascii(args, track.name, on_error)
         if args.comment is not None:
@@ -76,7 +156,8 @@ def set_metadata_tags(args, audio_file, track):
             genres_ascii = [to_ascii(args, genre) for genre in genres]
 
         # cover art image
-        image = track.album.cover()
+        with trace.stage("cover"):
+            image = album_meta.cover
 
         def tag_to_ascii(_str, _str_ascii):
             return _str if args.ascii_path_only else _str_ascii
@@ -89,7 +170,6 @@ def set_metadata_tags(args, audio_file, track):
 
         def save_cover_image(embed_image_func):
             if image is not None:
-                image.load()
                 if args.cover_file is not None:
                     cover_path = os.path.dirname(audio_file)
                     cover_file = os.path.join(cover_path, args.cover_file[0])
@@ -100,25 +180,19 @@ def set_metadata_tags(args, audio_file, track):
                     embed_image_func()
 
         def set_id3_tags(audio):
-            # add ID3 tag if it doesn't exist
-            audio.add_tags()
+            # add ID3 tag if it doesn't exist, lame writes an empty one
+            # to reserve room for the tags
+            if audio.tags is None:
+                audio.add_tags()
 
             def embed_image():
-                audio.tags.add(
-                    id3.APIC(
-                        encoding=3,
-                        mime='image/jpeg',
-                        type=3,
-                        desc='Front Cover',
-                        data=image.data
-                    )
-                )
+                audio.tags.add(image.apic)
 
             save_cover_image(embed_image)
 
             if album is not None:
                 audio.tags.add(
-                    id3.TALB(text=[tag_to_ascii(track.album.name, album)],
+                    id3.TALB(text=[tag_to_ascii(album_meta.name, album)],
                              encoding=3))
             audio.tags.add(
                 id3.TIT2(text=[tag_to_ascii(track.name, title)],
@@ -126,7 +200,7 @@ def set_metadata_tags(args, audio_file, track):
             audio.tags.add(
                 id3.TPE1(text=[tag_to_ascii(track.artists[0].name, artist)],
                          encoding=3))
-            audio.tags.add(id3.TDRC(text=[str(track.album.year)],
+            audio.tags.add(id3.TDRC(text=[str(album_meta.year)],
                                     encoding=3))
             audio.tags.add(
                 id3.TPOS(text=[idx_of_total_str(track.disc, num_discs)],
@@ -154,21 +228,13 @@ def set_metadata_tags(args, audio_file, track):
                 id3_dict = id3.ID3()
 
             def embed_image():
-                id3_dict.add(
-                    id3.APIC(
-                        encoding=3,
-                        mime='image/jpeg',
-                        type=3,
-                        desc='Front Cover',
-                        data=image.data
-                    )
-                )
+                id3_dict.add(image.apic)
 
             save_cover_image(embed_image)
 
             if album is not None:
                 id3_dict.add(
-                    id3.TALB(text=[tag_to_ascii(track.album.name, album)],
+                    id3.TALB(text=[tag_to_ascii(album_meta.name, album)],
                              encoding=3))
             id3_dict.add(
                 id3.TIT2(text=[tag_to_ascii(track.name, title)],
@@ -176,7 +242,7 @@ def set_metadata_tags(args, audio_file, track):
             id3_dict.add(
                 id3.TPE1(text=[tag_to_ascii(track.artists[0].name, artist)],
                          encoding=3))
-            id3_dict.add(id3.TDRC(text=[str(track.album.year)],
+            id3_dict.add(id3.TDRC(text=[str(album_meta.year)],
                                   encoding=3))
             id3_dict.add(
                 id3.TPOS(text=[idx_of_total_str(track.disc, num_discs)],
@@ -198,39 +264,25 @@ def set_metadata_tags(args, audio_file, track):
             audio.tags = id3_dict
 
         def set_vorbis_comments(audio):
+            if tagged:
+                save_cover_image(lambda: None)
+                return
+
             # add Vorbis comment block if it doesn't exist
             if audio.tags is None:
                 audio.add_tags()
 
             def embed_image():
-                pic = flac.Picture()
-                pic.type = 3
-                pic.mime = "image/jpeg"
-                pic.desc = "Front Cover"
-                pic.data = image.data
                 if args.output_type == "flac":
-                    audio.add_picture(pic)
+                    audio.add_picture(image.flac_picture)
                 else:
-                    data = base64.b64encode(pic.write())
-                    audio["METADATA_BLOCK_PICTURE"] = [data.decode("ascii")]
+                    audio["METADATA_BLOCK_PICTURE"] = [image.vorbis_block]
 
             save_cover_image(embed_image)
 
-            if album is not None:
-                audio.tags["ALBUM"] = tag_to_ascii(track.album.name, album)
-            audio.tags["TITLE"] = tag_to_ascii(track.name, title)
-            audio.tags["ARTIST"] = tag_to_ascii(track.artists[0].name, artist)
-            audio.tags["YEAR"] = str(track.album.year)
-            audio.tags["DISCNUMBER"] = str(track.disc)
-            audio.tags["DISCTOTAL"] = str(num_discs)
-            audio.tags["TRACKNUMBER"] = str(track.index)
-            audio.tags["TRACKTOTAL"] = str(num_tracks)
-            if args.comment is not None:
-                audio.tags["COMMENT"] = tag_to_ascii(args.comment[0], comment)
-
-            if genres is not None and genres:
-                _genres = genres if args.ascii_path_only else genres_ascii
-                audio.tags["GENRE"] = ", ".join(_genres)
+            for name, value in vorbis_comments(args, track, album_meta,
+                                               genres):
+                audio.tags[name] = value
 
             audio.save()
 
@@ -241,15 +293,15 @@ def set_metadata_tags(args, audio_file, track):
                 audio.add_tags()
 
             def embed_image():
-                audio.tags["covr"] = mp4.MP4Cover(image.data)
+                audio.tags["covr"] = image.mp4_cover
 
             save_cover_image(embed_image)
 
             if album is not None:
-                audio.tags["\xa9alb"] = tag_to_ascii(track.album.name, album)
+                audio.tags["\xa9alb"] = tag_to_ascii(album_meta.name, album)
             audio["\xa9nam"] = tag_to_ascii(track.name, title)
             audio.tags["\xa9ART"] = tag_to_ascii(track.artists[0].name, artist)
-            audio.tags["\xa9day"] = str(track.album.year)
+            audio.tags["\xa9day"] = str(album_meta.year)
             audio.tags["disk"] = [(track.disc, num_discs)]
             audio.tags["trkn"] = [(track.index, num_tracks)]
             if args.comment is not None:
@@ -266,16 +318,16 @@ def set_metadata_tags(args, audio_file, track):
             audio.add_tags()
 
             def embed_image():
-                audio.tags[str("covr")] = m4a.M4ACover(image.data)
+                audio.tags[str("covr")] = image.m4a_cover
 
             save_cover_image(embed_image)
 
             if album is not None:
-                audio.tags[b"\xa9alb"] = tag_to_ascii(track.album.name, album)
+                audio.tags[b"\xa9alb"] = tag_to_ascii(album_meta.name, album)
             audio[b"\xa9nam"] = tag_to_ascii(track.name, title)
             audio.tags[b"\xa9ART"] = tag_to_ascii(
                 track.artists[0].name, artist)
-            audio.tags[b"\xa9day"] = str(track.album.year)
+            audio.tags[b"\xa9day"] = str(album_meta.year)
             audio.tags[str("disk")] = (track.disc, num_discs)
             audio.tags[str("trkn")] = (track.index, num_tracks)
             if args.comment is not None:
@@ -287,33 +339,35 @@ def set_metadata_tags(args, audio_file, track):
 
             audio.save()
 
-        if args.output_type == "flac":
-            audio = flac.FLAC(audio_file)
-            set_vorbis_comments(audio)
-        elif args.output_type == "ogg":
-            audio = oggvorbis.OggVorbis(audio_file)
-            set_vorbis_comments(audio)
-        elif args.output_type == "opus":
-            audio = oggopus.OggOpus(audio_file)
-            set_vorbis_comments(audio)
-        elif args.output_type == "aac":
-            audio = aac.AAC(audio_file)
-            set_id3_tags_raw(audio, audio_file)
-        elif args.output_type == "m4a":
-            if sys.version_info >= (3, 0):
-                from mutagen import mp4
-
-                audio = mp4.MP4(audio_file)
-                set_mp4_tags(audio)
-            else:
-                from mutagen import m4a, mp4
+        # opening the file and saving the tags, which may rewrite it
+        with trace.stage("save"):
+            if args.output_type == "flac":
+                audio = flac.FLAC(audio_file)
+                set_vorbis_comments(audio)
+            elif args.output_type == "ogg":
+                audio = oggvorbis.OggVorbis(audio_file)
+                set_vorbis_comments(audio)
+            elif args.output_type == "opus":
+                audio = oggopus.OggOpus(audio_file)
+                set_vorbis_comments(audio)
+            elif args.output_type == "aac":
+                audio = aac.AAC(audio_file)
+                set_id3_tags_raw(audio, audio_file)
+            elif args.output_type == "m4a":
+                if sys.version_info >= (3, 0):
+                    from mutagen import mp4
+
+                    audio = mp4.MP4(audio_file)
+                    set_mp4_tags(audio)
+                else:
+                    from mutagen import m4a, mp4
 
-                audio = m4a.M4A(audio_file)
-                set_m4a_tags(audio)
-                audio = mp4.MP4(audio_file)
-        elif args.output_type == "mp3":
-            audio = mp3.MP3(audio_file, ID3=id3.ID3)
-            set_id3_tags(audio)
+                    audio = m4a.M4A(audio_file)
+                    set_m4a_tags(audio)
+                    audio = mp4.MP4(audio_file)
+            elif args.output_type == "mp3":
+                audio = mp3.MP3(audio_file, ID3=id3.ID3)
+                set_id3_tags(audio)
 
         def bit_rate_str(bit_rate):
             brs = "%d kb/s" % bit_rate
@@ -346,7 +400,7 @@ def set_metadata_tags(args, audio_file, track):
         print(Fore.YELLOW + "Setting disc info: (" + str(track.disc) +
               ", " + str(num_discs) + ")" + Fore.RESET)
         print(Fore.YELLOW + "Setting release year: " +
-              str(track.album.year) + Fore.RESET)
+              str(album_meta.year) + Fore.RESET)
         if genres is not None and genres:
             print(Fore.YELLOW + "Setting genres: " +
                   " / ".join(genres_ascii) + Fore.RESET)
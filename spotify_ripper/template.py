@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import re
+
+# every tag of the format string and the name of its value
+tag_aliases = {
+    "track_artist": "track_artist",
+    "artist": "track_artist",
+    "track_artists": "track_artists",
+    "artists": "track_artists",
+    "album_artist": "album_artist",
+    "album_artists_web": "album_artists_web",
+    "album": "album",
+    "track_name": "track_name",
+    "track": "track_name",
+    "year": "year",
+    "ext": "ext",
+    "extension": "ext",
+    "idx": "idx",
+    "index": "idx",
+    "track_num": "track_num",
+    "track_idx": "track_num",
+    "track_index": "track_num",
+    "disc_num": "disc_num",
+    "disc_idx": "disc_num",
+    "disc_index": "disc_num",
+    "playlist": "playlist",
+    "playlist_name": "playlist",
+    "playlist_owner": "playlist_owner",
+    "playlist_user": "playlist_owner",
+    "playlist_username": "playlist_owner",
+    "user": "user",
+    "username": "user",
+}
+
+# tags that can be zero filled, e.g. {idx:3}
+fill_tags = {"idx", "track_num", "disc_num"}
+
+tag_re = re.compile(r"\{([a-z_]+)(?::(\d+))?\}")
+
+
+def truncate(_str, max_size):
+    return _str[:max_size].strip() if len(_str) > max_size else _str
+
+
+def truncate_dir_path(dir_path):
+    path_tokens = dir_path.split(os.pathsep)
+    path_tokens = [truncate(token, 255) for token in path_tokens]
+    return os.pathsep.join(path_tokens)
+
+
+def truncate_file_name(file_name):
+    tokens = file_name.rsplit(os.extsep, 1)
+    if len(tokens) > 1:
+        tokens[0] = truncate(tokens[0], 255 - len(tokens[1]) - 1)
+    else:
+        tokens[0] = truncate(tokens[0], 255)
+    return os.extsep.join(tokens)
+
+
+def truncate_path(audio_file):
+    """ensure each component in path is no more than 255 chars long"""
+    tokens = audio_file.rsplit(os.pathsep, 1)
+    if len(tokens) > 1:
+        return os.path.join(
+            truncate_dir_path(tokens[0]), truncate_file_name(tokens[1]))
+    else:
+        return truncate_file_name(tokens[0])
+
+
+class PathTemplate(object):
+    """a format string parsed once into literal text and tags, so a path
+    is built with a single join and only the tags it uses are computed"""
+    base_dir = None
+
+    def __init__(self, format_str):
+        self.format_str = format_str
+        self.parts = []
+        self.tags = set()
+
+        pos = 0
+        for match in tag_re.finditer(format_str):
+            name = tag_aliases.get(match.group(1))
+            width = match.group(2)
+
+            # unknown tags (and widths on tags that can't be filled) are
+            # left in the path as they are
+            if name is None or (width is not None and name not in fill_tags):
+                continue
+
+            self.parts.append(format_str[pos:match.start()])
+            self.parts.append((name, int(width) if width else None))
+            self.tags.add(name)
+            pos = match.end()
+        self.parts.append(format_str[pos:])
+
+    def uses(self, name):
+        return name in self.tags
+
+    def render(self, values):
+        """path for values, a dict of tag name to a string or to a
+        function that computes the string"""
+        computed = {}
+        for name in self.tags:
+            value = values[name]
+            computed[name] = value() if callable(value) else value
+
+        path = []
+        for part in self.parts:
+            if isinstance(part, tuple):
+                name, width = part
+                path.append(computed[name] if width is None
+                            else computed[name].zfill(width))
+            else:
+                path.append(part)
+        return truncate_path("".join(path))
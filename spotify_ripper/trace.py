@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import io
+import json
+import threading
+
+
+class TrackTrace(object):
+    """monotonic start and end times of the stages of one track (or of
+    one output of a track) plus the frames/bytes that went through it"""
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.outputs = OrderedDict()
+        self.frames = 0
+        self.bytes = 0
+
+    def add(self, name, start, end):
+        self.stages[name] = [round(start, 6), round(end, 6)]
+
+    @contextmanager
+    def stage(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, start, monotonic())
+
+    def output(self, output_type):
+        trace = self.outputs.get(output_type)
+        if trace is None:
+            trace = self.outputs[output_type] = TrackTrace()
+        return trace
+
+
+class NullTrace(TrackTrace):
+    """stands in for a TrackTrace when tracing is off"""
+
+    def add(self, name, start, end):
+        pass
+
+    def output(self, output_type):
+        return self
+
+
+# shared by everything that is not traced
+null_trace = NullTrace()
+
+
+class Tracer(object):
+    """writes one JSON record per track with the timings of its stages
+    to the --trace file, for offline analysis of where the time goes"""
+
+    def __init__(self, args):
+        self.lock = threading.Lock()
+        self.tracks = {}
+        self.f = None
+        if args.trace is not None:
+            trace_file = norm_path(args.trace[0])
+            make_dirs(os.path.dirname(trace_file))
+            self.f = io.open(trace_file, "a", encoding="utf-8")
+
+    def track(self, idx, uri):
+        """trace of a track, started the first time it is asked for"""
+        if self.f is None:
+            return null_trace
+        with self.lock:
+            trace = self.tracks.get((idx, uri))
+            if trace is None:
+                trace = self.tracks[(idx, uri)] = TrackTrace()
+            return trace
+
+    def finish(self, idx, uri, result):
+        """write out the record of a track that needs no more work"""
+        if self.f is None:
+            return
+        with self.lock:
+            trace = self.tracks.pop((idx, uri), None)
+            if trace is None:
+                return
+            record = OrderedDict([("uri", uri), ("idx", idx),
+                                  ("result", result)])
+            record["frames"] = trace.frames
+            record["stages"] = trace.stages
+            record["outputs"] = OrderedDict(
+                [(output_type, {"bytes": output.bytes,
+                                "stages": output.stages})
+                 for output_type, output in trace.outputs.items()])
+            try:
+                self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self.f.flush()
+            except (IOError, OSError) as e:
+                print(Fore.YELLOW + "Warning: could not write trace of " +
+                      uri + Fore.RESET)
+                print(str(e))
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
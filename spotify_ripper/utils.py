@@ -8,6 +8,10 @@ import sys
 import errno
 import re
 import math
+import time
+
+# time.monotonic is python 3.3+, fall back to the wall clock
+monotonic = getattr(time, "monotonic", time.time)
 
 
 def print_str(args, _str):
@@ -22,13 +26,36 @@ def norm_path(path):
     return os.path.normpath(os.path.realpath(path))
 
 
+slash_re = re.compile(r"\s*/\s*")
+offending_re = re.compile(r"""\s*[\\/:"*?<>|]+\s*""")
+dots_re = re.compile(r"(^\.+\s*|(?<=\.)\.+|\s*\.+$)")
+
+
 # borrowed from AndersTornkvist's fork
 def escape_filename_part(part):
     """escape possible offending characters"""
-    part = re.sub(r"\s*/\s*", r' & ', part)
-    part = re.sub(r"""\s*[\\/:"*?<>|]+\s*""", r' ', part)
+    part = slash_re.sub(r' & ', part)
+    part = offending_re.sub(r' ', part)
     part = part.strip()
-    part = re.sub(r"(^\.+\s*|(?<=\.)\.+|\s*\.+$)", r'', part)
+    part = dots_re.sub(r'', part)
+    return part
+
+
+# memoized path components, an album's artist and name are the same for
+# every one of its tracks
+_path_parts = {}
+
+
+def path_part(args, _str, escape=True):
+    """escaped and (if needed) ascii folded path component"""
+    key = (args.ascii, escape, _str)
+    part = _path_parts.get(key)
+    if part is None:
+        if len(_path_parts) >= 4096:
+            _path_parts.clear()
+        part = to_ascii(
+            args, escape_filename_part(_str) if escape else _str)
+        _path_parts[key] = part
     return part
 
 
@@ -63,6 +90,11 @@ def rm_file(file_name):
             print(str(e))
 
 
+def make_dirs(path):
+    if path and not os.path.exists(path):
+        os.makedirs(path)
+
+
 def default_settings_dir():
     return norm_path(os.path.join(os.path.expanduser("~"), ".spotify-ripper"))
 
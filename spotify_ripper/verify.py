@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+from spotify_ripper.pcmfile import PCM_BYTES_PER_MS, WAV_HEADER_SIZE
+from spotify_ripper.spool import init_worker
+from collections import OrderedDict
+import os
+import io
+import json
+import wave
+import multiprocessing
+import mutagen
+from mutagen import id3
+
+# seconds a file may be longer or shorter than the track
+duration_tolerance = 2.0
+
+# tags a ripped file needs, by their ID3, Vorbis comment or MP4 key
+required_tags = [
+    ("title", ["TIT2", "title", "\xa9nam", b"\xa9nam"]),
+    ("artist", ["TPE1", "artist", "\xa9ART", b"\xa9ART"]),
+]
+
+
+def file_length(audio_file):
+    """(length in seconds, tags) of a ripped file, tags are None for
+    wav/pcm which are never tagged"""
+    ext = os.path.splitext(audio_file)[1].lower()
+    size = os.path.getsize(audio_file)
+    if ext == ".pcm":
+        return size / (PCM_BYTES_PER_MS * 1000), None
+    elif ext == ".wav":
+        wav_file = wave.open(audio_file, "rb")
+        try:
+            length = wav_file.getnframes() / float(wav_file.getframerate())
+        finally:
+            wav_file.close()
+        # the header is written first, a truncated file still claims
+        # the full length
+        return min(length, (size - WAV_HEADER_SIZE) /
+                   (PCM_BYTES_PER_MS * 1000)), None
+
+    audio = mutagen.File(audio_file)
+    if audio is None:
+        raise ValueError("unknown file type")
+    tags = audio.tags
+    if tags is None and ext == ".aac":
+        # mutagen's AAC doesn't read the ID3 tag in front of the stream
+        try:
+            tags = id3.ID3(audio_file)
+        except id3.ID3NoHeaderError:
+            tags = None
+    return audio.info.length, tags if tags is not None else {}
+
+
+def has_tag(tags, keys):
+    for key in keys:
+        try:
+            if key in tags:
+                return True
+        except (ValueError, TypeError):
+            # not a valid key for this kind of tag
+            pass
+    return False
+
+
+def verify_file(job):
+    """runs in a worker process, returns (audio_file, problem) where
+    problem is None if the file looks complete"""
+    audio_file, duration = job
+    try:
+        if not os.path.exists(audio_file):
+            return audio_file, "missing"
+        if os.path.getsize(audio_file) == 0:
+            return audio_file, "empty"
+
+        length, tags = file_length(audio_file)
+        if tags is not None:
+            for name, keys in required_tags:
+                if not has_tag(tags, keys):
+                    return audio_file, "no " + name + " tag"
+
+        expected = duration / 1000.0
+        if abs(length - expected) > duration_tolerance:
+            return audio_file, "%.1fs long, track is %.1fs" % (
+                length, expected)
+    except Exception as e:
+        return audio_file, "unreadable: " + str(e)
+    return audio_file, None
+
+
+class Verifier(object):
+    """with --verify, checks the files a track would be skipped for in a
+    process pool, so truncated or untagged files are ripped again"""
+    pool = None
+    chunk_size = 16
+
+    def __init__(self, args):
+        self.args = args
+        self.enabled = args.verify
+        self.results = OrderedDict()
+
+        # forked before the ripper starts any threads, like the spool's
+        # pool
+        if self.enabled:
+            self.pool = multiprocessing.Pool(
+                multiprocessing.cpu_count(), init_worker)
+
+    def verify(self, plans):
+        """plans with the ones whose files are not all valid no longer
+        skipped"""
+        if not self.enabled:
+            return plans
+
+        jobs = [(audio_file, plan.duration) for plan in plans if plan.skip
+                for audio_file in plan.audio_files
+                if audio_file not in self.results]
+        if len(jobs) > 1 and self.pool is not None:
+            results = self.pool.map(verify_file, jobs, self.chunk_size)
+        else:
+            results = [verify_file(job) for job in jobs]
+
+        uris = dict((audio_file, plan.uri) for plan in plans if plan.skip
+                    for audio_file in plan.audio_files)
+        for audio_file, problem in results:
+            self.results[audio_file] = {
+                "uri": uris[audio_file], "problem": problem, "ripped": False}
+            if problem is not None:
+                print(Fore.YELLOW + "Ripping " + audio_file + " again, " +
+                      problem + Fore.RESET)
+
+        def verified(plan):
+            if plan.skip and not all(self.is_valid(audio_file)
+                                     for audio_file in plan.audio_files):
+                return plan._replace(
+                    skip=False, size=calc_file_size(self.args, plan.track))
+            return plan
+
+        return [verified(plan) for plan in plans]
+
+    def is_valid(self, audio_file):
+        result = self.results.get(audio_file)
+        return result is None or result["problem"] is None or \
+            result["ripped"]
+
+    def ripped(self, audio_files):
+        """files of a track that has been ripped again"""
+        for audio_file in audio_files:
+            result = self.results.get(audio_file)
+            if result is not None and result["problem"] is not None:
+                result["ripped"] = True
+
+    def report(self):
+        """print a summary and write the --verify-report"""
+        if not self.enabled or not self.results:
+            return
+
+        invalid = [result for result in self.results.values()
+                   if result["problem"] is not None]
+        print(Fore.GREEN + "\nVerify Summary\n" + ("-" * 79) + Fore.RESET)
+        print("Checked " + str(len(self.results)) + " files, " +
+              str(len(invalid)) + " were missing or invalid, " +
+              str(sum(1 for result in invalid if result["ripped"])) +
+              " of them have been ripped again")
+
+        if self.args.verify_report is not None:
+            report_file = norm_path(self.args.verify_report[0])
+            rows = [OrderedDict([("file", audio_file),
+                                 ("uri", result["uri"]),
+                                 ("problem", result["problem"]),
+                                 ("ripped", result["ripped"])])
+                    for audio_file, result in self.results.items()]
+            try:
+                with io.open(report_file, "w", encoding="utf-8") as f:
+                    f.write(json.dumps(rows, ensure_ascii=False, indent=1))
+            except (IOError, OSError) as e:
+                print(Fore.YELLOW + "Warning: could not write verify "
+                      "report to " + report_file + Fore.RESET)
+                print(str(e))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+import os
+import io
+import json
+import time
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+api_url = 'https://api.spotify.com/v1/'
+
+# album and artist metadata hardly ever changes
+metadata_ttl = 30 * 24 * 3600
+
+# max number of ids per request of the multi-id endpoints
+batch_sizes = {"artist": 50, "album": 20}
+
+
+class WebAPI(object):
+    """client for Spotify's Web API that keeps its connections alive and
+    caches responses on disk in the settings directory
+
+    Cached responses are used until their TTL runs out, after that they
+    are revalidated with their ETag.
+    """
+    ttl = 24 * 3600
+    timeout = 30
+
+    def __init__(self, args):
+        self.args = args
+        self.cache_dir = os.path.join(settings_dir(args), "webapi")
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        self.session.mount("https://", adapter)
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.num_requests = 0
+        self.request_time = 0.0
+
+    def cache_file(self, url):
+        return os.path.join(
+            self.cache_dir,
+            hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def read_cache(self, url):
+        try:
+            with io.open(self.cache_file(url), "r", encoding="utf-8") as f:
+                entry = json.loads(f.read())
+            return entry if entry["url"] == url else None
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def write_cache(self, url, entry):
+        cache_file = self.cache_file(url)
+        tmp_file = cache_file + "." + str(threading.current_thread().ident)
+        try:
+            with io.open(tmp_file, "w", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False))
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError) as e:
+            rm_file(tmp_file)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def is_fresh(self, entry, ttl):
+        return entry is not None and time.time() - entry["time"] < ttl
+
+    def get_json(self, url, ttl=None, cache=True):
+        """JSON response of url, None if the request failed"""
+        ttl = self.ttl if ttl is None else ttl
+        entry = self.read_cache(url) if cache else None
+        if self.is_fresh(entry, ttl):
+            self.count("hits")
+            return entry["body"]
+
+        headers = {}
+        if entry is not None and entry.get("etag") is not None:
+            headers["If-None-Match"] = entry["etag"]
+
+        print(Fore.GREEN + "Retrieving from Spotify's Web API" + Fore.RESET)
+        print(Fore.CYAN + url + Fore.RESET)
+        start = time.time()
+        try:
+            req = self.session.get(url, headers=headers,
+                                   timeout=self.timeout)
+        except requests.RequestException as e:
+            print(Fore.YELLOW + "Warning: request failed" + Fore.RESET)
+            print(str(e))
+            return None
+        finally:
+            with self.lock:
+                self.num_requests += 1
+                self.request_time += time.time() - start
+
+        if req.status_code == 304 and entry is not None:
+            self.count("revalidated")
+            entry["time"] = time.time()
+            self.write_cache(url, entry)
+            return entry["body"]
+        elif req.status_code == 200:
+            self.count("misses")
+            try:
+                body = req.json()
+            except ValueError:
+                print(Fore.YELLOW + "Warning: invalid JSON response" +
+                      Fore.RESET)
+                return None
+            if cache:
+                self.write_cache(url, {
+                    "url": url,
+                    "time": time.time(),
+                    "etag": req.headers.get("ETag"),
+                    "body": body,
+                })
+            return body
+        else:
+            print(Fore.YELLOW + "URL returned non-200 HTTP code: " +
+                  str(req.status_code) + Fore.RESET)
+        return None
+
+    def item_url(self, item_type, item_id):
+        return api_url + item_type + 's/' + item_id
+
+    def get_item(self, item_type, uri):
+        """artist/album/track object of a Spotify URI"""
+        uri_tokens = uri.split(':')
+        if len(uri_tokens) != 3:
+            return None
+        return self.get_json(self.item_url(item_type, uri_tokens[2]),
+                             ttl=metadata_ttl)
+
+    def prefetch(self, item_type, uris):
+        """fetch the artists or albums of uris that are not cached yet
+        through the multi-id endpoint, so get_item finds them cached"""
+        ids = []
+        seen = set()
+        for uri in uris:
+            uri_tokens = uri.split(':')
+            if len(uri_tokens) != 3 or uri_tokens[2] in seen:
+                continue
+            seen.add(uri_tokens[2])
+            entry = self.read_cache(self.item_url(item_type, uri_tokens[2]))
+            if not self.is_fresh(entry, metadata_ttl):
+                ids.append(uri_tokens[2])
+
+        batch_size = batch_sizes[item_type]
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            resp = self.get_json(
+                api_url + item_type + 's?ids=' + ",".join(batch),
+                cache=False)
+            if resp is None:
+                continue
+
+            # unknown ids come back as null
+            for item in resp.get(item_type + 's', []):
+                if item is None or "id" not in item:
+                    continue
+                url = self.item_url(item_type, item["id"])
+                self.write_cache(url, {
+                    "url": url,
+                    "time": time.time(),
+                    "etag": None,
+                    "body": item,
+                })
+
+    def genres(self, item_type, uri):
+        item = self.get_item(item_type, uri)
+        return item.get("genres") if item is not None else None
+
+    def album_artists(self, uri):
+        album = self.get_item("album", uri)
+        if album is None:
+            return None
+        return [artist['name'] for artist in album['artists']]
+
+    def close(self):
+        self.session.close()